@@ -0,0 +1,852 @@
+# -*- coding: utf-8 -*-
+
+# In-process fake of the vCenter APIs used by the vSphere modules
+#
+# This provides just enough of pyVmomi and ansible.module_utils to
+# run the modules of this repository against a generated inventory without a
+# vCenter server, counting every call that would be a SOAP round trip.
+#
+# (c) 2016, Simon Rupf <simon@rupf.net>
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+import sys, threading, time, types
+
+# size in bytes assumed for the SOAP envelope of each request and response
+ENVELOPE_BYTES = 400
+
+# objects returned per page of RetrievePropertiesEx, like vCenter does
+PAGE_SIZE = 1000
+
+class Stats(object):
+    """Counts the round trips and estimated bytes of the fake SOAP calls"""
+    def __init__(self):
+        self.calls = {}
+        self.round_trips = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.first_request = None
+
+    def record(self, method, request=None, response=None):
+        """Records a single round trip of the given method and passes it
+        through the stub adapter, so hooks of the modules see it"""
+        sent = ENVELOPE_BYTES + payload_size(request)
+        received = ENVELOPE_BYTES + payload_size(response)
+        if self.first_request is None:
+            self.first_request = time.time()
+        self.calls[method] = self.calls.get(method, 0) + 1
+        self.round_trips += 1
+        self.bytes_sent += sent
+        self.bytes_received += received
+        STUB.InvokeMethod(None, DataObject(
+            wsdlName=method,
+            request_bytes=sent,
+            response_bytes=received), ())
+        # any call may have changed the inventory, so pending waits recheck
+        with UPDATES:
+            UPDATES.notify_all()
+
+STATS = Stats()
+
+# notified on every call, set once a session logged out
+UPDATES = threading.Condition()
+LOGGED_OUT = threading.Event()
+
+def payload_size(value):
+    """Returns the estimated size of a value serialized as SOAP XML"""
+    if value is None:
+        return 0
+    if isinstance(value, (bool, int, float)):
+        return 24
+    if isinstance(value, str) or value.__class__.__name__ == 'unicode':
+        return len(value) + 24
+    if isinstance(value, (list, tuple)):
+        return sum([payload_size(item) for item in value])
+    if isinstance(value, dict):
+        return sum([payload_size(key) + payload_size(item)
+            for key, item in value.items()])
+    if isinstance(value, ManagedObject):
+        return 80
+    if isinstance(value, DataObject):
+        return 40 + payload_size(value.__dict__)
+    return 24
+
+# data and managed objects
+
+class DataObject(object):
+    """A pyVmomi data object, attributes which were never set are None"""
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return None
+
+class Inventory(object):
+    """The properties of all managed objects of the fake vCenter"""
+    def __init__(self):
+        self.objects = {}
+        self.properties = {}
+        self.counter = 0
+
+    def add(self, vimtype, prefix, properties):
+        """Creates a managed object with the given properties"""
+        self.counter += 1
+        obj = vimtype('%s-%d' % (prefix, self.counter))
+        self.objects[obj._moId] = obj
+        self.properties[obj._moId] = properties
+        return obj
+
+    def of_type(self, vimtypes):
+        """Returns all objects which are instances of the given vimtypes"""
+        return [obj for obj in self.objects.values()
+            if isinstance(obj, tuple(vimtypes))]
+
+    def lookup(self, obj, path):
+        """Returns (True, value) of a dotted property path, (False, None) if
+        it is unset, raising ManagedObjectNotFound for unknown objects"""
+        if obj._moId not in self.properties:
+            raise vmodl.fault.ManagedObjectNotFound(obj=obj)
+        parts = path.split('.')
+        value = self.properties[obj._moId].get(parts[0])
+        if isinstance(value, types.FunctionType):
+            # computed on every lookup, like the members of a container view
+            value = value()
+        for part in parts[1:]:
+            if value is None:
+                break
+            value = getattr(value, part)
+        return value is not None, value
+
+INVENTORY = Inventory()
+
+class ManagedObject(object):
+    """A reference to a managed object, reading a property is a round trip"""
+    _wsdlName = 'ManagedObject'
+
+    def __init__(self, moId, stub=None, serverGuid=None):
+        self._moId = moId
+        self._stub = stub
+
+    def __eq__(self, other):
+        return isinstance(other, ManagedObject) and \
+            self._moId == other._moId
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self._moId)
+
+    def __repr__(self):
+        return "'vim.%s:%s'" % (self._wsdlName, self._moId)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        _, value = INVENTORY.lookup(self, name)
+        STATS.record('RetrieveProperties', name, value)
+        return value
+
+def managed_type(name, base=ManagedObject, **methods):
+    """Returns a new managed object class with the given methods"""
+    attributes = {'_wsdlName': name}
+    attributes.update(methods)
+    return type(name, (base,), attributes)
+
+def new_task(result=None, error=None):
+    """Returns a task, completed as soon as it was created"""
+    info = DataObject(
+        state=error and 'error' or 'success',
+        progress=100,
+        result=result,
+        error=error)
+    return INVENTORY.add(vim.Task, 'task', {'info': info})
+
+def clone_vm(template, folder, name, spec):
+    """Clones a VM (Clone and InstantClone_Task)"""
+    STATS.record('CloneVM_Task', spec)
+    for obj in INVENTORY.of_type([vim.VirtualMachine]):
+        if INVENTORY.properties[obj._moId].get('name') == name:
+            return new_task(error=vim.fault.DuplicateName(name=name))
+    source = INVENTORY.properties[template._moId]
+    config = spec.config or DataObject()
+    location = spec.location or DataObject()
+    properties = new_vm_properties(
+        name,
+        folder or location.folder or source['parent'],
+        location.pool or source['resourcePool'],
+        location.datastore or source['datastore'][0],
+        config.numCPUs or source['config'].hardware.numCPU,
+        config.memoryMB or source['config'].hardware.memoryMB,
+        config.annotation or '',
+        spec.template and True or False,
+        spec.powerOn and 'poweredOn' or 'poweredOff',
+        source['runtime'].host)
+    return new_task(result=INVENTORY.add(vim.VirtualMachine, 'vm', properties))
+
+def relocate_vm(vm, spec, priority=None):
+    """Changes the resource pool, folder or datastore of a VM"""
+    STATS.record('RelocateVM_Task', spec)
+    properties = INVENTORY.properties[vm._moId]
+    if spec.pool:
+        properties['resourcePool'] = spec.pool
+    if spec.folder:
+        properties['parent'] = spec.folder
+    if spec.host:
+        properties['runtime'].host = spec.host
+    return new_task()
+
+def reconfig_vm(vm, spec):
+    """Changes the annotation, CPUs or memory of a VM"""
+    STATS.record('ReconfigVM_Task', spec)
+    properties = INVENTORY.properties[vm._moId]
+    if spec.annotation is not None:
+        properties['config'].annotation = spec.annotation
+    if spec.numCPUs:
+        properties['config'].hardware.numCPU = spec.numCPUs
+        properties['summary'].config.numCpu = spec.numCPUs
+    if spec.memoryMB:
+        properties['config'].hardware.memoryMB = spec.memoryMB
+        properties['summary'].config.memorySizeMB = spec.memoryMB
+    return new_task()
+
+def migrate_vm(vm, pool=None, host=None, priority=None, state=None):
+    """Migrates a VM to another resource pool and/or host"""
+    STATS.record('MigrateVM_Task', [pool, host, priority])
+    properties = INVENTORY.properties[vm._moId]
+    if pool:
+        properties['resourcePool'] = pool
+    if host:
+        properties['runtime'].host = host
+    return new_task()
+
+def upgrade_tools(vm, installerOptions=None):
+    """Upgrades the VMware tools of a VM"""
+    STATS.record('UpgradeTools_Task', installerOptions)
+    INVENTORY.properties[vm._moId]['guest'].toolsVersionStatus2 = \
+        'guestToolsCurrent'
+    return new_task()
+
+def container_members(container, vimtypes, recursive):
+    """Returns the objects of the given vimtypes inside of a container"""
+    members = []
+    for obj in INVENTORY.of_type(vimtypes):
+        properties = INVENTORY.properties[obj._moId]
+        parents = [properties.get('parent'), properties.get('resourcePool')]
+        seen = []
+        while parents:
+            parent = parents.pop(0)
+            if parent is None or parent in seen:
+                continue
+            if parent == container:
+                members.append(obj)
+                break
+            seen.append(parent)
+            if recursive:
+                parents.append(INVENTORY.properties[parent._moId].get('parent'))
+    return members
+
+def create_container_view(manager, container, type, recursive):
+    """Returns a container view of the objects of the given types, which
+    follows the changes of the inventory"""
+    STATS.record('CreateContainerView', type)
+    def members():
+        if container == ROOT['folder']:
+            return INVENTORY.of_type(type)
+        return container_members(container, type, recursive)
+    return INVENTORY.add(vim.view.ContainerView, 'session', {'view': members})
+
+def destroy(obj):
+    """Destroys a view, property collector or filter"""
+    STATS.record('Destroy')
+    INVENTORY.properties.pop(obj._moId, None)
+
+def traversal_specs(select_set, named):
+    """Collects the named traversal specs of a select set into named"""
+    for spec in select_set or []:
+        if spec.path is not None and spec.name not in named:
+            named[spec.name] = spec
+            traversal_specs(spec.selectSet, named)
+
+def traverse(obj, select_set, named, reached, seen):
+    """Appends the objects reached from obj through the select set"""
+    for spec in select_set or []:
+        spec = named.get(spec.name, spec)
+        if spec.path is None or not isinstance(obj, spec.type):
+            continue
+        _, value = INVENTORY.lookup(obj, spec.path)
+        if not isinstance(value, list):
+            value = value is not None and [value] or []
+        for target in value:
+            if target._moId in seen:
+                continue
+            seen.add(target._moId)
+            if not spec.skip:
+                reached.append(target)
+            traverse(target, spec.selectSet, named, reached, seen)
+
+def retrieve_objects(filter_spec):
+    """Returns a list of (object, property paths) selected by a filter"""
+    selected = []
+    named = {}
+    for object_spec in filter_spec.objectSet:
+        traversal_specs(object_spec.selectSet, named)
+    for object_spec in filter_spec.objectSet:
+        objs = []
+        if not object_spec.skip:
+            objs.append(object_spec.obj)
+        traverse(object_spec.obj, object_spec.selectSet, named, objs,
+            set([object_spec.obj._moId]))
+        for obj in objs:
+            paths = []
+            for property_spec in filter_spec.propSet:
+                if isinstance(obj, property_spec.type):
+                    paths.extend(property_spec.pathSet or [])
+            if paths:
+                selected.append((obj, paths))
+    return selected
+
+def object_content(obj, paths):
+    """Returns the ObjectContent of the given paths of an object"""
+    prop_set = []
+    for path in paths:
+        is_set, value = INVENTORY.lookup(obj, path)
+        if is_set:
+            prop_set.append(DataObject(name=path, val=value))
+    return DataObject(obj=obj, propSet=prop_set)
+
+def retrieve_properties_ex(collector, specSet, options=None):
+    """Returns the first page of the properties selected by the filters"""
+    objects = []
+    for filter_spec in specSet:
+        for obj, paths in retrieve_objects(filter_spec):
+            objects.append(object_content(obj, paths))
+    page_size = (options and options.maxObjects) or PAGE_SIZE
+    return result_page(collector, 'RetrievePropertiesEx', specSet, objects,
+        page_size)
+
+def result_page(collector, method, request, objects, page_size):
+    """Returns a page of a RetrieveResult, keeping the rest for later"""
+    page, rest = objects[:page_size], objects[page_size:]
+    token = None
+    if rest:
+        token = 'token-%d' % len(rest)
+        PAGES[token] = (rest, page_size)
+    result = DataObject(objects=page, token=token)
+    STATS.record(method, request, result)
+    if not page:
+        return None
+    return result
+
+PAGES = {}
+
+def continue_retrieve_properties_ex(collector, token):
+    """Returns the next page of a RetrievePropertiesEx result"""
+    objects, page_size = PAGES.pop(token)
+    return result_page(collector, 'ContinueRetrievePropertiesEx', token,
+        objects, page_size)
+
+def create_property_collector(collector):
+    """Returns a new property collector"""
+    STATS.record('CreatePropertyCollector')
+    return INVENTORY.add(vmodl.query.PropertyCollector, 'session',
+        {'filters': []})
+
+def create_filter(collector, spec, partialUpdates):
+    """Adds a filter to a property collector"""
+    STATS.record('CreateFilter', spec)
+    INVENTORY.properties[collector._moId]['filters'].append(spec)
+    return INVENTORY.add(vmodl.query.PropertyCollector.Filter, 'session', {})
+
+def wait_for_updates_ex(collector, version=None, options=None):
+    """Returns all properties of the filters on the first call and the
+    changes since the given version afterwards, blocking until a change
+    or maxWaitSeconds like the vCenter server does"""
+    state = INVENTORY.properties[collector._moId]
+    deadline = time.time() + ((options and options.maxWaitSeconds) or 0)
+    with UPDATES:
+        while True:
+            if LOGGED_OUT.is_set():
+                raise vim.fault.NotAuthenticated(
+                    msg='The session is not authenticated.')
+            object_sets = filter_changes(state, bool(version))
+            remaining = deadline - time.time()
+            if object_sets or remaining <= 0:
+                break
+            UPDATES.wait(remaining)
+    update = None
+    if object_sets:
+        update = DataObject(
+            version=str(int(version or 0) + 1),
+            filterSet=[DataObject(objectSet=object_sets)])
+    STATS.record('WaitForUpdatesEx', version, update)
+    return update
+
+def filter_changes(state, incremental):
+    """Diffs the objects of the filters of a collector against the values
+    it reported last"""
+    reported = state.setdefault('reported', {})
+    current = {}
+    object_sets = []
+    for spec in state['filters']:
+        for obj, paths in retrieve_objects(spec):
+            values = {}
+            for prop in object_content(obj, paths).propSet:
+                values[prop.name] = prop.val
+            current[obj._moId] = (obj, values)
+            previous = reported.get(obj._moId, (None, None))[1]
+            if not incremental or previous is None:
+                kind, changed = 'enter', values
+            else:
+                kind, changed = 'modify', {}
+                for name, value in values.items():
+                    if name not in previous or previous[name] != value:
+                        changed[name] = value
+                if not changed:
+                    continue
+            object_sets.append(DataObject(
+                obj=obj,
+                kind=kind,
+                changeSet=[DataObject(name=name, op='assign', val=value)
+                    for name, value in changed.items()]))
+    if incremental:
+        for moid, (obj, values) in reported.items():
+            if moid not in current:
+                object_sets.append(DataObject(obj=obj, kind='leave', changeSet=[]))
+    state['reported'] = current
+    return object_sets
+
+def find_by_uuid(search_index, datacenter=None, uuid=None, vmSearch=True,
+    instanceUuid=False):
+    """Returns the VM with the given BIOS or instance UUID"""
+    STATS.record('FindByUuid', uuid)
+    attribute = instanceUuid and 'instanceUuid' or 'uuid'
+    for vm in INVENTORY.of_type([vim.VirtualMachine]):
+        if getattr(INVENTORY.properties[vm._moId]['config'], attribute) == uuid:
+            return vm
+    return None
+
+def find_by_inventory_path(search_index, inventoryPath):
+    """Returns the VM with the given inventory path"""
+    STATS.record('FindByInventoryPath', inventoryPath)
+    name = inventoryPath.split('/')[-1]
+    for vm in INVENTORY.of_type([vim.VirtualMachine]):
+        if INVENTORY.properties[vm._moId]['name'] == name:
+            return vm
+    return None
+
+def find_child(search_index, entity, name):
+    """Returns the child of an entity with the given name"""
+    STATS.record('FindChild', name)
+    for obj, properties in INVENTORY.properties.items():
+        if properties.get('parent') == entity and \
+            properties.get('name') == name:
+            return INVENTORY.objects[obj]
+    return None
+
+def retrieve_content(service_instance):
+    """Returns the service content"""
+    STATS.record('RetrieveServiceContent', None, ROOT['content'])
+    return ROOT['content']
+
+# the vim and vmodl namespaces
+
+def namespace(name, **members):
+    """Returns a module like namespace with the given members"""
+    module = types.ModuleType(name)
+    module.__dict__.update(members)
+    return module
+
+def data_type(name):
+    """Returns a new data object class"""
+    return type(name, (DataObject,), {})
+
+class MethodFault(Exception):
+    """The base class of all faults"""
+    def __init__(self, msg=None, **kwargs):
+        Exception.__init__(self, msg)
+        self.msg = msg
+        self.__dict__.update(kwargs)
+
+def fault_type(name):
+    """Returns a new fault class"""
+    return type(name, (MethodFault,), {})
+
+ManagedEntity = managed_type('ManagedEntity')
+PropertyCollector = managed_type(
+    'PropertyCollector',
+    RetrievePropertiesEx=retrieve_properties_ex,
+    ContinueRetrievePropertiesEx=continue_retrieve_properties_ex,
+    CreatePropertyCollector=create_property_collector,
+    CreateFilter=create_filter,
+    WaitForUpdatesEx=wait_for_updates_ex,
+    Destroy=destroy)
+for _name in ['FilterSpec', 'ObjectSpec', 'PropertySpec', 'TraversalSpec',
+    'RetrieveOptions', 'WaitOptions', 'SelectionSpec']:
+    setattr(PropertyCollector, _name, data_type(_name))
+PropertyCollector.Filter = managed_type('PropertyFilter')
+
+vmodl = namespace(
+    'pyVmomi.vmodl',
+    MethodFault=MethodFault,
+    ManagedObject=ManagedObject,
+    query=namespace('pyVmomi.vmodl.query', PropertyCollector=PropertyCollector),
+    fault=namespace(
+        'pyVmomi.vmodl.fault',
+        ManagedObjectNotFound=fault_type('ManagedObjectNotFound'),
+        SecurityError=fault_type('SecurityError'),
+        InvalidArgument=fault_type('InvalidArgument')))
+
+Folder = managed_type('Folder', ManagedEntity)
+vim = namespace(
+    'pyVmomi.vim',
+    ManagedEntity=ManagedEntity,
+    Folder=Folder,
+    StoragePod=managed_type('StoragePod', Folder),
+    Datacenter=managed_type('Datacenter', ManagedEntity),
+    Datastore=managed_type('Datastore', ManagedEntity),
+    ResourcePool=managed_type('ResourcePool', ManagedEntity),
+    ClusterComputeResource=managed_type('ClusterComputeResource',
+        ManagedEntity),
+    HostSystem=managed_type('HostSystem', ManagedEntity),
+    VirtualMachine=managed_type(
+        'VirtualMachine',
+        ManagedEntity,
+        Clone=lambda self, folder, name, spec: clone_vm(
+            self, folder, name, spec),
+        InstantClone_Task=lambda self, spec: clone_vm(
+            self, None, spec.name, spec),
+        RelocateVM_Task=relocate_vm,
+        ReconfigVM_Task=reconfig_vm,
+        MigrateVM_Task=migrate_vm,
+        UpgradeTools=upgrade_tools,
+        UpgradeTools_Task=upgrade_tools),
+    Task=managed_type('Task'),
+    ServiceInstance=managed_type(
+        'ServiceInstance',
+        RetrieveContent=retrieve_content),
+    SearchIndex=managed_type(
+        'SearchIndex',
+        FindByUuid=find_by_uuid,
+        FindByInventoryPath=find_by_inventory_path,
+        FindChild=find_child),
+    ViewManager=managed_type(
+        'ViewManager',
+        CreateContainerView=create_container_view),
+    view=namespace(
+        'pyVmomi.vim.view',
+        ContainerView=managed_type('ContainerView', Destroy=destroy)),
+    vm=namespace(
+        'pyVmomi.vim.vm',
+        RelocateSpec=data_type('RelocateSpec'),
+        ConfigSpec=data_type('ConfigSpec'),
+        CloneSpec=data_type('CloneSpec'),
+        InstantCloneSpec=data_type('InstantCloneSpec')),
+    host=namespace(
+        'pyVmomi.vim.host',
+        VmfsDatastoreInfo=data_type('VmfsDatastoreInfo'),
+        NasDatastoreInfo=data_type('NasDatastoreInfo')),
+    storageDrs=namespace(
+        'pyVmomi.vim.storageDrs',
+        StoragePlacementSpec=data_type('StoragePlacementSpec'),
+        PodSelectionSpec=data_type('PodSelectionSpec')),
+    fault=namespace(
+        'pyVmomi.vim.fault',
+        DuplicateName=fault_type('DuplicateName'),
+        NotAuthenticated=fault_type('NotAuthenticated')))
+
+# the generated inventory
+
+ROOT = {}
+
+def new_vm_properties(name, folder, pool, datastore, num_cpus, memory_mb,
+    annotation, template, power_state, host):
+    """Returns the properties of a new VM"""
+    uuid = '4200%04x-0000-0000-0000-%012d' % (len(INVENTORY.objects) % 65536,
+        len(INVENTORY.objects))
+    return {
+        'name': name,
+        'parent': folder,
+        'resourcePool': pool,
+        'datastore': [datastore],
+        'config': DataObject(
+            name=name,
+            uuid=uuid,
+            instanceUuid='5000' + uuid[4:],
+            annotation=annotation,
+            template=template,
+            hardware=DataObject(numCPU=num_cpus, memoryMB=memory_mb)),
+        'summary': DataObject(
+            config=DataObject(numCpu=num_cpus, memorySizeMB=memory_mb),
+            runtime=DataObject(powerState=power_state),
+            storage=DataObject(committed=40 * 1024 ** 3)),
+        'runtime': DataObject(host=host, powerState=power_state),
+        'guest': DataObject(
+            toolsVersionStatus2='guestToolsCurrent',
+            toolsRunningStatus=power_state == 'poweredOn' and
+                'guestToolsRunning' or 'guestToolsNotRunning',
+            guestFamily='linuxGuest')}
+
+def build_inventory(vms=1000, datastores=100, pools=50, folders=20, hosts=16):
+    """Creates the inventory of the fake vCenter, one datacenter with a
+    single cluster, and returns the root objects"""
+    INVENTORY.__init__()
+    PAGES.clear()
+    root = INVENTORY.add(vim.Folder, 'group-d', {'name': 'Datacenters'})
+    datacenter = INVENTORY.add(vim.Datacenter, 'datacenter',
+        {'name': 'Datacenter', 'parent': root})
+    vm_folder = INVENTORY.add(vim.Folder, 'group-v',
+        {'name': 'vm', 'parent': datacenter})
+    folder_objs = [INVENTORY.add(vim.Folder, 'group-v',
+        {'name': 'Folder%02d' % number, 'parent': vm_folder})
+        for number in range(folders)]
+    datastore_folder = INVENTORY.add(vim.Folder, 'group-s',
+        {'name': 'datastore', 'parent': datacenter})
+    datastore_objs = [INVENTORY.add(vim.Datastore, 'datastore', {
+        'name': 'DS%04d' % number,
+        'parent': datastore_folder,
+        'summary': DataObject(
+            freeSpace=(number % 10 + 1) * 100 * 1024 ** 3,
+            capacity=2 * 1024 ** 4,
+            accessible=True,
+            maintenanceMode='normal'),
+        'info': vim.host.VmfsDatastoreInfo(vmfs=DataObject(extent=[
+            DataObject(diskName='naa.60002ac00000000000000%03d%08x' %
+                (number % 4, number))]))})
+        for number in range(datastores)]
+    cluster = INVENTORY.add(vim.ClusterComputeResource, 'domain-c',
+        {'name': 'Cluster01', 'parent': datacenter})
+    host_objs = [INVENTORY.add(vim.HostSystem, 'host',
+        {'name': 'esx%02d' % number, 'parent': cluster})
+        for number in range(hosts)]
+    root_pool = INVENTORY.add(vim.ResourcePool, 'resgroup',
+        {'name': 'Resources', 'parent': cluster, 'owner': cluster,
+        'resourcePool': []})
+    INVENTORY.properties[cluster._moId]['resourcePool'] = root_pool
+    INVENTORY.properties[cluster._moId]['host'] = host_objs
+    pool_objs = [INVENTORY.add(vim.ResourcePool, 'resgroup',
+        {'name': 'Pool%03d' % number, 'parent': root_pool, 'owner': cluster,
+        'resourcePool': []})
+        for number in range(pools)]
+    INVENTORY.properties[root_pool._moId]['resourcePool'] = pool_objs
+
+    template = INVENTORY.add(vim.VirtualMachine, 'vm', new_vm_properties(
+        'Template01', folder_objs[0], root_pool, datastore_objs[0], 2, 4096,
+        '', True, 'poweredOff', host_objs[0]))
+    for number in range(vms):
+        vm = INVENTORY.add(vim.VirtualMachine, 'vm', new_vm_properties(
+            'vm%05d' % number,
+            folder_objs[number % folders],
+            pool_objs[number % pools],
+            datastore_objs[number % datastores],
+            2,
+            4096,
+            '',
+            False,
+            number % 2 and 'poweredOff' or 'poweredOn',
+            host_objs[number % hosts]))
+        # every seventh VM has outdated tools
+        if number % 7 == 3:
+            INVENTORY.properties[vm._moId]['guest'].toolsVersionStatus2 = \
+                'guestToolsNeedUpgrade'
+
+    content = DataObject(
+        rootFolder=root,
+        propertyCollector=PropertyCollector('propertyCollector'),
+        viewManager=vim.ViewManager('ViewManager'),
+        searchIndex=vim.SearchIndex('SearchIndex'),
+        about=DataObject(apiVersion='6.7', fullName='Fake vCenter'),
+        sessionManager=DataObject(currentSession=DataObject(key='session')),
+        storageResourceManager=DataObject())
+    service_instance = vim.ServiceInstance('ServiceInstance')
+    INVENTORY.objects['ServiceInstance'] = service_instance
+    INVENTORY.properties['ServiceInstance'] = {'content': content}
+    ROOT.update({
+        'folder': root,
+        'content': content,
+        'template': template,
+        'cluster': cluster,
+        'pools': pool_objs,
+        'datastores': datastore_objs})
+    return ROOT
+
+# pyVim and ansible
+
+class Stub(object):
+    """The SOAP stub adapter of a connection"""
+    def __init__(self, host=None, port=443, version='vim.version.version12',
+        sslContext=None, **kwargs):
+        self.host = host
+        self.port = port
+        self.version = version
+        self.cookie = ''
+        self.connection = None
+
+    def GetConnection(self):
+        if self.connection is None:
+            self.connection = Connection()
+        return self.connection
+
+    def ReturnConnection(self, conn):
+        pass
+
+    def InvokeMethod(self, mo, info, args, outerStub=None):
+        conn = self.GetConnection()
+        conn.response_bytes = info.response_bytes
+        conn.request('POST', '/sdk', ' ' * info.request_bytes, {})
+        conn.getresponse().read()
+        self.ReturnConnection(conn)
+
+class Response(object):
+    """The HTTP response to a SOAP request"""
+    def __init__(self, size):
+        self.data = ' ' * size
+
+    def read(self, *args):
+        data, self.data = self.data, ''
+        return data
+
+class Connection(object):
+    """The HTTP connection of a stub adapter"""
+    def request(self, method, url, body=None, headers={}):
+        pass
+
+    def getresponse(self):
+        return Response(self.response_bytes)
+
+def smart_connect(host=None, user=None, pwd=None, port=443, sslContext=None,
+    **kwargs):
+    """Logs in and returns the service instance"""
+    STATS.record('RetrieveServiceContent')
+    STATS.record('Login', user)
+    stub = Stub(host, port)
+    stub.cookie = 'vmware_soap_session="fake"'
+    return vim.ServiceInstance('ServiceInstance', stub)
+
+def disconnect(service_instance):
+    """Logs out, failing pending waits for updates"""
+    LOGGED_OUT.set()
+    STATS.record('Logout')
+
+class ModuleExit(Exception):
+    """Raised by exit_json and fail_json to end a module run"""
+    def __init__(self, result):
+        Exception.__init__(self, result.get('msg', ''))
+        self.result = result
+
+STUB = Stub()
+
+# parameters of the next module run, set by the benchmark harness
+MODULE_PARAMS = {}
+
+class AnsibleModule(object):
+    """Applies the argument spec to MODULE_PARAMS like ansible does"""
+    def __init__(self, argument_spec, supports_check_mode=False,
+        mutually_exclusive=None, required_one_of=None, **kwargs):
+        self.check_mode = MODULE_PARAMS.get('_ansible_check_mode', False)
+        self.params = {}
+        for name, spec in argument_spec.items():
+            value = MODULE_PARAMS.get(name, spec.get('default'))
+            for alias in spec.get('aliases', []):
+                value = MODULE_PARAMS.get(alias, value)
+            if spec.get('required') and value is None:
+                self.fail_json(msg='missing required arguments: %s' % name)
+            if value is not None:
+                value = self.convert(value, spec.get('type', 'str'))
+            self.params[name] = value
+        for names in required_one_of or []:
+            if not [name for name in names if self.params.get(name)]:
+                self.fail_json(msg='one of the following is required: %s' %
+                    ','.join(names))
+        for names in mutually_exclusive or []:
+            if len([name for name in names if self.params.get(name)]) > 1:
+                self.fail_json(msg='parameters are mutually exclusive: %s' %
+                    ','.join(names))
+
+    def convert(self, value, kind):
+        if kind == 'int':
+            return int(value)
+        if kind == 'bool':
+            return self.boolean(value)
+        if kind == 'list' and not isinstance(value, list):
+            return str(value).split(',')
+        return value
+
+    def boolean(self, value):
+        if isinstance(value, bool):
+            return value
+        return str(value).lower() in ['yes', 'on', '1', 'true']
+
+    def exit_json(self, **kwargs):
+        kwargs.setdefault('changed', False)
+        raise ModuleExit(kwargs)
+
+    def fail_json(self, **kwargs):
+        kwargs['failed'] = True
+        raise ModuleExit(kwargs)
+
+class FakeImporter(object):
+    """Serves the fake modules on import, so the modules of this repository
+    can be checked for the packages they load, and records their names"""
+    def __init__(self, modules):
+        self.modules = modules
+        self.imported = []
+
+    def find_module(self, name, path=None):
+        if name in self.modules:
+            return self
+        return None
+
+    def load_module(self, name):
+        if name not in sys.modules:
+            self.imported.append(name)
+            sys.modules[name] = self.modules[name]
+        return sys.modules[name]
+
+IMPORTER = FakeImporter({})
+
+def install():
+    """Installs the fake pyVmomi, pyVim and ansible modules
+
+    The ansible modules are loaded right away, the others only once they
+    are imported, see IMPORTER."""
+    pyvmomi = namespace('pyVmomi', vim=vim, vmodl=vmodl)
+    pyvmomi.SoapAdapter = namespace('pyVmomi.SoapAdapter',
+        SoapStubAdapter=Stub)
+    pyvim = namespace('pyVim')
+    # packages need a path for their submodules to be imported
+    pyvmomi.__path__ = pyvim.__path__ = []
+    modules = {
+        'pyVmomi': pyvmomi,
+        'pyVmomi.SoapAdapter': pyvmomi.SoapAdapter,
+        'pyVim': pyvim,
+        'pyVim.connect': namespace('pyVim.connect',
+            SmartConnect=smart_connect, Disconnect=disconnect)}
+    try:
+        import requests
+    except ImportError:
+        modules['requests'] = namespace('requests', packages=namespace(
+            'requests.packages', urllib3=namespace(
+                'requests.packages.urllib3',
+                disable_warnings=lambda: None)))
+    IMPORTER.modules.update(modules)
+    if IMPORTER not in sys.meta_path:
+        sys.meta_path.insert(0, IMPORTER)
+    sys.modules.update({
+        'ansible': namespace('ansible'),
+        'ansible.module_utils': namespace('ansible.module_utils'),
+        'ansible.module_utils.basic': namespace('ansible.module_utils.basic',
+            AnsibleModule=AnsibleModule)})
@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Offline benchmark of the vSphere modules against a fake vCenter
+#
+# Every scenario runs one module in a fresh process against a generated
+# inventory and reports the SOAP round trips, the estimated bytes on the wire,
+# the wall time, the startup time until the first request, whether pyVmomi
+# was loaded and the peak RSS. Round trips and bytes are deterministic and
+# are compared to the recorded baseline, failing on regressions. Scenarios
+# with invalid arguments must fail without loading pyVmomi. It also fails if
+# the helpers copied into the modules differ from common/vsphere_common.py.
+#
+# (c) 2016, Simon Rupf <simon@rupf.net>
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+import atexit, json, optparse, os, resource, shutil, subprocess, sys, \
+    tempfile, time
+
+# heavy packages the modules should only import once they need them
+IMPORT_TIMES = ['pyVmomi', 'requests', 'ssl']
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+BASELINE = os.path.join(BENCH_DIR, 'baseline.json')
+
+CONNECTION = {
+    'vcenter_hostname': 'vcenter.example.com',
+    'username': 'ansible',
+    'password': 'secret'}
+
+# the settings vm00001 is created with by fake_vcenter.build_inventory
+VM00001 = {
+    'guest': 'vm00001',
+    'template_src': 'Template01',
+    'datastore': 'DS0001',
+    'folder': 'Folder01',
+    'resource_pool': 'Pool001',
+    'num_cpus': 2,
+    'memory_mb': 4096,
+    'notes': ''}
+
+CACHED = {
+    'session_cache': True,
+    'inventory_cache': True}
+
+def scenario(module, params, warm_up=False, invalid=False, broker=False):
+    """Returns a scenario running the module with the given parameters,
+    invalid ones are expected to fail, with a broker the module is passed its
+    socket"""
+    merged = dict(CONNECTION)
+    merged.update(params)
+    return {
+        'module': module,
+        'params': merged,
+        'warm_up': warm_up,
+        'invalid': invalid,
+        'broker': broker}
+
+SCENARIOS = {
+    'create': scenario('vsphere_template.py', {
+        'guest': 'bench-new',
+        'template_src': 'Template01',
+        'datastore': 'DS0002',
+        'folder': 'Folder02',
+        'resource_pool': 'Pool002'}),
+    'create_batch': scenario('vsphere_template.py', {
+        'guests': ['bench-%02d' % number for number in range(20)],
+        'template_src': 'Template01',
+        'datastore': 'DS0002',
+        'folder': 'Folder02',
+        'resource_pool': 'Pool002'}),
+    'create_batch_nowait': scenario('vsphere_template.py', {
+        'guests': ['bench-%02d' % number for number in range(20)],
+        'template_src': 'Template01',
+        'datastore': 'DS0002',
+        'folder': 'Folder02',
+        'resource_pool': 'Pool002',
+        'wait': False}),
+    'noop_change': scenario('vsphere_template.py', VM00001),
+    'noop_change_cached': scenario(
+        'vsphere_template.py', dict(VM00001, **CACHED), warm_up=True),
+    'noop_change_broker': scenario(
+        'vsphere_template.py', VM00001, warm_up=True, broker=True),
+    'reconfigure': scenario(
+        'vsphere_template.py', dict(VM00001, num_cpus=4, memory_mb=8192)),
+    'tools_check': scenario('vsphere_tools.py', {
+        'guest': 'vm00002',
+        'state': 'present'}),
+    'tools_check_broker': scenario('vsphere_tools.py', {
+        'guest': 'vm00002',
+        'state': 'present'}, warm_up=True, broker=True),
+    'tools_invalid': scenario('vsphere_tools.py', {
+        'guest': 'vm00002',
+        'state': 'installed'}, invalid=True),
+    'template_invalid': scenario('vsphere_template.py', dict(
+        VM00001, max_concurrent_clones=0), invalid=True),
+    'tools_report': scenario('vsphere_tools.py', {
+        'guests': ['vm00*'],
+        'state': 'report'}),
+    'tools_report_pool': scenario('vsphere_tools.py', {
+        'resource_pool': 'Pool010',
+        'state': 'report'}),
+    'tools_rolling': scenario('vsphere_tools.py', {
+        'guests': ['vm00*'],
+        'state': 'latest'}),
+    'pool_migrate': scenario('vsphere_migrate_pool.py', {
+        'guest': 'vm00003',
+        'cluster': 'Cluster01',
+        'resource_pool': 'Pool010'}),
+    'pool_migrate_cached': scenario('vsphere_migrate_pool.py', dict(
+        CACHED,
+        guest='vm00003',
+        cluster='Cluster01',
+        resource_pool='/Resources/Pool010'), warm_up=True),
+    'pool_migrate_broker': scenario('vsphere_migrate_pool.py', {
+        'guest': 'vm00003',
+        'cluster': 'Cluster01',
+        'resource_pool': 'Pool010'}, warm_up=True, broker=True),
+    'pool_migrate_bulk': scenario('vsphere_migrate_pool.py', {
+        'guests': ['vm000*'],
+        'cluster': 'Cluster01',
+        'resource_pool': 'Pool010'})}
+
+def run_module(path, params):
+    """Runs a module as ansible would and returns its result dict"""
+    import fake_vcenter
+    fake_vcenter.MODULE_PARAMS.clear()
+    fake_vcenter.MODULE_PARAMS.update(params)
+    handlers = []
+    register = atexit.register
+    atexit.register = lambda func, *args, **kwargs: handlers.append(
+        (func, args, kwargs))
+    try:
+        code = compile(open(path).read(), path, 'exec')
+        try:
+            exec(code, {'__name__': '__main__', '__file__': path})
+            result = {'failed': True, 'msg': 'module did not exit'}
+        except fake_vcenter.ModuleExit as error:
+            result = error.result
+    finally:
+        atexit.register = register
+        for func, args, kwargs in reversed(handlers):
+            func(*args, **kwargs)
+    return result
+
+def run_scenario(name, options):
+    """Runs a single scenario in this process and returns its measurements"""
+    sys.dont_write_bytecode = True
+    sys.path.insert(0, BENCH_DIR)
+    import fake_vcenter
+    fake_vcenter.install()
+    fake_vcenter.build_inventory(
+        vms=options.vms,
+        datastores=options.datastores,
+        pools=options.pools)
+
+    spec = SCENARIOS[name]
+    path = os.path.join(REPO_DIR, spec['module'])
+    cache_dir = tempfile.mkdtemp(prefix='vsphere_bench')
+    params = dict(spec['params'], cache_dir=cache_dir)
+    broker = None
+    if spec['broker']:
+        broker = start_broker(cache_dir)
+        params['broker_socket'] = broker.server_address
+    try:
+        if spec['warm_up']:
+            run_module(path, params)
+        stats = fake_vcenter.STATS
+        stats.__init__()
+        start = time.time()
+        result = run_module(path, params)
+        wall = time.time() - start
+        # the calls made while stopping the broker aren't measured
+        fake_vcenter.STATS = fake_vcenter.Stats()
+    finally:
+        if broker is not None:
+            stop_broker(broker)
+        shutil.rmtree(cache_dir)
+
+    startup = wall
+    if stats.first_request is not None:
+        startup = stats.first_request - start
+    return {
+        'round_trips': stats.round_trips,
+        'bytes': stats.bytes_sent + stats.bytes_received,
+        'calls': stats.calls,
+        'wall': round(wall, 3),
+        'startup': round(startup, 3),
+        'pyvmomi': 'pyVmomi' in fake_vcenter.IMPORTER.imported,
+        'rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'changed': result.get('changed', False),
+        'failed': result.get('failed', False),
+        'msg': result.get('msg')}
+
+def start_broker(cache_dir):
+    """Starts a vsphere_broker serving the fake vCenter in a thread and
+    returns it"""
+    import threading
+    sys.path.insert(0, REPO_DIR)
+    import vsphere_broker
+    path = os.path.join(cache_dir, 'broker.sock')
+    broker = vsphere_broker.Broker(path, 0)
+    thread = threading.Thread(target=broker.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return broker
+
+def stop_broker(broker):
+    """Stops the broker and waits for its threads, which end as it logs
+    out"""
+    import threading
+    broker.shutdown()
+    broker.server_close()
+    broker.close()
+    for thread in threading.enumerate():
+        if thread is not threading.current_thread():
+            thread.join(1)
+
+def measure(name, options):
+    """Runs a scenario in a new process, so the peak RSS is its own"""
+    command = [sys.executable, os.path.abspath(__file__),
+        '--run-scenario', name,
+        '--vms', str(options.vms),
+        '--datastores', str(options.datastores),
+        '--pools', str(options.pools)]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    output = process.communicate()[0]
+    if process.returncode:
+        raise SystemExit('scenario %s crashed' % name)
+    return json.loads(output.decode('utf-8'))
+
+def import_times():
+    """Returns the seconds it takes a new interpreter to import each of the
+    heavy packages, or None if it isn't installed"""
+    def run(statement):
+        start = time.time()
+        returncode = subprocess.call([sys.executable, '-c', statement],
+            stderr=open(os.devnull, 'w'))
+        return returncode, time.time() - start
+    _, empty = run('pass')
+    times = {}
+    for name in IMPORT_TIMES:
+        returncode, seconds = run('import %s' % name)
+        times[name] = not returncode and max(seconds - empty, 0) or None
+    return times
+
+def size_key(options):
+    """Returns the baseline key of the inventory size"""
+    return '%d/%d/%d' % (options.vms, options.datastores, options.pools)
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--vms', type='int', default=1000,
+        help='number of VMs in the inventory [default: %default]')
+    parser.add_option('--datastores', type='int', default=100,
+        help='number of datastores in the inventory [default: %default]')
+    parser.add_option('--pools', type='int', default=50,
+        help='number of resource pools in the inventory [default: %default]')
+    parser.add_option('--scenario', action='append', dest='scenarios',
+        choices=sorted(SCENARIOS.keys()),
+        help='scenario to run, may be repeated [default: all]')
+    parser.add_option('--baseline', default=BASELINE,
+        help='baseline file to compare with [default: %default]')
+    parser.add_option('--update-baseline', action='store_true', default=False,
+        help='record the results as the new baseline')
+    parser.add_option('--tolerance', type='float', default=0.05,
+        help='allowed relative increase of round trips and bytes '
+        '[default: %default]')
+    parser.add_option('--verbose', action='store_true', default=False,
+        help='show the calls made per SOAP method')
+    parser.add_option('--import-times', action='store_true', default=False,
+        help='show the time it takes to import the heavy packages, which '
+        'invalid scenarios save')
+    parser.add_option('--run-scenario', help=optparse.SUPPRESS_HELP)
+    options, _ = parser.parse_args()
+
+    if options.run_scenario:
+        sys.stdout.write(json.dumps(run_scenario(options.run_scenario, options)))
+        return
+
+    if options.import_times:
+        for name, seconds in sorted(import_times().items()):
+            if seconds is None:
+                print('%-20s not installed' % name)
+            else:
+                print('%-20s %9.3f s' % (name, seconds))
+        return
+
+    baselines = {}
+    if os.path.exists(options.baseline):
+        baselines = json.load(open(options.baseline))
+    baseline = baselines.get(size_key(options), {})
+
+    # the modules are only measured with the current shared helpers
+    sys.path.insert(0, os.path.join(REPO_DIR, 'common'))
+    import update_modules
+    regressions = ['%s differs from common/vsphere_common.py' % name
+        for name in update_modules.outdated()]
+    results = {}
+    print('%-20s %8s %12s %9s %11s %7s %9s  %s' %
+        ('scenario', 'trips', 'bytes', 'wall (s)', 'startup (s)', 'pyVmomi',
+        'rss (kB)', 'result'))
+    for name in options.scenarios or sorted(SCENARIOS.keys()):
+        measured = measure(name, options)
+        results[name] = {
+            'round_trips': measured['round_trips'],
+            'bytes': measured['bytes']}
+        outcome = measured['failed'] and 'failed: %s' % measured['msg'] or \
+            measured['changed'] and 'changed' or 'ok'
+        print('%-20s %8d %12d %9.3f %11.3f %7s %9d  %s' % (name,
+            measured['round_trips'], measured['bytes'], measured['wall'],
+            measured['startup'], measured['pyvmomi'] and 'loaded' or '-',
+            measured['rss_kb'], outcome))
+        if options.verbose:
+            for method, count in sorted(measured['calls'].items()):
+                print('    %-32s %6d' % (method, count))
+        if SCENARIOS[name]['invalid']:
+            if not measured['failed']:
+                regressions.append('%s did not fail' % name)
+            if measured['pyvmomi']:
+                regressions.append('%s loaded pyVmomi' % name)
+        elif measured['failed']:
+            regressions.append('%s failed' % name)
+        for key in ['round_trips', 'bytes']:
+            expected = baseline.get(name, {}).get(key)
+            if expected is not None and \
+                measured[key] > expected * (1 + options.tolerance):
+                regressions.append('%s: %s increased from %d to %d' %
+                    (name, key, expected, measured[key]))
+
+    if options.update_baseline:
+        baselines.setdefault(size_key(options), {}).update(results)
+        out = open(options.baseline, 'w')
+        json.dump(baselines, out, indent=2, sort_keys=True,
+            separators=(',', ': '))
+        out.write('\n')
+        out.close()
+        print('baseline for %s updated' % size_key(options))
+    elif regressions:
+        for regression in regressions:
+            print('REGRESSION %s' % regression)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
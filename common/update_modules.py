@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copies the shared helpers of common/vsphere_common.py into the modules
+#
+# The part of vsphere_common.py between its BEGIN and END lines replaces the
+# same part of each module. With --check, nothing is written and the script
+# fails if a module differs, i.e. because it was edited instead of
+# vsphere_common.py.
+#
+# (c) 2016, Simon Rupf <simon@rupf.net>
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+import optparse, os, sys
+
+COMMON_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(COMMON_DIR)
+COMMON = os.path.join(COMMON_DIR, 'vsphere_common.py')
+
+# the modules the helpers are copied into
+MODULES = ['vsphere_migrate_pool.py', 'vsphere_task_status.py',
+    'vsphere_template.py', 'vsphere_tools.py']
+
+BEGIN = '# BEGIN vsphere_common\n'
+END = '# END vsphere_common\n'
+
+def split(path):
+    """Returns the text of a file before, within and after the shared part,
+    which starts with the BEGIN line and ends with the END line"""
+    text = open(path).read()
+    start = text.find(BEGIN)
+    end = text.find(END, start)
+    if start < 0 or end < 0:
+        raise SystemExit('%s has no %s part' % (path, BEGIN.strip()))
+    end += len(END)
+    return text[:start], text[start:end], text[end:]
+
+def outdated():
+    """Returns the names of the modules whose shared part differs"""
+    shared = split(COMMON)[1]
+    return [name for name in MODULES
+        if split(os.path.join(REPO_DIR, name))[1] != shared]
+
+def update():
+    """Replaces the shared part of the modules and returns the names of those
+    which changed"""
+    shared = split(COMMON)[1]
+    changed = []
+    for name in MODULES:
+        path = os.path.join(REPO_DIR, name)
+        before, current, after = split(path)
+        if current == shared:
+            continue
+        out = open(path, 'w')
+        try:
+            out.write(before + shared + after)
+        finally:
+            out.close()
+        changed.append(name)
+    return changed
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [--check]')
+    parser.add_option('--check', action='store_true', default=False,
+        help='fail if a module differs instead of updating it')
+    options, _ = parser.parse_args()
+
+    if options.check:
+        names = outdated()
+        for name in names:
+            print('%s differs from common/vsphere_common.py' % name)
+        if names:
+            sys.exit(1)
+        return
+
+    for name in update():
+        print('%s updated' % name)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,570 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Connection broker shared by the vSphere modules
+#
+# A long lived process on the ansible control node, listening on a Unix
+# socket. It keeps an authenticated session per vCenter server and user, an
+# inventory index of the names of the objects the modules look up, kept fresh
+# by waiting for updates of the vCenter server, and waits for tasks on behalf
+# of the modules. The modules use it if their broker_socket option is set and
+# fall back to connecting directly if it isn't running.
+#
+# Like the modules, it requires Python 2. Start it before the play, i.e.:
+#
+#   nohup python2 vsphere_broker.py --socket ~/.ansible/vsphere_cache/broker.sock &
+#
+# The protocol is a JSON object per line in both directions. Every request
+# holds the connection options of the module (vcenter_hostname, port,
+# username, password and certificate_check) and an op:
+#
+#   session     returns the cookie and version of the session
+#   find        resolves the names of objects per vimtype, see Session.find
+#   properties  returns the properties of objects by name, see
+#               Session.properties
+#   wait_tasks  waits for tasks to complete, see Session.wait_tasks
+#   status      returns the number of sessions and requests served
+#
+# The response holds either the result or an error message.
+#
+# (c) 2016, Simon Rupf <simon@rupf.net>
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+if sys.version_info[0] != 2:
+    sys.exit('vsphere_broker requires Python 2')
+
+from pyVmomi import vim, vmodl
+from pyVim.connect import SmartConnect, Disconnect
+import hashlib, json, optparse, os, signal, socket, SocketServer, ssl, \
+    threading, time
+
+# vimtypes whose names are kept in the inventory index
+INDEX_TYPES = [vim.VirtualMachine, vim.Datastore, vim.StoragePod, vim.Folder,
+    vim.ResourcePool, vim.ClusterComputeResource, vim.HostSystem,
+    vim.Datacenter]
+
+# the number of seconds a single WaitForUpdatesEx call may block
+MAX_WAIT_SECONDS = 60
+
+# the number of seconds a request waits for the initial inventory index
+INDEX_TIMEOUT = 300
+
+class Session(object):
+    """An authenticated session on a vCenter server with the inventory index
+    of its objects, kept fresh by a thread waiting for updates"""
+    def __init__(self, request):
+        self.salt = os.urandom(16)
+        self.digest = self.password_digest(request['password'])
+        self.username = request['username']
+        self.connection = login(request)
+        self.content = self.connection.RetrieveContent()
+        self.stub = self.connection._stub
+        self.lock = threading.Lock()
+        self.names = dict((vimtype._wsdlName, {}) for vimtype in INDEX_TYPES)
+        self.objects = {}
+        # the moIds of the objects per (vimtype name, name) pair
+        self.holders = {}
+        # (vimtype name, name) pairs a sweep confirmed to be missing
+        self.misses = set()
+        self.indexed = threading.Event()
+        self.failed = None
+        thread = threading.Thread(target=self.follow_inventory)
+        thread.daemon = True
+        thread.start()
+
+    def password_digest(self, password):
+        """Returns the salted digest of a password"""
+        return hashlib.sha256(self.salt + password.encode('utf-8')).hexdigest()
+
+    def authenticate(self, request):
+        """Returns True if the request was sent with the password of the
+        session"""
+        return self.password_digest(request['password']) == self.digest
+
+    def follow_inventory(self):
+        """Builds the inventory index and applies the updates of the vCenter
+        server to it until the session fails"""
+        try:
+            collector = self.content.propertyCollector.CreatePropertyCollector()
+            view = self.content.viewManager.CreateContainerView(
+                self.content.rootFolder, INDEX_TYPES, True)
+            traversal_spec = vmodl.query.PropertyCollector.TraversalSpec(
+                name='traverseView',
+                path='view',
+                skip=False,
+                type=vim.view.ContainerView)
+            object_spec = vmodl.query.PropertyCollector.ObjectSpec(
+                obj=view,
+                skip=True,
+                selectSet=[traversal_spec])
+            property_specs = [
+                vmodl.query.PropertyCollector.PropertySpec(
+                    type=vimtype,
+                    pathSet=['name'])
+                for vimtype in INDEX_TYPES]
+            collector.CreateFilter(vmodl.query.PropertyCollector.FilterSpec(
+                objectSet=[object_spec],
+                propSet=property_specs), True)
+            version = ''
+            while True:
+                update = collector.WaitForUpdatesEx(
+                    version,
+                    vmodl.query.PropertyCollector.WaitOptions(
+                        maxWaitSeconds=MAX_WAIT_SECONDS))
+                if update is not None:
+                    version = update.version
+                    self.apply_update(update)
+                self.indexed.set()
+        except Exception as error:
+            self.failed = str(error) or error.__class__.__name__
+            self.indexed.set()
+
+    def apply_update(self, update):
+        """Applies the changes of the names of objects to the index"""
+        with self.lock:
+            for filter_set in update.filterSet:
+                for object_set in filter_set.objectSet:
+                    obj = object_set.obj
+                    previous = self.remove_object(obj._moId)
+                    if object_set.kind == 'leave':
+                        continue
+                    name = previous and previous[1]
+                    for change in object_set.changeSet:
+                        if change.name == 'name':
+                            name = change.val
+                    # subtypes which aren't indexed themselves, like vApps,
+                    # are left out, as the modules don't find them either
+                    if name is None or type(obj) not in INDEX_TYPES:
+                        continue
+                    self.add_object(obj._moId, (type(obj)._wsdlName, name))
+
+    def add_object(self, moid, key):
+        """Adds an object to the index under its (vimtype name, name) pair,
+        the lock must be held"""
+        self.objects[moid] = key
+        self.holders.setdefault(key, set()).add(moid)
+        self.names[key[0]].setdefault(key[1], moid)
+        self.misses.discard(key)
+
+    def remove_object(self, moid):
+        """Removes an object from the index and returns its (vimtype name,
+        name) pair, if it was indexed, another object of the same name takes
+        its place, the lock must be held"""
+        key = self.objects.pop(moid, None)
+        if key is None:
+            return None
+        holders = self.holders[key]
+        holders.discard(moid)
+        names = self.names[key[0]]
+        if names.get(key[1]) == moid:
+            if holders:
+                names[key[1]] = next(iter(holders))
+            else:
+                del names[key[1]]
+        if not holders:
+            del self.holders[key]
+        return key
+
+    def check(self):
+        """Waits for the initial inventory index and raises an error if the
+        session has failed"""
+        self.indexed.wait(INDEX_TIMEOUT)
+        if self.failed:
+            raise RuntimeError('session failed: %s' % self.failed)
+        if not self.indexed.is_set():
+            raise RuntimeError('timed out building the inventory index')
+
+    def session(self, request):
+        """Returns the cookie and version of the session"""
+        return {
+            'username': self.username,
+            'cookie': self.stub.cookie,
+            'version': self.stub.version}
+
+    def find(self, request):
+        """Returns a dict mapping the vimtype names in the wanted dict of the
+        request to dicts of the names found and the moIds of their objects
+
+        The index is kept up to date as the vCenter server reports changes,
+        so the moIds are not verified like those of the cache file. Names
+        missing from it are swept for once, as an object may have been
+        created before its update was applied, until they show up or tasks
+        complete."""
+        wanted = request['wanted']
+        for wsdl_name in wanted:
+            if wsdl_name not in self.names:
+                raise ValueError('%s is not indexed' % wsdl_name)
+        found, missing = self.lookup(wanted)
+        with self.lock:
+            unconfirmed = set(
+                wsdl_name for wsdl_name, name in missing
+                if (wsdl_name, name) not in self.misses)
+        if unconfirmed:
+            self.sweep(list(unconfirmed))
+            found, missing = self.lookup(wanted)
+            with self.lock:
+                self.misses.update(missing)
+        return found
+
+    def lookup(self, wanted):
+        """Returns the names of the wanted dict found in the index and the
+        (vimtype name, name) pairs of those which are not"""
+        found = {}
+        missing = []
+        with self.lock:
+            for wsdl_name, names in wanted.items():
+                index = self.names[wsdl_name]
+                found[wsdl_name] = {}
+                for name in names:
+                    if name in index:
+                        found[wsdl_name][name] = index[name]
+                    else:
+                        missing.append((wsdl_name, name))
+        return found, missing
+
+    def sweep(self, wsdl_names):
+        """Adds the names of all objects of the given vimtypes to the index,
+        leaving the removal of objects to the updates"""
+        vimtypes = [getattr(vim, wsdl_name) for wsdl_name in wsdl_names]
+        view = self.content.viewManager.CreateContainerView(
+            self.content.rootFolder, vimtypes, True)
+        try:
+            collector = self.content.propertyCollector
+            result = collector.RetrievePropertiesEx(
+                specSet=[vmodl.query.PropertyCollector.FilterSpec(
+                    objectSet=[vmodl.query.PropertyCollector.ObjectSpec(
+                        obj=view,
+                        skip=True,
+                        selectSet=[vmodl.query.PropertyCollector.TraversalSpec(
+                            name='traverseView',
+                            path='view',
+                            skip=False,
+                            type=vim.view.ContainerView)])],
+                    propSet=[vmodl.query.PropertyCollector.PropertySpec(
+                        type=vimtype,
+                        pathSet=['name'])
+                        for vimtype in vimtypes])],
+                options=vmodl.query.PropertyCollector.RetrieveOptions())
+            while result:
+                with self.lock:
+                    for obj_content in result.objects:
+                        if type(obj_content.obj) not in vimtypes:
+                            continue
+                        if obj_content.obj._moId in self.objects:
+                            continue
+                        self.add_object(obj_content.obj._moId, (
+                            type(obj_content.obj)._wsdlName,
+                            obj_content.propSet[0].val))
+                if not result.token:
+                    break
+                result = collector.ContinueRetrievePropertiesEx(
+                    token=result.token)
+        finally:
+            view.Destroy()
+
+    def properties(self, request):
+        """Returns a dict mapping the names of the objects of the vimtype in
+        the request to their properties, retrieved in a single call
+
+        Only simple values and references to managed objects, as dicts of
+        their type and moId, are returned, other values are left out."""
+        vimtype = getattr(vim, request['type'])
+        found = self.find({'wanted': {request['type']: request['names']}})
+        objs = dict(
+            (moid, name) for name, moid in found[request['type']].items())
+        if not objs:
+            return {}
+        collector = self.content.propertyCollector
+        result = collector.RetrievePropertiesEx(
+            specSet=[vmodl.query.PropertyCollector.FilterSpec(
+                objectSet=[
+                    vmodl.query.PropertyCollector.ObjectSpec(
+                        obj=vimtype(moid, self.stub))
+                    for moid in objs],
+                propSet=[vmodl.query.PropertyCollector.PropertySpec(
+                    type=vimtype,
+                    pathSet=request['paths'])])],
+            options=vmodl.query.PropertyCollector.RetrieveOptions())
+        properties = {}
+        while result:
+            for obj_content in result.objects:
+                values = {}
+                for prop in obj_content.propSet:
+                    value = json_value(prop.val)
+                    if value is not None:
+                        values[prop.name] = value
+                properties[objs[obj_content.obj._moId]] = values
+            if not result.token:
+                break
+            result = collector.ContinueRetrievePropertiesEx(token=result.token)
+        return properties
+
+    def wait_tasks(self, request):
+        """Waits for the tasks in the request to complete and returns their
+        state information
+
+        Like wait_for_tasks of the modules, this blocks in WaitForUpdatesEx
+        until their state changes, returning once all of them or, if first
+        is set, at least one of them completed or the timeout elapsed."""
+        tasks = [vim.Task(moid, self.stub) for moid in request['tasks']]
+        timeout = request.get('timeout') or 0
+        collector = self.content.propertyCollector.CreatePropertyCollector()
+        try:
+            collector.CreateFilter(vmodl.query.PropertyCollector.FilterSpec(
+                objectSet=[
+                    vmodl.query.PropertyCollector.ObjectSpec(obj=task)
+                    for task in tasks],
+                propSet=[vmodl.query.PropertyCollector.PropertySpec(
+                    type=vim.Task,
+                    pathSet=['info.state', 'info.progress', 'info.result',
+                        'info.error'])]), True)
+            start = time.time()
+            infos = dict(
+                (task._moId, {
+                    'task': task._moId,
+                    'state': None,
+                    'progress': None,
+                    'result': None,
+                    'error': None,
+                    'duration': None})
+                for task in tasks)
+            done = {}
+            version = ''
+            while len(done) < len(tasks) and \
+                not (request.get('first') and done):
+                max_wait = MAX_WAIT_SECONDS
+                if timeout:
+                    remaining = timeout - (time.time() - start)
+                    if remaining <= 0:
+                        return {'done': done, 'infos': infos, 'timed_out': True}
+                    max_wait = int(min(max_wait, max(remaining, 1)))
+                update = collector.WaitForUpdatesEx(
+                    version,
+                    vmodl.query.PropertyCollector.WaitOptions(
+                        maxWaitSeconds=max_wait))
+                if update is None:
+                    continue
+                version = update.version
+                for filter_set in update.filterSet:
+                    for object_set in filter_set.objectSet:
+                        info = infos[object_set.obj._moId]
+                        for change in object_set.changeSet:
+                            key = change.name.split('.', 1)[1]
+                            if key == 'error':
+                                info[key] = fault_value(change.val)
+                            else:
+                                info[key] = json_value(change.val)
+                        if info['state'] in ['success', 'error'] and \
+                            info['task'] not in done:
+                            info['duration'] = round(time.time() - start, 3)
+                            done[info['task']] = info
+                            # completed tasks may have created missing objects
+                            with self.lock:
+                                self.misses.clear()
+            return {'done': done, 'infos': infos, 'timed_out': False}
+        finally:
+            collector.Destroy()
+
+    def close(self):
+        """Logs out of the vCenter server"""
+        try:
+            Disconnect(self.connection)
+        except Exception:
+            pass
+
+class Broker(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """Serves the requests of the modules, one thread per connection"""
+    daemon_threads = True
+
+    def __init__(self, path, idle_timeout):
+        self.sessions = {}
+        self.lock = threading.Lock()
+        # one lock per session key, held while logging in
+        self.login_locks = {}
+        self.started = time.time()
+        self.last_request = time.time()
+        self.requests = 0
+        # the number of requests being answered
+        self.active = 0
+        self.idle_timeout = idle_timeout
+        SocketServer.UnixStreamServer.__init__(self, path, RequestHandler)
+
+    def session(self, request):
+        """Returns the session of the vCenter server and user of a request,
+        logging in if there is none or the previous one failed
+
+        Requests for the same session wait for a single login, those of
+        other sessions go on, as the broker wide lock isn't held meanwhile."""
+        key = '%s:%s:%s' % (request['vcenter_hostname'],
+            request.get('port', 443), request['username'])
+        with self.lock:
+            login_lock = self.login_locks.setdefault(key, threading.Lock())
+        with login_lock:
+            with self.lock:
+                session = self.sessions.get(key)
+            if session is not None and session.failed:
+                session.close()
+                session = None
+            if session is None:
+                session = Session(request)
+                with self.lock:
+                    self.sessions[key] = session
+        if not session.authenticate(request):
+            raise RuntimeError('authentication failed for user %s' %
+                request['username'])
+        session.check()
+        return session
+
+    def dispatch(self, request):
+        """Returns the result of a request"""
+        with self.lock:
+            self.active += 1
+            self.requests += 1
+            self.last_request = time.time()
+        try:
+            if request['op'] == 'status':
+                return {
+                    'sessions': len(self.sessions),
+                    'requests': self.requests,
+                    'uptime': round(time.time() - self.started, 3)}
+            if request['op'] not in ['session', 'find', 'properties',
+                'wait_tasks']:
+                raise ValueError('unknown op %s' % request['op'])
+            session = self.session(request)
+            return getattr(session, request['op'])(request)
+        finally:
+            with self.lock:
+                self.active -= 1
+                self.last_request = time.time()
+
+    def idle(self):
+        """Returns True if no request is being answered and the last one
+        ended idle_timeout seconds ago"""
+        with self.lock:
+            return self.active == 0 and \
+                time.time() - self.last_request >= self.idle_timeout
+
+    def watch_idle(self):
+        """Shuts the broker down once it was idle for idle_timeout seconds,
+        requests being answered, like long waits for tasks, keep it running"""
+        while not self.idle():
+            time.sleep(min(60, self.idle_timeout))
+        self.shutdown()
+
+    def close(self):
+        """Logs out of all sessions"""
+        for session in self.sessions.values():
+            session.close()
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+    """Answers the requests sent on a connection, one per line"""
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            try:
+                response = {'result': self.server.dispatch(json.loads(line))}
+            except vmodl.MethodFault as error:
+                response = {'error': getattr(error, 'msg', None) or
+                    error.__class__.__name__}
+            except Exception as error:
+                response = {'error': str(error) or error.__class__.__name__}
+            self.wfile.write(json.dumps(response) + '\n')
+            self.wfile.flush()
+
+def login(request):
+    """Logs in to the vCenter server with the options of a request and returns
+    the service instance"""
+    kwargs = {}
+    if not request.get('certificate_check', True) and \
+        hasattr(ssl, 'SSLContext'):
+        context = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
+        context.verify_mode = ssl.CERT_NONE
+        kwargs['sslContext'] = context
+    return SmartConnect(
+        host=request['vcenter_hostname'],
+        user=request['username'],
+        pwd=request['password'],
+        port=request.get('port', 443),
+        **kwargs)
+
+def json_value(value):
+    """Returns a value which can be sent as JSON, references to managed
+    objects as dicts of their type and moId, or None"""
+    if value is None or isinstance(value, (bool, int, long, float, basestring)):
+        return value
+    if isinstance(value, vmodl.ManagedObject):
+        return {'type': value._wsdlName, 'moId': value._moId}
+    if isinstance(value, (list, tuple)):
+        return [json_value(item) for item in value]
+    return None
+
+def fault_value(fault):
+    """Returns the type, message and name of a fault as a dict"""
+    if fault is None:
+        return None
+    return {
+        'type': getattr(fault, '_wsdlName', fault.__class__.__name__),
+        'msg': getattr(fault, 'msg', None),
+        'name': getattr(fault, 'name', None)}
+
+def serve(path, idle_timeout):
+    """Listens on the Unix socket at path until terminated or idle"""
+    path = os.path.expanduser(path)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path), 0o700)
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+            raise SystemExit('a broker is already listening on %s' % path)
+        except socket.error:
+            os.unlink(path)
+        finally:
+            probe.close()
+
+    # the socket grants access to the sessions, so only the user may use it
+    umask = os.umask(0o077)
+    try:
+        broker = Broker(path, idle_timeout)
+    finally:
+        os.umask(umask)
+    if idle_timeout:
+        watcher = threading.Thread(target=broker.watch_idle)
+        watcher.daemon = True
+        watcher.start()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        broker.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        broker.server_close()
+        broker.close()
+        if os.path.exists(path):
+            os.unlink(path)
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--socket', default='~/.ansible/vsphere_cache/broker.sock',
+        help='path of the Unix socket to listen on [default: %default]')
+    parser.add_option('--idle-timeout', type='int', default=3600,
+        help='seconds after the last request was answered after which the '
+        'broker exits, unless another one is being answered, 0 to '
+        'run until terminated [default: %default]')
+    options, _ = parser.parse_args()
+    serve(options.socket, options.idle_timeout)
+
+if __name__ == '__main__':
+    main()
@@ -26,7 +26,7 @@ DOCUMENTATION = '''
 module: vsphere_migrate_pool
 short_description: Control resource pools of VMs
 description:
-     - This module controls resource pools of VMs, (online) migrating them there if necessary.
+     - This module controls resource pools of VMs, (online) migrating them there if necessary. A VM running on a host of the cluster is only relocated into the pool, VMs on hosts outside of the cluster are migrated, letting DRS choose the host.
 version_added: "not yet"
 notes:
     - This module should run from a system that can access vSphere directly.
@@ -42,8 +42,24 @@ options:
     required: true
   guest:
     description:
-      - The virtual server name you wish to manage.
-    required: true
+      - The virtual server name you wish to manage. Either guest, guests, uuid, instance_uuid or inventory_path is required.
+    required: false
+  guests:
+    description:
+      - A list of VM names or shell style patterns (i.e. web*) to migrate into the resource pool at once. The inventory and the resource pool are looked up only once and the migrations run in parallel, limited by max_migrations_per_host and max_migrations_per_cluster. Unless wait is no, the module waits for all migrations to complete in this mode and returns the status of each VM in results, as well as the throughput in VMs per minute.
+    required: false
+  uuid:
+    description:
+      - The BIOS UUID of the VM. If set, the VM is looked up by it in the vCenter search index instead of scanning all VMs for its name, which is faster on large inventories and unambiguous if names are duplicated across datacenters.
+    required: false
+  instance_uuid:
+    description:
+      - The vCenter instance UUID of the VM, used like uuid.
+    required: false
+  inventory_path:
+    description:
+      - The inventory path of the VM, i.e. MyDatacenter/vm/MyFolder/myvm001, used to look it up in the vCenter search index like uuid.
+    required: false
   username:
     description:
       - Username to connect to vcenter as.
@@ -54,18 +70,77 @@ options:
     required: true
   resource_pool:
     description:
-      - The name of the resource_pool to migrate the VM to.
+      - The full path of the resource pool in the cluster to migrate the VM to, i.e. /Resources/MyPool. A plain pool name is accepted as well, as long as it is unique within the cluster.
     required: true
   cluster:
     description:
       - The name of the cluster to migrate the VM to.
     required: true
-  sync:
+  port:
+    description:
+        - The port number under which the API is accessible on the vCenter server, defaults to port 443 (HTTPS).
+    required: false
+    default: 443
+  certificate_check:
+    description:
+        - As of PyVmomi 6.0 certificate checks are enforced for increased security, defaults to yes. May be disabled if using self signed certificates and have no way of importing it on your ansible host (unsafe).
+    required: false
+    default: yes
+    choices: ['yes', 'no']
+  wait:
     description:
-      - Specifies if the module should wait until the migration is completed. If no further changes on the VM are done during the current play, this can be set to 'no'.
+      - Specifies if the module should wait until the migrations are completed. If no further changes on the VMs are done during the current play, this can be set to 'no'. The migrations are then all started at once, without applying max_migrations_per_host and max_migrations_per_cluster, and their task ids are returned in tasks, to be collected later with vsphere_task_status.
     required: false
     default: yes
     choices: ['yes', 'no']
+    aliases: ['sync']
+  inventory_cache:
+    description:
+      - Keep a local index of the names and managed object references of the inventory objects the module looks up, to avoid sweeping the vCenter inventory on every run. Cached references are verified before use and the index is refreshed if one turned out to be stale or a name is missing.
+    required: false
+    default: no
+    choices: ['yes', 'no']
+  inventory_cache_ttl:
+    description:
+      - The number of seconds after which the inventory index of an object type is refreshed, defaults to one hour.
+    required: false
+    default: 3600
+  task_timeout:
+    description:
+      - The number of seconds to wait for a vCenter task to complete, before failing. Defaults to 0, which waits until the task has completed. A VM whose migration timed out fails in the state running, with the id of its task in tasks to be collected later with vsphere_task_status, while the other VMs of a guests list keep their results. Once migrations time out, the VMs not migrated yet are skipped.
+    required: false
+    default: 0
+  session_cache:
+    description:
+      - Keep the vCenter session cookie in the cache file in cache_dir and reuse it in following tasks, instead of logging in and out on every task. A new login is only done if the cached session has expired. The session in the result tells whether a session was reused and how many logins the task did, 0 or 1, which summed over the tasks of a playbook run should stay close to one.
+    required: false
+    default: no
+    choices: ['yes', 'no']
+  max_migrations_per_host:
+    description:
+      - The maximum number of migrations running at once per ESXi host the VMs are running on, when migrating guests. vSphere allows 4 concurrent vMotions per host on 1GbE and 8 on 10GbE networks, further migrations are queued or rejected.
+    required: false
+    default: 4
+  max_migrations_per_cluster:
+    description:
+      - The maximum number of migrations running at once in total, when migrating guests.
+    required: false
+    default: 16
+  cache_dir:
+    description:
+      - The directory on the ansible host in which the cache files are kept, one per vCenter server and user. It is created with permissions restricted to the current user, if it doesn't exist.
+    required: false
+    default: ~/.ansible/vsphere_cache
+  broker_socket:
+    description:
+      - The path of the Unix socket of a vsphere_broker running on the ansible host, i.e. ~/.ansible/vsphere_cache/broker.sock. The module then uses the session of the broker, resolves names through its inventory index instead of sweeping the inventory and lets it wait for tasks. If the broker isn't running or a request to it fails, the module falls back to connecting directly.
+    required: false
+  perf:
+    description:
+      - Add a perf key to the result, breaking down the wall time of the module into the phases connect, lookup, diff, task_submit and task_wait. It also counts the SOAP requests to the vCenter server per method, with the seconds spent in them, the bytes sent and received and lists the slowest requests.
+    required: false
+    default: no
+    choices: ['yes', 'no']
 author:
     - Simon Rupf
 '''
@@ -78,63 +153,1111 @@ EXAMPLES = '''
     guest: myvm001
     resource_pool: "/Resources"
     cluster: MyCluster
+# Rebalance all web servers and two database servers into a resource pool
+- vsphere_migrate_pool:
+    vcenter_hostname: vcenter.mydomain.local
+    username: myuser
+    password: mypass
+    guests:
+      - web*
+      - db001
+      - db002
+    resource_pool: "/Resources/Production"
+    cluster: MyCluster
+    max_migrations_per_host: 8
+# Start the migrations without waiting and collect them at the end of the play
+- vsphere_migrate_pool:
+    vcenter_hostname: vcenter.mydomain.local
+    username: myuser
+    password: mypass
+    guests:
+      - app*
+    resource_pool: "/Resources/Production"
+    cluster: MyCluster
+    wait: no
+  register: migrations
+- vsphere_task_status:
+    vcenter_hostname: vcenter.mydomain.local
+    username: myuser
+    password: mypass
+    tasks: "{{ migrations.results | map(attribute='tasks') | sum(start=[]) | map(attribute='task') | list }}"
+    wait: yes
 '''
 
 # import module snippets
 from ansible.module_utils.basic import *
-from pysphere import VIServer
-import re
+import fnmatch, time
+
+# imported by import_pyvmomi once the arguments have been validated
+vim = vmodl = SmartConnect = Disconnect = SoapStubAdapter = None
 
 def main():
     """Sets up the module parameters, validates them and perform the change"""
     module = AnsibleModule(
         argument_spec=dict(
-            vcenter_hostname=dict(required=True),
-            username=dict(required=True),
-            password=dict(required=True),
-            guest=dict(required=True),
-            resource_pool=dict(required=True),
-            cluster=dict(required=True),
-            sync=dict(required=False, type='bool', default=True)
+            vcenter_hostname=dict(required=True, type='str'),
+            username=dict(required=True, type='str'),
+            password=dict(required=True, type='str'),
+            guest=dict(required=False, type='str'),
+            guests=dict(required=False, type='list'),
+            uuid=dict(required=False, type='str'),
+            instance_uuid=dict(required=False, type='str'),
+            inventory_path=dict(required=False, type='str'),
+            resource_pool=dict(required=True, type='str'),
+            cluster=dict(required=True, type='str'),
+            port=dict(required=False, type='int', default=443),
+            certificate_check=dict(required=False, type='bool', default=True),
+            wait=dict(
+                required=False, type='bool', default=True, aliases=['sync']),
+            max_migrations_per_host=dict(
+                required=False, type='int', default=4),
+            max_migrations_per_cluster=dict(
+                required=False, type='int', default=16),
+            task_timeout=dict(required=False, type='int', default=0),
+            session_cache=dict(required=False, type='bool', default=False),
+            inventory_cache=dict(required=False, type='bool', default=False),
+            inventory_cache_ttl=dict(required=False, type='int', default=3600),
+            cache_dir=dict(
+                required=False, type='str', default='~/.ansible/vsphere_cache'),
+            broker_socket=dict(required=False, type='str'),
+            perf=dict(required=False, type='bool', default=False)
         ),
+        mutually_exclusive=[
+            ['guests', 'guest'],
+            ['guests', 'uuid'],
+            ['guests', 'instance_uuid'],
+            ['guests', 'inventory_path']],
+        required_one_of=[
+            ['guest', 'guests', 'uuid', 'instance_uuid', 'inventory_path']],
         supports_check_mode=True
     )
+    if module.params['max_migrations_per_host'] < 1 or \
+        module.params['max_migrations_per_cluster'] < 1:
+        module.fail_json(msg='max_migrations_per_host and '
+            'max_migrations_per_cluster must be at least 1')
+    broker_connect(module)
+    import_pyvmomi()
+    perf_start(module)
 
-    server = VIServer()
-    server.connect(
-        module.params['vcenter_hostname'],
-        module.params['username'],
-        module.params['password'])
-    virtualmachine = server.get_vm_by_name(module.params['guest'])
-
-    old_name = virtualmachine.get_resource_pool_name()
-    new_name = module.params['resource_pool']
-
-    # find the clusters ManagedObjectReference
-    cluster = None
-    clusters = server.get_clusters()
-    for mor, name in clusters.iteritems():
-        if name == module.params['cluster']:
-            cluster = mor
-            break
+    # connect to the vCenter...
+    connection, session = connect(module)
+    content = connection.RetrieveContent()
+    perf_phase('lookup')
+
+    cache_path = None
+    if module.params['inventory_cache']:
+        cache_path = cache_file(module)
 
+    # resolve the cluster and the VMs given by name in a single pass,
+    # identifiers are looked up in the search index
+    identifiers = [module.params[key]
+        for key in ['uuid', 'instance_uuid', 'inventory_path']
+        if module.params[key]]
+    names = module.params['guests'] or []
+    if module.params['guest'] and not identifiers:
+        names = [module.params['guest']]
+    found = find_objs(
+        content,
+        {
+            vim.ClusterComputeResource: [module.params['cluster']],
+            vim.VirtualMachine: [
+                name for name in names if not is_pattern(name)]},
+        cache_path,
+        module.params['inventory_cache_ttl'])
+
+    cluster = found[vim.ClusterComputeResource].get(module.params['cluster'])
     if cluster is None:
         module.fail_json(msg='Cluster %s not found on server %s' %
             (module.params['cluster'], module.params['vcenter_hostname']))
 
-    # find the new resource pools Managed Object Reference and migrate the VM
-    rps = server.get_resource_pools(from_mor=cluster)
-    for mor, path in rps.iteritems():
-        if re.match('.*%s$' % new_name, path):
-            if not re.match('.*%s$' % old_name, path):
-                if not module.check_mode:
-                    virtualmachine.migrate(
-                        resource_pool=mor,
-                        host=virtualmachine.get_property('hostname'),
-                        sync_run=module.params['sync'])
-                module.exit_json(changed=True, changes=module.params)
-            module.exit_json(changed=False, changes=module.params)
-    module.fail_json(msg='Resource pool %s not found' %
-        module.params['resource_pool'])
+    guests = []
+    if identifiers:
+        guest = find_vm(content, module.params)
+        if guest is None:
+            module.fail_json(msg='guest VM %s not found on server %s' %
+                (identifiers[0], module.params['vcenter_hostname']))
+        guests.append(guest)
+    else:
+        guests = select_guests(module, content, names, found)
+
+    # find the resource pool by its full path, refreshing the cached index of
+    # the pools of the cluster if it doesn't know about it
+    pool = find_resource_pool(module, content, cluster, cache_path, False)
+    if cache_path and pool is None:
+        pool = find_resource_pool(module, content, cluster, cache_path, True)
+    if pool is None:
+        module.fail_json(msg='Resource pool %s not found in cluster %s' %
+            (module.params['resource_pool'], module.params['cluster']))
+
+    start = time.time()
+    results = migrate_guests(
+        module, content, cluster, cache_path, pool, guests)
+
+    # with wait, migrations which are still running have timed out
+    failed_states = ['error']
+    if module.params['wait']:
+        failed_states.append('running')
+
+    if not module.params['guests']:
+        result = results[0]
+        if result['state'] in failed_states:
+            module.fail_json(
+                msg=result['msg'], tasks=result['tasks'], session=session)
+        module.exit_json(
+            changed=result['changed'],
+            changes={
+                'guest': result['name'],
+                'cluster': module.params['cluster'],
+                'resource_pool': module.params['resource_pool']},
+            operation=result.get('operation'),
+            tasks=result['tasks'],
+            session=session)
+
+    duration = round(time.time() - start, 3)
+    migrated = len([result for result in results
+        if result['state'] == 'success'])
+    summary = dict(
+        results=results,
+        changed=len([result for result in results if result['changed']]) > 0,
+        migrated=migrated,
+        duration=duration,
+        vms_per_minute=duration and round(migrated * 60 / duration, 1) or 0,
+        session=session)
+    failed = [result['name'] for result in results
+        if result['state'] in failed_states]
+    if failed:
+        module.fail_json(
+            msg='%d of %d VMs failed to migrate: %s' %
+                (len(failed), len(results), ', '.join(failed)),
+            **summary)
+    module.exit_json(**summary)
+
+def select_guests(module, content, names, found):
+    """Returns the VMs with the given names or matching the shell style
+    patterns among them, sweeping the inventory only if there are patterns"""
+    vms = {}
+    if [name for name in names if is_pattern(name)]:
+        vms = dict(
+            (properties['name'], vm)
+            for vm, properties in get_objs(content, [vim.VirtualMachine])
+            if 'name' in properties)
+    guests = []
+    for name in names:
+        if is_pattern(name):
+            matches = sorted([vm_name for vm_name in vms
+                if fnmatch.fnmatchcase(vm_name, name)])
+        elif name in found[vim.VirtualMachine]:
+            matches = [name]
+            vms[name] = found[vim.VirtualMachine][name]
+        else:
+            module.fail_json(msg='guest VM %s not found on server %s' %
+                (name, module.params['vcenter_hostname']))
+        for match in matches:
+            if vms[match] not in guests:
+                guests.append(vms[match])
+    return guests
+
+def migrate_guests(module, content, cluster, cache_path, pool, guests):
+    """Moves the guests into the resource pool and returns a list of their
+    results
+
+    A plain change of the resource pool is done with RelocateVM_Task, only
+    guests running on a host outside of the cluster are migrated with
+    MigrateVM_Task, which lets DRS choose the host. If wait is set, the tasks
+    run in parallel, limited by max_migrations_per_host and
+    max_migrations_per_cluster, otherwise they are all started at once and
+    returned without waiting for them. Migrations still running once
+    task_timeout elapsed are returned as running as well."""
+    wait = module.params['wait']
+    snapshots = get_cluster_snapshots(content, cluster, pool, guests)
+    cluster_hosts = snapshots[cluster._moId].get('host', [])
+
+    # a pool from the inventory cache is stale once it was deleted, even if a
+    # pool of the same name was created again, which shows in the name read
+    # along with the guests
+    refreshed = False
+    if cache_path and snapshots.get(pool._moId, {}).get('name') != \
+        module.params['resource_pool'].strip('/').rsplit('/', 1)[-1]:
+        refreshed = True
+        pool = find_resource_pool(module, content, cluster, cache_path, True)
+        if pool is None:
+            module.fail_json(msg='Resource pool %s not found in cluster %s' %
+                (module.params['resource_pool'], module.params['cluster']))
+
+    perf_phase('diff')
+    results = {}
+    pending = []
+    for guest in guests:
+        snapshot = snapshots.get(guest._moId)
+        if snapshot is None:
+            results[guest._moId] = {
+                'name': guest._moId,
+                'changed': False,
+                'state': 'error',
+                'msg': 'vm %s no longer exists' % guest._moId,
+                'tasks': []}
+            continue
+        result = {
+            'name': snapshot['name'],
+            'changed': False,
+            'tasks': []}
+        results[guest._moId] = result
+        host = snapshot.get('runtime.host')
+        if host is None:
+            result['state'] = 'error'
+            result['msg'] = 'vm %s is not running on a host, it may be ' \
+                'orphaned or disconnected' % snapshot['name']
+            continue
+        result['host'] = snapshots.get(host._moId, {}).get('name', host._moId)
+        if snapshot['resourcePool'] == pool:
+            result['state'] = 'unchanged'
+            continue
+        if host in cluster_hosts:
+            result['operation'] = 'relocate'
+        else:
+            result['operation'] = 'migrate'
+        if module.check_mode:
+            result['changed'] = True
+            result['state'] = 'check_mode'
+        else:
+            pending.append(guest)
+
+    per_host = module.params['max_migrations_per_host']
+    per_cluster = module.params['max_migrations_per_cluster']
+    running = {}
+    while pending or running:
+        # start as many migrations as the limits allow, in the order given,
+        # skipping guests whose host is busy
+        previous = perf_phase('task_submit')
+        for guest in list(pending):
+            if guest not in pending:
+                continue
+            if wait and len(running) >= per_cluster:
+                break
+            host = snapshots[guest._moId]['runtime.host']
+            if wait and len([1 for _, other, _ in running.values()
+                if other == host]) >= per_host:
+                continue
+            pending.remove(guest)
+            result = results[guest._moId]
+            try:
+                try:
+                    task = submit_migration(guest, pool, result['operation'])
+                except vmodl.fault.ManagedObjectNotFound:
+                    # the cached reference of the pool may be stale, retry
+                    # once with a fresh one, otherwise the guest is gone
+                    if not cache_path or refreshed:
+                        raise
+                    refreshed = True
+                    fresh = find_resource_pool(
+                        module, content, cluster, cache_path, True)
+                    if fresh is None or fresh == pool:
+                        raise
+                    pool = fresh
+                    # the guests were compared with the stale reference
+                    unchanged = [other for other in [guest] + pending
+                        if snapshots[other._moId]['resourcePool'] == pool]
+                    for other in unchanged:
+                        results[other._moId]['state'] = 'unchanged'
+                        del results[other._moId]['operation']
+                        if other in pending:
+                            pending.remove(other)
+                    if guest in unchanged:
+                        continue
+                    task = submit_migration(guest, pool, result['operation'])
+            except vmodl.MethodFault as error:
+                result['state'] = 'error'
+                result['msg'] = task_error_msg(error)
+                continue
+            running[task._moId] = (guest, host, task)
+            if not wait:
+                result['changed'] = True
+                result['state'] = 'running'
+                result['tasks'].append(task_handle(task))
+        perf_phase(previous)
+        if not wait or not running:
+            break
+
+        done = wait_for_tasks(
+            module,
+            content,
+            [task for _, _, task in running.values()],
+            module.params['task_timeout'],
+            first=True,
+            partial=True)
+        if not done:
+            # the migrations keep running and can be collected with
+            # vsphere_task_status, those not started yet aren't started
+            for guest, host, task in running.values():
+                result = results[guest._moId]
+                result['changed'] = True
+                result['state'] = 'running'
+                result['msg'] = 'timed out after %d seconds waiting for the ' \
+                    'migration of vm %s to complete' % \
+                    (module.params['task_timeout'], result['name'])
+                result['tasks'].append(task_handle(task))
+            for guest in pending:
+                result = results[guest._moId]
+                result['state'] = 'error'
+                result['msg'] = 'vm %s was not migrated, as the migrations ' \
+                    'before it timed out' % result['name']
+            break
+        for moid, info in done.items():
+            guest, host, task = running.pop(moid)
+            result = results[guest._moId]
+            result['state'] = info['state']
+            result['tasks'].append(task_summary(info))
+            if info['state'] == 'success':
+                result['changed'] = True
+            else:
+                result['msg'] = task_error_msg(info['error'])
+    return [results[guest._moId] for guest in guests]
+
+def get_cluster_snapshots(content, cluster, pool, guests):
+    """Returns a dict mapping the moIds of the guests, the cluster, its hosts
+    and the resource pool to their properties, retrieved in a single call
+
+    A guest or pool deleted since it was looked up fails the whole call, it
+    is left out of the dict and the call repeated without it."""
+    property_specs = [
+        vmodl.query.PropertyCollector.PropertySpec(
+            type=vim.VirtualMachine,
+            pathSet=['name', 'resourcePool', 'runtime.host']),
+        vmodl.query.PropertyCollector.PropertySpec(
+            type=vim.ClusterComputeResource,
+            pathSet=['host']),
+        vmodl.query.PropertyCollector.PropertySpec(
+            type=vim.HostSystem,
+            pathSet=['name']),
+        vmodl.query.PropertyCollector.PropertySpec(
+            type=vim.ResourcePool,
+            pathSet=['name'])]
+    objs = list(guests) + [pool]
+    while True:
+        object_specs = [
+            vmodl.query.PropertyCollector.ObjectSpec(obj=obj)
+            for obj in objs]
+        object_specs.append(vmodl.query.PropertyCollector.ObjectSpec(
+            obj=cluster,
+            selectSet=[vmodl.query.PropertyCollector.TraversalSpec(
+                name='clusterHosts',
+                type=vim.ClusterComputeResource,
+                path='host',
+                skip=False)]))
+        try:
+            return dict(
+                (obj._moId, properties)
+                for obj, properties in retrieve_properties(
+                    content, object_specs, property_specs))
+        except vmodl.fault.ManagedObjectNotFound as error:
+            moid = getattr(error.obj, '_moId', None)
+            missing = [obj for obj in objs if obj._moId == moid]
+            if not missing:
+                raise
+            objs.remove(missing[0])
+
+def submit_migration(guest, pool, operation):
+    """Starts moving a guest into the resource pool and returns the task"""
+    if operation == 'relocate':
+        return guest.RelocateVM_Task(spec=vim.vm.RelocateSpec(pool=pool))
+    return guest.MigrateVM_Task(pool=pool, priority='defaultPriority')
+
+def find_resource_pool(module, content, cluster, cache_path, refresh):
+    """Returns the resource pool of the cluster with the full path given in
+    resource_pool, i.e. /Resources/MyPool, or None if not found
+
+    A plain pool name is accepted as well, as long as it is unique in the
+    cluster."""
+    index = pool_index(module, content, cluster, cache_path, refresh)
+    path = module.params['resource_pool']
+    if '/' in path:
+        return index.get('/' + path.strip('/'))
+    matches = [pool for pool_path, pool in index.items()
+        if pool_path.rsplit('/', 1)[1] == path]
+    if len(matches) > 1:
+        module.fail_json(msg='Resource pool name %s is ambiguous in cluster '
+            '%s, use its full path' % (path, module.params['cluster']))
+    if matches:
+        return matches[0]
+    return None
+
+def pool_index(module, content, cluster, cache_path, refresh):
+    """Returns a dict mapping the full paths of the resource pools of the
+    cluster to the pools, built by traversing the pool tree in a single
+    property collector call or taken from the inventory cache if enabled and
+    up to date"""
+    key = 'ResourcePool:%s' % cluster._moId
+    if cache_path and not refresh:
+        entry = read_cache(cache_path).get('inventory', {}).get(key)
+        if entry and time.time() - entry['timestamp'] <= \
+            module.params['inventory_cache_ttl']:
+            return dict(
+                (path, vim.ResourcePool(moid, cluster._stub))
+                for path, moid in entry['objects'].items())
+
+    child_pools = vmodl.query.PropertyCollector.SelectionSpec(
+        name='childPools')
+    object_spec = vmodl.query.PropertyCollector.ObjectSpec(
+        obj=cluster,
+        skip=True,
+        selectSet=[
+            vmodl.query.PropertyCollector.TraversalSpec(
+                name='clusterPools',
+                type=vim.ClusterComputeResource,
+                path='resourcePool',
+                skip=False,
+                selectSet=[child_pools]),
+            vmodl.query.PropertyCollector.TraversalSpec(
+                name='childPools',
+                type=vim.ResourcePool,
+                path='resourcePool',
+                skip=False,
+                selectSet=[child_pools])])
+    property_spec = vmodl.query.PropertyCollector.PropertySpec(
+        type=vim.ResourcePool,
+        pathSet=['name', 'parent'])
+    pools = dict(
+        (pool._moId, (pool, properties))
+        for pool, properties in retrieve_properties(
+            content, [object_spec], [property_spec]))
+    index = {}
+    for pool, properties in pools.values():
+        names = []
+        while properties:
+            names.insert(0, properties['name'])
+            parent = properties.get('parent')
+            properties = parent and pools.get(parent._moId, (None, None))[1]
+        index['/' + '/'.join(names)] = pool
+
+    if cache_path:
+        def update_index(cache):
+            cache.setdefault('inventory', {})[key] = {
+                'timestamp': time.time(),
+                'objects': dict(
+                    (path, pool._moId) for path, pool in index.items())}
+        update_cache(cache_path, update_index)
+    return index
+
+# BEGIN vsphere_common
+# copied from common/vsphere_common.py by common/update_modules.py, edit there
+import atexit, fcntl, hashlib, json, os, socket, tempfile, time
+
+# the connection to the vsphere_broker, only set while it is available
+BROKER = {}
+
+# the performance counters of the module run, only filled if perf is set
+PERF = {}
+
+# the number of slowest SOAP requests listed in the perf result
+PERF_SLOWEST_CALLS = 5
+
+def import_pyvmomi():
+    """Imports pyVmomi and pyVim into the module globals
+
+    Loading pyVmomi and its type tables takes a good share of the runtime of
+    a short task, so it is deferred until the arguments have been validated
+    and the vCenter server is actually needed."""
+    global vim, vmodl, SmartConnect, Disconnect, SoapStubAdapter
+    from pyVmomi import vim, vmodl
+    from pyVim.connect import SmartConnect, Disconnect
+    from pyVmomi.SoapAdapter import SoapStubAdapter
+
+def connect(module):
+    """Connects to the vCenter server, reusing a cached session if enabled
+
+    Returns the service instance and a dict describing the session used,
+    with the number of logins done by this task, so their sum over a
+    playbook run shows how often the sessions were reused."""
+    context = None
+
+    if not module.params['certificate_check']:
+        import requests, ssl
+
+        # disable urllib3 ssl warnings
+        requests.packages.urllib3.disable_warnings()
+
+        # disable SSL certificate verification
+        if hasattr(ssl, 'SSLContext'):
+            context = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
+            context.verify_mode = ssl.CERT_NONE
+
+    # use the session of the broker, if there is one
+    session = broker_call('session')
+    if session:
+        connection = reuse_session(module, session, context)
+        if connection:
+            return connection, {'reused': True, 'logins': 0, 'broker': True}
+
+    if not module.params['session_cache']:
+        connection = login(module, context)
+        # and don't forget to disconnect
+        atexit.register(Disconnect, connection)
+        return connection, {'reused': False, 'logins': 1}
+
+    # try the cached session first, without holding the lock
+    cache_path = cache_file(module)
+    session = read_cache(cache_path).get('session', {})
+    connection = reuse_session(module, session, context)
+    if connection:
+        return connection, {'reused': True, 'logins': 0}
+
+    # log in while holding the lock, so concurrent forks wait for a single
+    # login and then reuse its session
+    connections = []
+    def update_session(cache):
+        session = cache.get('session', {})
+        connection = reuse_session(module, session, context)
+        if connection:
+            connections.append((connection, True))
+            return
+        connection = login(module, context)
+        connections.append((connection, False))
+        cache['session'] = {
+            'username': module.params['username'],
+            'cookie': connection._stub.cookie,
+            'version': connection._stub.version}
+    update_cache(cache_path, update_session)
+    connection, reused = connections[0]
+    # the session is kept open for the following tasks, so no disconnect here
+    return connection, {'reused': reused, 'logins': reused and 0 or 1}
+
+def login(module, context):
+    """Logs in to the vCenter server and returns the service instance"""
+    try:
+        if context:
+            return SmartConnect(
+                host=module.params['vcenter_hostname'],
+                user=module.params['username'],
+                pwd=module.params['password'],
+                port=module.params['port'],
+                sslContext=context)
+        else:
+            return SmartConnect(
+                host=module.params['vcenter_hostname'],
+                user=module.params['username'],
+                pwd=module.params['password'],
+                port=module.params['port'])
+    except:
+        module.fail_json(
+            msg='failed to connect to vCenter server at %s with user %s' %
+            (module.params['vcenter_hostname'], module.params['username']))
+
+def reuse_session(module, session, context):
+    """Returns a service instance using the cached session, or None if there
+    is no cached session for the user, it has expired or checking it fails"""
+    if session.get('username') != module.params['username'] or \
+        not session.get('cookie'):
+        return None
+
+    if context:
+        stub = SoapStubAdapter(
+            host=module.params['vcenter_hostname'],
+            port=module.params['port'],
+            version=session['version'],
+            sslContext=context)
+    else:
+        stub = SoapStubAdapter(
+            host=module.params['vcenter_hostname'],
+            port=module.params['port'],
+            version=session['version'])
+    stub.cookie = session['cookie']
+    connection = vim.ServiceInstance('ServiceInstance', stub)
+    try:
+        if connection.content.sessionManager.currentSession:
+            return connection
+    except (vmodl.MethodFault, socket.error, IOError):
+        # a new login either succeeds or reports the actual error
+        pass
+    return None
+
+def find_vm(content, identifiers):
+    """Returns the VM with the uuid, instance_uuid or inventory_path given in
+    the identifiers dict, looked up in the search index, or None"""
+    search_index = content.searchIndex
+    if identifiers.get('uuid'):
+        return search_index.FindByUuid(
+            uuid=identifiers['uuid'], vmSearch=True, instanceUuid=False)
+    if identifiers.get('instance_uuid'):
+        return search_index.FindByUuid(
+            uuid=identifiers['instance_uuid'], vmSearch=True, instanceUuid=True)
+    if identifiers.get('inventory_path'):
+        vm = search_index.FindByInventoryPath(
+            inventoryPath=identifiers['inventory_path'])
+        if isinstance(vm, vim.VirtualMachine):
+            return vm
+    return None
+
+def retrieve_properties(content, object_specs, property_specs):
+    """Returns a list of (object, properties) tuples, retrieved in bulk"""
+    return list(stream_properties(content, object_specs, property_specs))
+
+def stream_properties(content, object_specs, property_specs, page_size=None):
+    """Yields (object, properties) tuples, retrieved in bulk in pages of
+    page_size objects, or as the server sees fit, so that only a single page
+    is held in memory at once"""
+    collector = content.propertyCollector
+    filter_spec = vmodl.query.PropertyCollector.FilterSpec(
+        objectSet=object_specs,
+        propSet=property_specs)
+    options = vmodl.query.PropertyCollector.RetrieveOptions()
+    if page_size:
+        options.maxObjects = page_size
+    result = collector.RetrievePropertiesEx(
+        specSet=[filter_spec],
+        options=options)
+    while result:
+        for obj_content in result.objects:
+            properties = {}
+            for prop in obj_content.propSet:
+                properties[prop.name] = prop.val
+            yield obj_content.obj, properties
+        if not result.token:
+            break
+        result = collector.ContinueRetrievePropertiesEx(token=result.token)
+
+def get_objs(content, vimtypes, properties=None):
+    """Returns the properties (name by default) of all objects of the given
+    vimtypes, using a single container view and property collector call"""
+    if properties is None:
+        properties = ['name']
+    view = content.viewManager.CreateContainerView(
+        content.rootFolder, vimtypes, True)
+    try:
+        traversal_spec = vmodl.query.PropertyCollector.TraversalSpec(
+            name='traverseView',
+            path='view',
+            skip=False,
+            type=vim.view.ContainerView)
+        object_spec = vmodl.query.PropertyCollector.ObjectSpec(
+            obj=view,
+            skip=True,
+            selectSet=[traversal_spec])
+        property_specs = [
+            vmodl.query.PropertyCollector.PropertySpec(
+                type=vimtype,
+                pathSet=properties)
+            for vimtype in vimtypes]
+        return retrieve_properties(content, [object_spec], property_specs)
+    finally:
+        view.Destroy()
+
+def get_props(content, objs, properties):
+    """Returns a list of (object, properties) tuples for the given objects,
+    retrieved in a single property collector call"""
+    object_specs = [
+        vmodl.query.PropertyCollector.ObjectSpec(obj=obj) for obj in objs]
+    property_specs = [
+        vmodl.query.PropertyCollector.PropertySpec(
+            type=vimtype,
+            pathSet=properties)
+        for vimtype in set([type(obj) for obj in objs])]
+    return retrieve_properties(content, object_specs, property_specs)
+
+def find_objs(content, wanted, cache_path=None, cache_ttl=0):
+    """Resolves the names of objects of several vimtypes in a single pass
+
+    wanted maps vimtypes to a list of names, the returned dict maps the same
+    vimtypes to a dict of the names found and their objects. If a cache_path
+    is given, the names are looked up in the inventory index kept in that file
+    first and the vCenter inventory is only swept for the vimtypes that are
+    missing, outdated or stale in the index."""
+    index = broker_call('find', wanted=dict(
+        (vimtype._wsdlName, names) for vimtype, names in wanted.items()))
+    if index is not None:
+        stub = content.propertyCollector._stub
+        return dict(
+            (vimtype, dict(
+                (name, vimtype(moid, stub))
+                for name, moid in index[vimtype._wsdlName].items()))
+            for vimtype in wanted)
+
+    found = dict((vimtype, {}) for vimtype in wanted)
+    sweep = list(wanted.keys())
+
+    if cache_path:
+        sweep = []
+        index = read_cache(cache_path).get('inventory', {})
+        stub = content.propertyCollector._stub
+        candidates = []
+        for vimtype, names in wanted.items():
+            entry = index.get(vimtype._wsdlName)
+            if not entry or time.time() - entry['timestamp'] > cache_ttl or \
+                [name for name in names if name not in entry['objects']]:
+                sweep.append(vimtype)
+                continue
+            for name in names:
+                candidates.append(
+                    (vimtype, name, vimtype(entry['objects'][name], stub)))
+
+        # verify that the cached references still exist and carry their names
+        if candidates:
+            try:
+                current = dict(
+                    (obj._moId, properties.get('name'))
+                    for obj, properties in get_props(
+                        content, [obj for _, _, obj in candidates], ['name']))
+            except vmodl.fault.ManagedObjectNotFound:
+                current = {}
+            for vimtype, name, obj in candidates:
+                if current.get(obj._moId) == name:
+                    found[vimtype][name] = obj
+                elif vimtype not in sweep:
+                    sweep.append(vimtype)
+
+    if sweep:
+        # the views include subtypes, i.e. datastore clusters are folders and
+        # vApps resource pools, but names only resolve to objects of exactly
+        # the wanted vimtype, as they do in the index of the broker
+        objects = dict((vimtype, {}) for vimtype in sweep)
+        for obj, properties in get_objs(content, sweep):
+            if type(obj) in objects and 'name' in properties:
+                objects[type(obj)].setdefault(properties['name'], obj)
+        for vimtype in sweep:
+            found[vimtype] = dict(
+                (name, objects[vimtype][name])
+                for name in wanted[vimtype] if name in objects[vimtype])
+
+        if cache_path:
+            def update_index(cache):
+                index = cache.setdefault('inventory', {})
+                for vimtype in sweep:
+                    index[vimtype._wsdlName] = {
+                        'timestamp': time.time(),
+                        'objects': dict(
+                            (name, obj._moId)
+                            for name, obj in objects[vimtype].items())}
+            update_cache(cache_path, update_index)
+
+    return found
+
+def is_pattern(name):
+    """Returns True if the name contains shell style wildcards"""
+    return len([char for char in '*?[' if char in name]) > 0
+
+def cache_file(module):
+    """Returns the path of the cache file for the vCenter server and user in
+    use, so users neither replace each others sessions nor see inventory
+    indexes built with the permissions of another user"""
+    directory = os.path.expanduser(module.params['cache_dir'])
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+    user = hashlib.sha1(module.params['username'].encode('utf-8'))
+    return os.path.join(directory, '%s_%d_%s.json' %
+        (module.params['vcenter_hostname'], module.params['port'],
+        user.hexdigest()[:12]))
+
+def read_cache(path):
+    """Returns the contents of a cache file, empty if it is missing or broken"""
+    try:
+        cache = open(path)
+        try:
+            return json.load(cache)
+        finally:
+            cache.close()
+    except (IOError, ValueError):
+        return {}
+
+def update_cache(path, update):
+    """Applies the update function to the contents of a cache file
+
+    The file is locked for the duration of the update, to be safe against
+    concurrent forks, and atomically replaced by the updated contents."""
+    lock = open(path + '.lock', 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        cache = read_cache(path)
+        update(cache)
+        handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        temp = os.fdopen(handle, 'w')
+        try:
+            json.dump(cache, temp)
+        finally:
+            temp.close()
+        os.rename(temp_path, path)
+    finally:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
+
+def wait_for_tasks(module, content, tasks, timeout=0, first=False,
+    partial=False):
+    """Wait for tasks to complete and return a dict of their state information
+
+    Instead of polling the tasks, this blocks in WaitForUpdatesEx on the vCenter
+    server until their state or progress changes. The dict maps each completed
+    tasks moId to its state, progress, result, error and the seconds waited.
+    If first is set, it returns as soon as at least one task has completed. A
+    timeout of 0 waits forever, otherwise the module fails once it elapsed,
+    unless partial is set, which returns the tasks completed until then.
+    If the broker is available, it waits on behalf of the module."""
+    previous = perf_phase('task_wait')
+    response = broker_call('wait_tasks',
+        tasks=[task._moId for task in tasks], timeout=timeout, first=first)
+    if response is not None:
+        perf_phase(previous)
+        return broker_task_infos(module, content, response, timeout, partial)
+    collector = content.propertyCollector.CreatePropertyCollector()
+    try:
+        object_specs = [
+            vmodl.query.PropertyCollector.ObjectSpec(obj=task)
+            for task in tasks]
+        property_spec = vmodl.query.PropertyCollector.PropertySpec(
+            type=vim.Task,
+            pathSet=['info.state', 'info.progress', 'info.result',
+                'info.error'])
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec(
+            objectSet=object_specs,
+            propSet=[property_spec])
+        collector.CreateFilter(filter_spec, True)
+
+        start = time.time()
+        infos = dict(
+            (task._moId, {
+                'task': task._moId,
+                'state': None,
+                'progress': None,
+                'result': None,
+                'error': None,
+                'duration': None})
+            for task in tasks)
+        done = {}
+        version = ''
+        while len(done) < len(tasks) and not (first and done):
+            max_wait = 60
+            if timeout:
+                remaining = timeout - (time.time() - start)
+                if remaining <= 0:
+                    if partial:
+                        return done
+                    module.fail_json(
+                        msg='timed out after %d seconds waiting for %d ' \
+                            'task(s) to complete' %
+                            (timeout, len(tasks) - len(done)),
+                        tasks=[task_summary(info) for info in infos.values()])
+                max_wait = int(min(max_wait, max(remaining, 1)))
+            options = vmodl.query.PropertyCollector.WaitOptions(
+                maxWaitSeconds=max_wait)
+            update = collector.WaitForUpdatesEx(version, options)
+            if update is None:
+                continue
+            version = update.version
+            for filter_set in update.filterSet:
+                for object_set in filter_set.objectSet:
+                    info = infos[object_set.obj._moId]
+                    for change in object_set.changeSet:
+                        info[change.name.split('.', 1)[1]] = change.val
+                    if info['state'] in ['success', 'error'] and \
+                        info['task'] not in done:
+                        info['duration'] = round(time.time() - start, 3)
+                        done[info['task']] = info
+        return done
+    finally:
+        collector.Destroy()
+        perf_phase(previous)
+
+def task_error_msg(error):
+    """Returns a message describing the error of a failed task"""
+    if isinstance(error, vim.fault.DuplicateName):
+        return 'an object with the name %s already exists' % error.name
+    if getattr(error, 'msg', None):
+        return 'an error occurred while waiting for the task to complete: %s' \
+            % error.msg
+    return 'an error occurred while waiting for the task to complete'
+
+def task_summary(info):
+    """Returns the state information of a task, reduced to what can be
+    returned in the module result"""
+    return {
+        'task': info['task'],
+        'state': info['state'],
+        'progress': info['progress'],
+        'duration': info['duration']}
+
+def task_handle(task):
+    """Returns the summary of a task which is not waited for, its id can be
+    passed to vsphere_task_status to collect it later"""
+    return {
+        'task': task._moId,
+        'state': 'running',
+        'progress': None,
+        'duration': None}
+
+def broker_connect(module):
+    """Connects to the vsphere_broker listening on broker_socket, if it is set
+    and the broker is running"""
+    if not module.params['broker_socket']:
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(os.path.expanduser(module.params['broker_socket']))
+    except socket.error:
+        sock.close()
+        return
+    reader = sock.makefile('r')
+    atexit.register(broker_close, sock, reader)
+    BROKER.update({
+        'socket': sock,
+        'reader': reader,
+        'request': dict(
+            (key, module.params[key])
+            for key in ['vcenter_hostname', 'port', 'username', 'password',
+                'certificate_check'])})
+
+def broker_close(sock, reader):
+    """Closes the connection to the broker"""
+    reader.close()
+    sock.close()
+
+def broker_call(op, **request):
+    """Returns the result of a request to the broker, or None if it isn't
+    available
+
+    If the request fails, the broker isn't used for the rest of the task and
+    the module falls back to connecting directly, reporting the errors of the
+    vCenter server in its own words."""
+    if not BROKER:
+        return None
+    request.update(BROKER['request'])
+    request['op'] = op
+    start = time.time()
+    try:
+        BROKER['socket'].sendall(json.dumps(request) + '\n')
+        response = json.loads(BROKER['reader'].readline())
+    except (socket.error, ValueError):
+        response = {'error': 'connection to the broker lost'}
+    if PERF:
+        perf_call('broker.%s' % op, time.time() - start)
+    if 'error' in response:
+        broker_close(BROKER['socket'], BROKER['reader'])
+        BROKER.clear()
+        return None
+    return response['result']
+
+def broker_task_infos(module, content, response, timeout, partial=False):
+    """Returns the state information of the tasks the broker waited for like
+    wait_for_tasks does, restoring their results and errors"""
+    stub = content.propertyCollector._stub
+    infos = response['infos']
+    for info in infos.values():
+        if info['result']:
+            vimtype = getattr(
+                vim, info['result']['type'], vmodl.ManagedObject)
+            info['result'] = vimtype(info['result']['moId'], stub)
+        if info['error']:
+            fault = getattr(vim.fault, info['error']['type'], vmodl.MethodFault)
+            error = fault(msg=info['error']['msg'])
+            if info['error']['name']:
+                error.name = info['error']['name']
+            info['error'] = error
+    if response['timed_out'] and not partial:
+        module.fail_json(
+            msg='timed out after %d seconds waiting for %d task(s) to complete'
+                % (timeout, len(infos) - len(response['done'])),
+            tasks=[task_summary(info) for info in infos.values()])
+    return dict((moid, infos[moid]) for moid in response['done'])
+
+def perf_start(module):
+    """Enables the performance counters, if the perf option is set
+
+    The pyVmomi stub adapter is hooked to count, time and measure the SOAP
+    requests of all callers and the counters are added to the result of the
+    module as perf key, whether it succeeds or fails."""
+    if not module.params['perf']:
+        return
+    now = time.time()
+    PERF.update({
+        'start': now,
+        'phase': 'connect',
+        'phase_start': now,
+        'phases': {},
+        'calls': {},
+        'bytes_sent': 0,
+        'bytes_received': 0,
+        'slowest': []})
+
+    invoke_method = SoapStubAdapter.InvokeMethod
+    def timed_invoke_method(self, mo, info, args, outerStub=None):
+        start = time.time()
+        try:
+            return invoke_method(self, mo, info, args, outerStub)
+        finally:
+            perf_call(info.wsdlName, time.time() - start)
+    SoapStubAdapter.InvokeMethod = timed_invoke_method
+
+    get_connection = SoapStubAdapter.GetConnection
+    def counted_get_connection(self):
+        conn = get_connection(self)
+        if not getattr(conn, 'perf_counted', False):
+            perf_count_connection(conn)
+        return conn
+    SoapStubAdapter.GetConnection = counted_get_connection
+
+    exit_json = module.exit_json
+    fail_json = module.fail_json
+    module.exit_json = lambda **kwargs: exit_json(perf=perf_report(), **kwargs)
+    module.fail_json = lambda **kwargs: fail_json(perf=perf_report(), **kwargs)
+
+def perf_count_connection(conn):
+    """Counts the bytes of the requests and responses of a HTTP connection"""
+    request = conn.request
+    getresponse = conn.getresponse
+    def counted_request(method, url, body=None, headers={}):
+        PERF['bytes_sent'] += len(body or '')
+        return request(method, url, body, headers)
+    def counted_getresponse():
+        response = getresponse()
+        read = response.read
+        def counted_read(*args):
+            data = read(*args)
+            PERF['bytes_received'] += len(data)
+            return data
+        response.read = counted_read
+        return response
+    conn.request = counted_request
+    conn.getresponse = counted_getresponse
+    conn.perf_counted = True
+
+def perf_call(method, seconds):
+    """Records a SOAP request to the vCenter server"""
+    calls = PERF['calls'].setdefault(method, {'count': 0, 'seconds': 0.0})
+    calls['count'] += 1
+    calls['seconds'] += seconds
+    PERF['slowest'].append({
+        'method': method,
+        'phase': PERF['phase'],
+        'seconds': round(seconds, 3)})
+    PERF['slowest'].sort(key=lambda call: -call['seconds'])
+    del PERF['slowest'][PERF_SLOWEST_CALLS:]
+
+def perf_phase(name):
+    """Attributes the time from now on to the named phase and returns the
+    previous phase, so that it can be restored after a nested phase"""
+    if not PERF or name is None:
+        return None
+    now = time.time()
+    previous = PERF['phase']
+    PERF['phases'][previous] = \
+        PERF['phases'].get(previous, 0.0) + now - PERF['phase_start']
+    PERF['phase'] = name
+    PERF['phase_start'] = now
+    return previous
+
+def perf_report():
+    """Returns the performance counters, as added to the result"""
+    perf_phase(PERF['phase'])
+    return {
+        'duration': round(time.time() - PERF['start'], 3),
+        'phases': dict(
+            (name, round(seconds, 3))
+            for name, seconds in PERF['phases'].items()),
+        'requests': sum([calls['count'] for calls in PERF['calls'].values()]),
+        'calls': dict(
+            (method, {
+                'count': calls['count'],
+                'seconds': round(calls['seconds'], 3)})
+            for method, calls in PERF['calls'].items()),
+        'bytes_sent': PERF['bytes_sent'],
+        'bytes_received': PERF['bytes_received'],
+        'slowest': PERF['slowest']}
+# END vsphere_common
 
 main()
@@ -0,0 +1,878 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Collects the state of vCenter tasks
+#
+# This module returns the state of tasks started by the other vSphere modules
+# with wait set to no, optionally waiting for them to complete.
+#
+# (c) 2016, Simon Rupf <simon@rupf.net>
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+DOCUMENTATION = '''
+---
+module: vsphere_task_status
+short_description: Collects the state of vCenter tasks
+description:
+    - This module returns the state, progress, result and error of one or many vCenter tasks, retrieved in a single call. The tasks are usually started by vsphere_template, vsphere_tools or vsphere_migrate_pool with wait set to no, so a play can start many long running operations and collect them at once.
+version_added: "not yet"
+notes:
+    - This module should run from a system that can access vSphere directly.
+      Either by using local_action, or using delegate_to.
+    - The vCenter server purges completed tasks after a while, their state is returned as unknown.
+requirements:
+    - "python >= 2.6"
+    - PyVmomi
+options:
+  vcenter_hostname:
+    description:
+      - The hostname of the vCenter server the module will connect to.
+    required: true
+  username:
+    description:
+      - Username to connect to vCenter as.
+    required: true
+  password:
+    description:
+      - Password of the user to connect to vcenter as.
+    required: true
+  tasks:
+    description:
+      - A list of the ids of the tasks to collect, i.e. task-1234, as returned in the task key of the tasks of the other modules.
+    required: true
+  wait:
+    description:
+      - Wait until all tasks have completed, instead of returning their current state. The module then fails if any of the tasks failed.
+    required: false
+    default: no
+    choices: ['yes', 'no']
+  task_timeout:
+    description:
+      - The number of seconds to wait for the tasks to complete if wait is set, before failing. Defaults to 0, which waits until all tasks have completed.
+    required: false
+    default: 0
+  port:
+    description:
+        - The port number under which the API is accessible on the vCenter server, defaults to port 443 (HTTPS).
+    required: false
+    default: 443
+  certificate_check:
+    description:
+        - As of PyVmomi 6.0 certificate checks are enforced for increased security, defaults to yes. May be disabled if using self signed certificates and have no way of importing it on your ansible host (unsafe).
+    required: false
+    default: yes
+    choices: ['yes', 'no']
+  session_cache:
+    description:
+      - Keep the vCenter session cookie in the cache file in cache_dir and reuse it in following tasks, instead of logging in and out on every task. A new login is only done if the cached session has expired. The session in the result tells whether a session was reused and how many logins the task did, 0 or 1, which summed over the tasks of a playbook run should stay close to one.
+    required: false
+    default: no
+    choices: ['yes', 'no']
+  cache_dir:
+    description:
+      - The directory on the ansible host in which the cache files are kept, one per vCenter server and user. It is created with permissions restricted to the current user, if it doesn't exist.
+    required: false
+    default: ~/.ansible/vsphere_cache
+  perf:
+    description:
+      - Add a perf key to the result, breaking down the wall time of the module into the phases connect, lookup and task_wait. It also counts the SOAP requests to the vCenter server per method, with the seconds spent in them, the bytes sent and received and lists the slowest requests.
+    required: false
+    default: no
+    choices: ['yes', 'no']
+author:
+    - Simon Rupf
+'''
+EXAMPLES = '''
+# start creating several VMs and poll until all of them are created
+- vsphere_template:
+    vcenter_hostname: vcenter.mydomain.local
+    username: myuser
+    password: mypass
+    template_src: mytemplate
+    resource_pool: MyResourcePool
+    datastore: MyDataStore
+    folder: MyFolder
+    guests: "{{ groups['webservers'] }}"
+    wait: no
+  register: clones
+- vsphere_task_status:
+    vcenter_hostname: vcenter.mydomain.local
+    username: myuser
+    password: mypass
+    tasks: "{{ clones.results | map(attribute='tasks') | sum(start=[]) | map(attribute='task') | list }}"
+  register: status
+  until: status.done
+  retries: 60
+  delay: 10
+# or block until they have completed, failing if any of them failed
+- vsphere_task_status:
+    vcenter_hostname: vcenter.mydomain.local
+    username: myuser
+    password: mypass
+    tasks: "{{ clones.results | map(attribute='tasks') | sum(start=[]) | map(attribute='task') | list }}"
+    wait: yes
+'''
+
+# import module snippets
+from ansible.module_utils.basic import *
+
+# imported by import_pyvmomi once the arguments have been validated
+vim = vmodl = SmartConnect = Disconnect = SoapStubAdapter = None
+
+# properties of the tasks returned in the result
+TASK_PROPERTIES = ['info.state', 'info.progress', 'info.result', 'info.error',
+    'info.descriptionId', 'info.entityName', 'info.startTime',
+    'info.completeTime']
+
+def main():
+    """Sets up the module parameters, validates them and collects the tasks"""
+    # enforce parameters and types
+    module = AnsibleModule(
+        argument_spec=dict(
+            vcenter_hostname=dict(required=True, type='str'),
+            username=dict(required=True, type='str'),
+            password=dict(required=True, type='str'),
+            tasks=dict(required=True, type='list'),
+            wait=dict(required=False, type='bool', default=False),
+            task_timeout=dict(required=False, type='int', default=0),
+            port=dict(required=False, type='int', default=443),
+            certificate_check=dict(required=False, type='bool', default=True),
+            session_cache=dict(required=False, type='bool', default=False),
+            cache_dir=dict(
+                required=False, type='str', default='~/.ansible/vsphere_cache'),
+            perf=dict(required=False, type='bool', default=False)
+        ),
+        supports_check_mode=True
+    )
+    import_pyvmomi()
+    perf_start(module)
+
+    # connect to the vCenter...
+    connection, session = connect(module)
+    content = connection.RetrieveContent()
+    perf_phase('lookup')
+
+    ids = []
+    for task_id in module.params['tasks']:
+        if task_id not in ids:
+            ids.append(task_id)
+    tasks = [vim.Task(task_id, connection._stub) for task_id in ids]
+    statuses = get_statuses(content, tasks)
+
+    if module.params['wait']:
+        running = [task for task in tasks
+            if statuses[task._moId]['state'] in ['queued', 'running']]
+        if running:
+            wait_for_tasks(
+                module, content, running, module.params['task_timeout'])
+            statuses.update(get_statuses(content, running))
+
+    results = [statuses[task_id] for task_id in ids]
+    counts = {}
+    for result in results:
+        counts[result['state']] = counts.get(result['state'], 0) + 1
+    output = dict(
+        changed=False,
+        tasks=results,
+        counts=counts,
+        done=counts.get('queued', 0) + counts.get('running', 0) == 0,
+        session=session)
+    failed = [result['task'] for result in results
+        if result['state'] == 'error']
+    if module.params['wait'] and failed:
+        module.fail_json(
+            msg='%d of %d tasks failed: %s' %
+                (len(failed), len(results), ', '.join(failed)),
+            **output)
+    module.exit_json(**output)
+
+def get_statuses(content, tasks):
+    """Returns a dict mapping the moIds of the tasks to their state, retrieved
+    in a single call
+
+    The property collector fails the whole call if a single task is unknown,
+    so those are left out and reported as unknown one by one."""
+    statuses = {}
+    remaining = list(tasks)
+    while remaining:
+        object_specs = [
+            vmodl.query.PropertyCollector.ObjectSpec(obj=task)
+            for task in remaining]
+        property_spec = vmodl.query.PropertyCollector.PropertySpec(
+            type=vim.Task,
+            pathSet=TASK_PROPERTIES)
+        try:
+            retrieved = retrieve_properties(
+                content, object_specs, [property_spec])
+        except vmodl.fault.ManagedObjectNotFound as error:
+            if error.obj not in remaining:
+                raise
+            remaining.remove(error.obj)
+            statuses[error.obj._moId] = {
+                'task': error.obj._moId,
+                'state': 'unknown',
+                'msg': 'task %s not found, it may have been purged by the '
+                    'vCenter server' % error.obj._moId}
+            continue
+        for task, properties in retrieved:
+            statuses[task._moId] = task_status(task, properties)
+        break
+    return statuses
+
+def task_status(task, properties):
+    """Returns the state of a task as returned in the module result"""
+    status = {
+        'task': task._moId,
+        'state': properties.get('info.state'),
+        'progress': properties.get('info.progress'),
+        'description': properties.get('info.descriptionId'),
+        'entity': properties.get('info.entityName'),
+        'result': None,
+        'start_time': None,
+        'complete_time': None}
+    result = properties.get('info.result')
+    if isinstance(result, vmodl.ManagedObject):
+        status['result'] = result._moId
+    for path, key in [
+        ('info.startTime', 'start_time'), ('info.completeTime', 'complete_time')]:
+        if properties.get(path) is not None:
+            status[key] = properties[path].isoformat()
+    if properties.get('info.error') is not None:
+        status['msg'] = task_error_msg(properties['info.error'])
+    return status
+
+# BEGIN vsphere_common
+# copied from common/vsphere_common.py by common/update_modules.py, edit there
+import atexit, fcntl, hashlib, json, os, socket, tempfile, time
+
+# the connection to the vsphere_broker, only set while it is available
+BROKER = {}
+
+# the performance counters of the module run, only filled if perf is set
+PERF = {}
+
+# the number of slowest SOAP requests listed in the perf result
+PERF_SLOWEST_CALLS = 5
+
+def import_pyvmomi():
+    """Imports pyVmomi and pyVim into the module globals
+
+    Loading pyVmomi and its type tables takes a good share of the runtime of
+    a short task, so it is deferred until the arguments have been validated
+    and the vCenter server is actually needed."""
+    global vim, vmodl, SmartConnect, Disconnect, SoapStubAdapter
+    from pyVmomi import vim, vmodl
+    from pyVim.connect import SmartConnect, Disconnect
+    from pyVmomi.SoapAdapter import SoapStubAdapter
+
+def connect(module):
+    """Connects to the vCenter server, reusing a cached session if enabled
+
+    Returns the service instance and a dict describing the session used,
+    with the number of logins done by this task, so their sum over a
+    playbook run shows how often the sessions were reused."""
+    context = None
+
+    if not module.params['certificate_check']:
+        import requests, ssl
+
+        # disable urllib3 ssl warnings
+        requests.packages.urllib3.disable_warnings()
+
+        # disable SSL certificate verification
+        if hasattr(ssl, 'SSLContext'):
+            context = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
+            context.verify_mode = ssl.CERT_NONE
+
+    # use the session of the broker, if there is one
+    session = broker_call('session')
+    if session:
+        connection = reuse_session(module, session, context)
+        if connection:
+            return connection, {'reused': True, 'logins': 0, 'broker': True}
+
+    if not module.params['session_cache']:
+        connection = login(module, context)
+        # and don't forget to disconnect
+        atexit.register(Disconnect, connection)
+        return connection, {'reused': False, 'logins': 1}
+
+    # try the cached session first, without holding the lock
+    cache_path = cache_file(module)
+    session = read_cache(cache_path).get('session', {})
+    connection = reuse_session(module, session, context)
+    if connection:
+        return connection, {'reused': True, 'logins': 0}
+
+    # log in while holding the lock, so concurrent forks wait for a single
+    # login and then reuse its session
+    connections = []
+    def update_session(cache):
+        session = cache.get('session', {})
+        connection = reuse_session(module, session, context)
+        if connection:
+            connections.append((connection, True))
+            return
+        connection = login(module, context)
+        connections.append((connection, False))
+        cache['session'] = {
+            'username': module.params['username'],
+            'cookie': connection._stub.cookie,
+            'version': connection._stub.version}
+    update_cache(cache_path, update_session)
+    connection, reused = connections[0]
+    # the session is kept open for the following tasks, so no disconnect here
+    return connection, {'reused': reused, 'logins': reused and 0 or 1}
+
+def login(module, context):
+    """Logs in to the vCenter server and returns the service instance"""
+    try:
+        if context:
+            return SmartConnect(
+                host=module.params['vcenter_hostname'],
+                user=module.params['username'],
+                pwd=module.params['password'],
+                port=module.params['port'],
+                sslContext=context)
+        else:
+            return SmartConnect(
+                host=module.params['vcenter_hostname'],
+                user=module.params['username'],
+                pwd=module.params['password'],
+                port=module.params['port'])
+    except:
+        module.fail_json(
+            msg='failed to connect to vCenter server at %s with user %s' %
+            (module.params['vcenter_hostname'], module.params['username']))
+
+def reuse_session(module, session, context):
+    """Returns a service instance using the cached session, or None if there
+    is no cached session for the user, it has expired or checking it fails"""
+    if session.get('username') != module.params['username'] or \
+        not session.get('cookie'):
+        return None
+
+    if context:
+        stub = SoapStubAdapter(
+            host=module.params['vcenter_hostname'],
+            port=module.params['port'],
+            version=session['version'],
+            sslContext=context)
+    else:
+        stub = SoapStubAdapter(
+            host=module.params['vcenter_hostname'],
+            port=module.params['port'],
+            version=session['version'])
+    stub.cookie = session['cookie']
+    connection = vim.ServiceInstance('ServiceInstance', stub)
+    try:
+        if connection.content.sessionManager.currentSession:
+            return connection
+    except (vmodl.MethodFault, socket.error, IOError):
+        # a new login either succeeds or reports the actual error
+        pass
+    return None
+
+def find_vm(content, identifiers):
+    """Returns the VM with the uuid, instance_uuid or inventory_path given in
+    the identifiers dict, looked up in the search index, or None"""
+    search_index = content.searchIndex
+    if identifiers.get('uuid'):
+        return search_index.FindByUuid(
+            uuid=identifiers['uuid'], vmSearch=True, instanceUuid=False)
+    if identifiers.get('instance_uuid'):
+        return search_index.FindByUuid(
+            uuid=identifiers['instance_uuid'], vmSearch=True, instanceUuid=True)
+    if identifiers.get('inventory_path'):
+        vm = search_index.FindByInventoryPath(
+            inventoryPath=identifiers['inventory_path'])
+        if isinstance(vm, vim.VirtualMachine):
+            return vm
+    return None
+
+def retrieve_properties(content, object_specs, property_specs):
+    """Returns a list of (object, properties) tuples, retrieved in bulk"""
+    return list(stream_properties(content, object_specs, property_specs))
+
+def stream_properties(content, object_specs, property_specs, page_size=None):
+    """Yields (object, properties) tuples, retrieved in bulk in pages of
+    page_size objects, or as the server sees fit, so that only a single page
+    is held in memory at once"""
+    collector = content.propertyCollector
+    filter_spec = vmodl.query.PropertyCollector.FilterSpec(
+        objectSet=object_specs,
+        propSet=property_specs)
+    options = vmodl.query.PropertyCollector.RetrieveOptions()
+    if page_size:
+        options.maxObjects = page_size
+    result = collector.RetrievePropertiesEx(
+        specSet=[filter_spec],
+        options=options)
+    while result:
+        for obj_content in result.objects:
+            properties = {}
+            for prop in obj_content.propSet:
+                properties[prop.name] = prop.val
+            yield obj_content.obj, properties
+        if not result.token:
+            break
+        result = collector.ContinueRetrievePropertiesEx(token=result.token)
+
+def get_objs(content, vimtypes, properties=None):
+    """Returns the properties (name by default) of all objects of the given
+    vimtypes, using a single container view and property collector call"""
+    if properties is None:
+        properties = ['name']
+    view = content.viewManager.CreateContainerView(
+        content.rootFolder, vimtypes, True)
+    try:
+        traversal_spec = vmodl.query.PropertyCollector.TraversalSpec(
+            name='traverseView',
+            path='view',
+            skip=False,
+            type=vim.view.ContainerView)
+        object_spec = vmodl.query.PropertyCollector.ObjectSpec(
+            obj=view,
+            skip=True,
+            selectSet=[traversal_spec])
+        property_specs = [
+            vmodl.query.PropertyCollector.PropertySpec(
+                type=vimtype,
+                pathSet=properties)
+            for vimtype in vimtypes]
+        return retrieve_properties(content, [object_spec], property_specs)
+    finally:
+        view.Destroy()
+
+def get_props(content, objs, properties):
+    """Returns a list of (object, properties) tuples for the given objects,
+    retrieved in a single property collector call"""
+    object_specs = [
+        vmodl.query.PropertyCollector.ObjectSpec(obj=obj) for obj in objs]
+    property_specs = [
+        vmodl.query.PropertyCollector.PropertySpec(
+            type=vimtype,
+            pathSet=properties)
+        for vimtype in set([type(obj) for obj in objs])]
+    return retrieve_properties(content, object_specs, property_specs)
+
+def find_objs(content, wanted, cache_path=None, cache_ttl=0):
+    """Resolves the names of objects of several vimtypes in a single pass
+
+    wanted maps vimtypes to a list of names, the returned dict maps the same
+    vimtypes to a dict of the names found and their objects. If a cache_path
+    is given, the names are looked up in the inventory index kept in that file
+    first and the vCenter inventory is only swept for the vimtypes that are
+    missing, outdated or stale in the index."""
+    index = broker_call('find', wanted=dict(
+        (vimtype._wsdlName, names) for vimtype, names in wanted.items()))
+    if index is not None:
+        stub = content.propertyCollector._stub
+        return dict(
+            (vimtype, dict(
+                (name, vimtype(moid, stub))
+                for name, moid in index[vimtype._wsdlName].items()))
+            for vimtype in wanted)
+
+    found = dict((vimtype, {}) for vimtype in wanted)
+    sweep = list(wanted.keys())
+
+    if cache_path:
+        sweep = []
+        index = read_cache(cache_path).get('inventory', {})
+        stub = content.propertyCollector._stub
+        candidates = []
+        for vimtype, names in wanted.items():
+            entry = index.get(vimtype._wsdlName)
+            if not entry or time.time() - entry['timestamp'] > cache_ttl or \
+                [name for name in names if name not in entry['objects']]:
+                sweep.append(vimtype)
+                continue
+            for name in names:
+                candidates.append(
+                    (vimtype, name, vimtype(entry['objects'][name], stub)))
+
+        # verify that the cached references still exist and carry their names
+        if candidates:
+            try:
+                current = dict(
+                    (obj._moId, properties.get('name'))
+                    for obj, properties in get_props(
+                        content, [obj for _, _, obj in candidates], ['name']))
+            except vmodl.fault.ManagedObjectNotFound:
+                current = {}
+            for vimtype, name, obj in candidates:
+                if current.get(obj._moId) == name:
+                    found[vimtype][name] = obj
+                elif vimtype not in sweep:
+                    sweep.append(vimtype)
+
+    if sweep:
+        # the views include subtypes, i.e. datastore clusters are folders and
+        # vApps resource pools, but names only resolve to objects of exactly
+        # the wanted vimtype, as they do in the index of the broker
+        objects = dict((vimtype, {}) for vimtype in sweep)
+        for obj, properties in get_objs(content, sweep):
+            if type(obj) in objects and 'name' in properties:
+                objects[type(obj)].setdefault(properties['name'], obj)
+        for vimtype in sweep:
+            found[vimtype] = dict(
+                (name, objects[vimtype][name])
+                for name in wanted[vimtype] if name in objects[vimtype])
+
+        if cache_path:
+            def update_index(cache):
+                index = cache.setdefault('inventory', {})
+                for vimtype in sweep:
+                    index[vimtype._wsdlName] = {
+                        'timestamp': time.time(),
+                        'objects': dict(
+                            (name, obj._moId)
+                            for name, obj in objects[vimtype].items())}
+            update_cache(cache_path, update_index)
+
+    return found
+
+def is_pattern(name):
+    """Returns True if the name contains shell style wildcards"""
+    return len([char for char in '*?[' if char in name]) > 0
+
+def cache_file(module):
+    """Returns the path of the cache file for the vCenter server and user in
+    use, so users neither replace each others sessions nor see inventory
+    indexes built with the permissions of another user"""
+    directory = os.path.expanduser(module.params['cache_dir'])
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+    user = hashlib.sha1(module.params['username'].encode('utf-8'))
+    return os.path.join(directory, '%s_%d_%s.json' %
+        (module.params['vcenter_hostname'], module.params['port'],
+        user.hexdigest()[:12]))
+
+def read_cache(path):
+    """Returns the contents of a cache file, empty if it is missing or broken"""
+    try:
+        cache = open(path)
+        try:
+            return json.load(cache)
+        finally:
+            cache.close()
+    except (IOError, ValueError):
+        return {}
+
+def update_cache(path, update):
+    """Applies the update function to the contents of a cache file
+
+    The file is locked for the duration of the update, to be safe against
+    concurrent forks, and atomically replaced by the updated contents."""
+    lock = open(path + '.lock', 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        cache = read_cache(path)
+        update(cache)
+        handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        temp = os.fdopen(handle, 'w')
+        try:
+            json.dump(cache, temp)
+        finally:
+            temp.close()
+        os.rename(temp_path, path)
+    finally:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
+
+def wait_for_tasks(module, content, tasks, timeout=0, first=False,
+    partial=False):
+    """Wait for tasks to complete and return a dict of their state information
+
+    Instead of polling the tasks, this blocks in WaitForUpdatesEx on the vCenter
+    server until their state or progress changes. The dict maps each completed
+    tasks moId to its state, progress, result, error and the seconds waited.
+    If first is set, it returns as soon as at least one task has completed. A
+    timeout of 0 waits forever, otherwise the module fails once it elapsed,
+    unless partial is set, which returns the tasks completed until then.
+    If the broker is available, it waits on behalf of the module."""
+    previous = perf_phase('task_wait')
+    response = broker_call('wait_tasks',
+        tasks=[task._moId for task in tasks], timeout=timeout, first=first)
+    if response is not None:
+        perf_phase(previous)
+        return broker_task_infos(module, content, response, timeout, partial)
+    collector = content.propertyCollector.CreatePropertyCollector()
+    try:
+        object_specs = [
+            vmodl.query.PropertyCollector.ObjectSpec(obj=task)
+            for task in tasks]
+        property_spec = vmodl.query.PropertyCollector.PropertySpec(
+            type=vim.Task,
+            pathSet=['info.state', 'info.progress', 'info.result',
+                'info.error'])
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec(
+            objectSet=object_specs,
+            propSet=[property_spec])
+        collector.CreateFilter(filter_spec, True)
+
+        start = time.time()
+        infos = dict(
+            (task._moId, {
+                'task': task._moId,
+                'state': None,
+                'progress': None,
+                'result': None,
+                'error': None,
+                'duration': None})
+            for task in tasks)
+        done = {}
+        version = ''
+        while len(done) < len(tasks) and not (first and done):
+            max_wait = 60
+            if timeout:
+                remaining = timeout - (time.time() - start)
+                if remaining <= 0:
+                    if partial:
+                        return done
+                    module.fail_json(
+                        msg='timed out after %d seconds waiting for %d ' \
+                            'task(s) to complete' %
+                            (timeout, len(tasks) - len(done)),
+                        tasks=[task_summary(info) for info in infos.values()])
+                max_wait = int(min(max_wait, max(remaining, 1)))
+            options = vmodl.query.PropertyCollector.WaitOptions(
+                maxWaitSeconds=max_wait)
+            update = collector.WaitForUpdatesEx(version, options)
+            if update is None:
+                continue
+            version = update.version
+            for filter_set in update.filterSet:
+                for object_set in filter_set.objectSet:
+                    info = infos[object_set.obj._moId]
+                    for change in object_set.changeSet:
+                        info[change.name.split('.', 1)[1]] = change.val
+                    if info['state'] in ['success', 'error'] and \
+                        info['task'] not in done:
+                        info['duration'] = round(time.time() - start, 3)
+                        done[info['task']] = info
+        return done
+    finally:
+        collector.Destroy()
+        perf_phase(previous)
+
+def task_error_msg(error):
+    """Returns a message describing the error of a failed task"""
+    if isinstance(error, vim.fault.DuplicateName):
+        return 'an object with the name %s already exists' % error.name
+    if getattr(error, 'msg', None):
+        return 'an error occurred while waiting for the task to complete: %s' \
+            % error.msg
+    return 'an error occurred while waiting for the task to complete'
+
+def task_summary(info):
+    """Returns the state information of a task, reduced to what can be
+    returned in the module result"""
+    return {
+        'task': info['task'],
+        'state': info['state'],
+        'progress': info['progress'],
+        'duration': info['duration']}
+
+def task_handle(task):
+    """Returns the summary of a task which is not waited for, its id can be
+    passed to vsphere_task_status to collect it later"""
+    return {
+        'task': task._moId,
+        'state': 'running',
+        'progress': None,
+        'duration': None}
+
+def broker_connect(module):
+    """Connects to the vsphere_broker listening on broker_socket, if it is set
+    and the broker is running"""
+    if not module.params['broker_socket']:
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(os.path.expanduser(module.params['broker_socket']))
+    except socket.error:
+        sock.close()
+        return
+    reader = sock.makefile('r')
+    atexit.register(broker_close, sock, reader)
+    BROKER.update({
+        'socket': sock,
+        'reader': reader,
+        'request': dict(
+            (key, module.params[key])
+            for key in ['vcenter_hostname', 'port', 'username', 'password',
+                'certificate_check'])})
+
+def broker_close(sock, reader):
+    """Closes the connection to the broker"""
+    reader.close()
+    sock.close()
+
+def broker_call(op, **request):
+    """Returns the result of a request to the broker, or None if it isn't
+    available
+
+    If the request fails, the broker isn't used for the rest of the task and
+    the module falls back to connecting directly, reporting the errors of the
+    vCenter server in its own words."""
+    if not BROKER:
+        return None
+    request.update(BROKER['request'])
+    request['op'] = op
+    start = time.time()
+    try:
+        BROKER['socket'].sendall(json.dumps(request) + '\n')
+        response = json.loads(BROKER['reader'].readline())
+    except (socket.error, ValueError):
+        response = {'error': 'connection to the broker lost'}
+    if PERF:
+        perf_call('broker.%s' % op, time.time() - start)
+    if 'error' in response:
+        broker_close(BROKER['socket'], BROKER['reader'])
+        BROKER.clear()
+        return None
+    return response['result']
+
+def broker_task_infos(module, content, response, timeout, partial=False):
+    """Returns the state information of the tasks the broker waited for like
+    wait_for_tasks does, restoring their results and errors"""
+    stub = content.propertyCollector._stub
+    infos = response['infos']
+    for info in infos.values():
+        if info['result']:
+            vimtype = getattr(
+                vim, info['result']['type'], vmodl.ManagedObject)
+            info['result'] = vimtype(info['result']['moId'], stub)
+        if info['error']:
+            fault = getattr(vim.fault, info['error']['type'], vmodl.MethodFault)
+            error = fault(msg=info['error']['msg'])
+            if info['error']['name']:
+                error.name = info['error']['name']
+            info['error'] = error
+    if response['timed_out'] and not partial:
+        module.fail_json(
+            msg='timed out after %d seconds waiting for %d task(s) to complete'
+                % (timeout, len(infos) - len(response['done'])),
+            tasks=[task_summary(info) for info in infos.values()])
+    return dict((moid, infos[moid]) for moid in response['done'])
+
+def perf_start(module):
+    """Enables the performance counters, if the perf option is set
+
+    The pyVmomi stub adapter is hooked to count, time and measure the SOAP
+    requests of all callers and the counters are added to the result of the
+    module as perf key, whether it succeeds or fails."""
+    if not module.params['perf']:
+        return
+    now = time.time()
+    PERF.update({
+        'start': now,
+        'phase': 'connect',
+        'phase_start': now,
+        'phases': {},
+        'calls': {},
+        'bytes_sent': 0,
+        'bytes_received': 0,
+        'slowest': []})
+
+    invoke_method = SoapStubAdapter.InvokeMethod
+    def timed_invoke_method(self, mo, info, args, outerStub=None):
+        start = time.time()
+        try:
+            return invoke_method(self, mo, info, args, outerStub)
+        finally:
+            perf_call(info.wsdlName, time.time() - start)
+    SoapStubAdapter.InvokeMethod = timed_invoke_method
+
+    get_connection = SoapStubAdapter.GetConnection
+    def counted_get_connection(self):
+        conn = get_connection(self)
+        if not getattr(conn, 'perf_counted', False):
+            perf_count_connection(conn)
+        return conn
+    SoapStubAdapter.GetConnection = counted_get_connection
+
+    exit_json = module.exit_json
+    fail_json = module.fail_json
+    module.exit_json = lambda **kwargs: exit_json(perf=perf_report(), **kwargs)
+    module.fail_json = lambda **kwargs: fail_json(perf=perf_report(), **kwargs)
+
+def perf_count_connection(conn):
+    """Counts the bytes of the requests and responses of a HTTP connection"""
+    request = conn.request
+    getresponse = conn.getresponse
+    def counted_request(method, url, body=None, headers={}):
+        PERF['bytes_sent'] += len(body or '')
+        return request(method, url, body, headers)
+    def counted_getresponse():
+        response = getresponse()
+        read = response.read
+        def counted_read(*args):
+            data = read(*args)
+            PERF['bytes_received'] += len(data)
+            return data
+        response.read = counted_read
+        return response
+    conn.request = counted_request
+    conn.getresponse = counted_getresponse
+    conn.perf_counted = True
+
+def perf_call(method, seconds):
+    """Records a SOAP request to the vCenter server"""
+    calls = PERF['calls'].setdefault(method, {'count': 0, 'seconds': 0.0})
+    calls['count'] += 1
+    calls['seconds'] += seconds
+    PERF['slowest'].append({
+        'method': method,
+        'phase': PERF['phase'],
+        'seconds': round(seconds, 3)})
+    PERF['slowest'].sort(key=lambda call: -call['seconds'])
+    del PERF['slowest'][PERF_SLOWEST_CALLS:]
+
+def perf_phase(name):
+    """Attributes the time from now on to the named phase and returns the
+    previous phase, so that it can be restored after a nested phase"""
+    if not PERF or name is None:
+        return None
+    now = time.time()
+    previous = PERF['phase']
+    PERF['phases'][previous] = \
+        PERF['phases'].get(previous, 0.0) + now - PERF['phase_start']
+    PERF['phase'] = name
+    PERF['phase_start'] = now
+    return previous
+
+def perf_report():
+    """Returns the performance counters, as added to the result"""
+    perf_phase(PERF['phase'])
+    return {
+        'duration': round(time.time() - PERF['start'], 3),
+        'phases': dict(
+            (name, round(seconds, 3))
+            for name, seconds in PERF['phases'].items()),
+        'requests': sum([calls['count'] for calls in PERF['calls'].values()]),
+        'calls': dict(
+            (method, {
+                'count': calls['count'],
+                'seconds': round(calls['seconds'], 3)})
+            for method, calls in PERF['calls'].items()),
+        'bytes_sent': PERF['bytes_sent'],
+        'bytes_received': PERF['bytes_received'],
+        'slowest': PERF['slowest']}
+# END vsphere_common
+
+main()
@@ -42,8 +42,24 @@ options:
     required: true
   guest:
     description:
-      - The virtual machines name you wish to create or manage.
-    required: true
+      - The virtual machines name you wish to create or manage. Either guest or guests is required.
+    required: false
+  uuid:
+    description:
+      - The BIOS UUID of the VM. If set, the VM is looked up by it in the vCenter search index instead of scanning all VMs for its name, which is faster on large inventories and unambiguous if names are duplicated across datacenters. New VMs are created with this UUID.
+    required: false
+  instance_uuid:
+    description:
+      - The vCenter instance UUID of the VM, used like uuid.
+    required: false
+  inventory_path:
+    description:
+      - The inventory path of the VM, i.e. MyDatacenter/vm/MyFolder/myvm001, used to look it up in the vCenter search index like uuid.
+    required: false
+  guests:
+    description:
+      - A list of virtual machines to create or manage in a single run. Each entry is either a name or a dict with a name, optionally one of uuid, instance_uuid and inventory_path, and any of the options template_src, datastore, folder, resource_pool, notes, num_cpus, memory_mb and power_on_after_clone, which default to the module parameters of the same name. The inventory lookups are done once for all guests and new guests are cloned concurrently. The result contains a list of per guest results, the facts of all guests in vsphere_guests and the total duration in seconds.
+    required: false
   username:
     description:
       - Username to connect to vCenter as.
@@ -54,20 +70,20 @@ options:
     required: true
   template_src:
     description:
-      - Name of the source template to deploy from
-    required: true
+      - Name of the source template to deploy from. Required unless set for every entry of guests. May also be a list of names or shell style patterns of replicas of the same template, kept on different datastores. The replica on the target datastore is then chosen, falling back to one on the same storage array (same NFS server or NAA id prefix) and finally the first one listed. The chosen template and the reason are returned in template_source.
+    required: false
   resource_pool:
     description:
-      - The name of the resource pool to migrate the VM to.
-    required: true
+      - The name of the resource pool to migrate the VM to. Required unless set for every entry of guests.
+    required: false
   datastore:
     description:
-      - The name of the datastore to create the VM into. This parameter is not considered when changing an existing VM, as it may have unexpected and dangerous results, e.g. migrating contents of multiple datastores into a single one.
-    required: true
+      - The name of the datastore to create the VM into. This parameter is not considered when changing an existing VM, as it may have unexpected and dangerous results, e.g. migrating contents of multiple datastores into a single one. Required unless set for every entry of guests. May also be a list of names, shell style patterns or datastore clusters, in which case the target datastore of new VMs is chosen according to datastore_placement and returned in placement.
+    required: false
   folder:
     description:
-      - The name of the folder to migrate the VM to.
-    required: true
+      - The name of the folder to migrate the VM to. Required unless set for every entry of guests.
+    required: false
   notes:
     description:
         - The string to set as the annotation about the VM, defaults to an empty string.
@@ -83,6 +99,33 @@ options:
         - The number of CPUs the VM should have, defaults to 4096 MiB. When changing this on an existing VM, you need to shutdown the VM beforehand.
     required: false
     default: 4096
+  clone_type:
+    description:
+      - The kind of clone to create. A full clone copies the whole template. A linked clone only creates delta disks backed by a snapshot of the template, see template_snapshot. An instant clone forks the running VM given as template_src and requires vCenter 6.7 or later, the new VM inherits the CPUs and memory of its parent. The mode used is returned in the clone_type fact of newly created VMs.
+    required: false
+    default: full
+    choices: ['full', 'linked', 'instant']
+  replicate_template:
+    description:
+      - If no replica of the template exists on the target datastore, create one named after the first template_src entry and the datastore, i.e. mytemplate_MyDataStore, and clone from it. The replica is kept for following deployments, which find it by that name.
+    required: false
+    default: no
+    choices: ['yes', 'no']
+  datastore_placement:
+    description:
+      - How to choose the target datastore if datastore is a list, pattern or datastore cluster. With free_space the accessible datastore with the most free space is chosen, taking into account the space reserved by the other clones of the same run, the committed space of the template for full clones and the memory for the swap file of linked and instant clones. With sdrs, storage DRS is asked for a recommendation for the first datastore cluster given.
+    required: false
+    default: free_space
+    choices: ['free_space', 'sdrs']
+  template_snapshot:
+    description:
+      - The name of the snapshot of the template to base linked clones on, defaults to the current snapshot of the template.
+    required: false
+  max_concurrent_clones:
+    description:
+      - The maximum number of clone tasks to run at once when creating the guests listed in guests.
+    required: false
+    default: 4
   port:
     description:
         - The port number under which the API is accessible on the vCenter server, defaults to port 443 (HTTPS).
@@ -100,6 +143,49 @@ options:
     required: false
     default: yes
     choices: ['yes', 'no']
+  inventory_cache:
+    description:
+      - Keep a local index of the names and managed object references of the inventory objects the module looks up, to avoid sweeping the vCenter inventory on every run. Cached references are verified before use and the index is refreshed if one turned out to be stale or a name is missing.
+    required: false
+    default: no
+    choices: ['yes', 'no']
+  inventory_cache_ttl:
+    description:
+      - The number of seconds after which the inventory index of an object type is refreshed, defaults to one hour.
+    required: false
+    default: 3600
+  wait:
+    description:
+      - Specifies if the module should wait until the clone, relocate and reconfigure tasks are completed. If set to 'no', the clones are all started at once, without applying max_concurrent_clones, and the ids of the tasks left running are returned in tasks, to be collected later with vsphere_task_status. The facts of VMs with a running task are not gathered. Tasks preparing the clones, like replicating the template, are always waited for, as are relocations followed by a reconfiguration of the same VM.
+    required: false
+    default: yes
+    choices: ['yes', 'no']
+  task_timeout:
+    description:
+      - The number of seconds to wait for a vCenter task to complete, before failing. Defaults to 0, which waits until the task has completed. A VM whose task timed out fails with the id of the task in tasks, to be collected later with vsphere_task_status, while the other VMs of a guests list keep their results. Once clones time out, the clones not started yet are skipped.
+    required: false
+    default: 0
+  session_cache:
+    description:
+      - Keep the vCenter session cookie in the cache file in cache_dir and reuse it in following tasks, instead of logging in and out on every task. A new login is only done if the cached session has expired. The session in the result tells whether a session was reused and how many logins the task did, 0 or 1, which summed over the tasks of a playbook run should stay close to one.
+    required: false
+    default: no
+    choices: ['yes', 'no']
+  cache_dir:
+    description:
+      - The directory on the ansible host in which the cache files are kept, one per vCenter server and user. It is created with permissions restricted to the current user, if it doesn't exist.
+    required: false
+    default: ~/.ansible/vsphere_cache
+  broker_socket:
+    description:
+      - The path of the Unix socket of a vsphere_broker running on the ansible host, i.e. ~/.ansible/vsphere_cache/broker.sock. The module then uses the session of the broker, resolves names through its inventory index instead of sweeping the inventory and lets it wait for tasks. If the broker isn't running or a request to it fails, the module falls back to connecting directly.
+    required: false
+  perf:
+    description:
+      - Add a perf key to the result, breaking down the wall time of the module into the phases connect, lookup, diff, task_submit, task_wait and facts. It also counts the SOAP requests to the vCenter server per method, with the seconds spent in them, the bytes sent and received and lists the slowest requests.
+    required: false
+    default: no
+    choices: ['yes', 'no']
 author:
     - Simon Rupf, based on examples by Dann Bohn
 '''
@@ -114,13 +200,57 @@ EXAMPLES = '''
     resource_pool: MyResourcePool
     datastore: MyDataStore
     folder: MyFolder
+# create or update several machines at once, overriding some options per VM
+- vsphere_template:
+    vcenter_hostname: vcenter.mydomain.local
+    username: myuser
+    password: mypass
+    template_src: mytemplate
+    resource_pool: MyResourcePool
+    datastore: MyDataStore
+    folder: MyFolder
+    max_concurrent_clones: 8
+    guests:
+      - myvm002
+      - name: myvm003
+        num_cpus: 4
+        memory_mb: 8192
+        notes: database server
+# start creating many machines without waiting, collecting them with a single
+# poll at the end of the play
+- vsphere_template:
+    vcenter_hostname: vcenter.mydomain.local
+    username: myuser
+    password: mypass
+    template_src: mytemplate
+    resource_pool: MyResourcePool
+    datastore: MyDataStore
+    folder: MyFolder
+    guests: "{{ groups['webservers'] }}"
+    wait: no
+  register: clones
 '''
 
 # import module snippets
 from ansible.module_utils.basic import *
-from pyVmomi import vim
-from pyVim.connect import SmartConnect, Disconnect
-import atexit, requests, ssl
+import fnmatch, time
+
+# imported by import_pyvmomi once the arguments have been validated
+vim = vmodl = SmartConnect = Disconnect = SoapStubAdapter = None
+
+# options which can be set per guest in the guests list, defaulting to the
+# module parameter of the same name
+GUEST_OPTIONS = ['template_src', 'datastore', 'folder', 'resource_pool',
+    'notes', 'num_cpus', 'memory_mb', 'power_on_after_clone']
+
+# identifiers of existing VMs, resolved through the search index
+VM_IDENTIFIERS = ['uuid', 'instance_uuid', 'inventory_path']
+
+# properties of VMs used by change_guest and gather_facts, prefetched in bulk
+GUEST_PROPERTIES = ['resourcePool', 'parent', 'config.name', 'config.uuid',
+    'config.instanceUuid', 'config.annotation', 'config.hardware.numCPU',
+    'config.hardware.memoryMB', 'summary.config.memorySizeMB',
+    'summary.config.numCpu', 'summary.runtime.powerState']
 
 def main():
     """Sets up the module parameters, validates them and perform the change"""
@@ -130,138 +260,868 @@ def main():
             vcenter_hostname=dict(required=True, type='str'),
             username=dict(required=True, type='str'),
             password=dict(required=True, type='str'),
-            guest=dict(required=True, type='str'),
-            template_src=dict(required=True, type='str'),
-            datastore=dict(required=True, type='str'),
-            folder=dict(required=True, type='str'),
-            resource_pool=dict(required=True, type='str'),
+            guest=dict(required=False, type='str'),
+            guests=dict(required=False, type='list'),
+            uuid=dict(required=False, type='str'),
+            instance_uuid=dict(required=False, type='str'),
+            inventory_path=dict(required=False, type='str'),
+            template_src=dict(required=False, type='list'),
+            datastore=dict(required=False, type='list'),
+            folder=dict(required=False, type='str'),
+            resource_pool=dict(required=False, type='str'),
             notes=dict(required=False, type='str', default=''),
             num_cpus=dict(required=False, type='int', default=2),
             memory_mb=dict(required=False, type='int', default=4096),
             port=dict(required=False, type='int', default=443),
             certificate_check=dict(required=False, type='bool', default=True),
-            power_on_after_clone=dict(required=False, type='bool', default=True)
+            power_on_after_clone=dict(required=False, type='bool', default=True),
+            max_concurrent_clones=dict(required=False, type='int', default=4),
+            clone_type=dict(
+                required=False,
+                type='str',
+                default='full',
+                choices=['full', 'linked', 'instant']),
+            template_snapshot=dict(required=False, type='str', default=None),
+            replicate_template=dict(required=False, type='bool', default=False),
+            datastore_placement=dict(
+                required=False,
+                type='str',
+                default='free_space',
+                choices=['free_space', 'sdrs']),
+            wait=dict(required=False, type='bool', default=True),
+            task_timeout=dict(required=False, type='int', default=0),
+            session_cache=dict(required=False, type='bool', default=False),
+            inventory_cache=dict(required=False, type='bool', default=False),
+            inventory_cache_ttl=dict(required=False, type='int', default=3600),
+            cache_dir=dict(
+                required=False, type='str', default='~/.ansible/vsphere_cache'),
+            broker_socket=dict(required=False, type='str'),
+            perf=dict(required=False, type='bool', default=False)
         ),
+        mutually_exclusive=[
+            ['guest', 'guests'],
+            ['guests', 'uuid'],
+            ['guests', 'instance_uuid'],
+            ['guests', 'inventory_path']],
+        required_one_of=[['guest', 'guests']],
         supports_check_mode=True
     )
+    if module.params['max_concurrent_clones'] < 1:
+        module.fail_json(msg='max_concurrent_clones must be at least 1')
+    if module.params['replicate_template'] and \
+        module.params['clone_type'] != 'full':
+        module.fail_json(msg='replicate_template is only supported for full '
+            'clones, as the replicas are created without snapshots')
+    specs = guest_specs(module)
+    if not module.params['wait'] and module.params['clone_type'] == 'instant' \
+        and [spec for spec in specs if spec['notes']]:
+        module.fail_json(msg='notes can only be set on instant clones if wait '
+            'is yes, as they are set once the clone has completed')
+    start = time.time()
+    broker_connect(module)
+    import_pyvmomi()
+    perf_start(module)
 
     # connect to the vCenter...
-    context = None
+    connection, session = connect(module)
+    content = connection.RetrieveContent()
+    perf_phase('lookup')
 
-    if not module.params['certificate_check']:
-        # disable urllib3 ssl warnings
-        requests.packages.urllib3.disable_warnings()
+    # resolve all objects the module needs in a single pass
+    cache_path = None
+    if module.params['inventory_cache']:
+        cache_path = cache_file(module)
+    wanted = {
+        vim.VirtualMachine: [],
+        vim.Datastore: [],
+        vim.StoragePod: [],
+        vim.Folder: [],
+        vim.ResourcePool: []}
+    for spec in specs:
+        if not has_identifier(spec):
+            wanted[vim.VirtualMachine].append(spec['name'])
+        wanted[vim.VirtualMachine].extend(
+            [name for name in spec['template_src'] if not is_pattern(name)])
+        datastores = [
+            name for name in spec['datastores'] if not is_pattern(name)]
+        wanted[vim.Datastore].extend(datastores)
+        wanted[vim.StoragePod].extend(datastores)
+        wanted[vim.Folder].append(spec['folder'])
+        wanted[vim.ResourcePool].append(spec['resource_pool'])
+    found = find_objs(
+        content, wanted, cache_path, module.params['inventory_cache_ttl'])
 
-        # disable SSL certificate verification
-        if hasattr(ssl, 'SSLContext'):
-            context = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
-            context.verify_mode = ssl.CERT_NONE
+    # validate parameters of all guests, before changing any of them
+    guests = []
+    templates = find_templates(module, content, specs, found)
+    for spec in specs:
+        objects = resolve_objs(module, spec, found)
+        objects['templates'] = templates[spec['name']]
+        guests.append((spec, objects))
 
-    try:
-        if context:
-            connection = SmartConnect(
-                host=module.params['vcenter_hostname'],
-                user=module.params['username'],
-                pwd=module.params['password'],
-                port=module.params['port'],
-                sslContext=context)
+    # is this a change of an existing machine or a new creation operation?
+    existing = []
+    clones = []
+    for spec, objects in guests:
+        if has_identifier(spec):
+            guest = find_vm(content, spec)
         else:
-            connection = SmartConnect(
-                host=module.params['vcenter_hostname'],
-                user=module.params['username'],
-                pwd=module.params['password'],
-                port=module.params['port'])
-    except:
+            guest = found[vim.VirtualMachine].get(spec['name'])
+        if guest:
+            existing.append((spec, objects, guest))
+        else:
+            clones.append((spec, objects))
+
+    # compare existing guests against a snapshot of their properties
+    perf_phase('diff')
+    results = {}
+    refresh = {}
+    snapshots = get_snapshots(content, [guest for _, _, guest in existing])
+    for spec, objects, guest in existing:
+        result = change_guest(
+            guest, snapshots[guest._moId], module, content, spec, objects)
+        results[spec['name']] = result
+        if 'ansible_facts' not in result and not result.get('failed'):
+            refresh[spec['name']] = guest
+    if clones:
+        perf_phase('lookup')
+        place_guests(module, content, clones)
+        select_templates(module, content, clones)
+    if clones and module.params['clone_type'] != 'full':
+        prepare_clone_sources(module, content, clones)
+    clone_results, new_vms = clone_guests(module, content, clones)
+    results.update(clone_results)
+    refresh.update(new_vms)
+
+    # gather the facts of all changed and created guests in one call
+    perf_phase('facts')
+    snapshots = get_snapshots(content, refresh.values())
+    for name, guest in refresh.items():
+        results[name]['ansible_facts'] = gather_facts(snapshots[guest._moId])
+    for name in new_vms:
+        results[name]['ansible_facts']['clone_type'] = \
+            module.params['clone_type']
+
+    if module.params['guest']:
+        result = results[module.params['guest']]
+        del result['name']
+        if result.get('failed'):
+            del result['failed']
+            module.fail_json(session=session, **result)
+        module.exit_json(session=session, **result)
+
+    results = [results[spec['name']] for spec in specs]
+    failed = [result['name'] for result in results if result.get('failed')]
+    if failed:
         module.fail_json(
-            msg='failed to connect to vCenter server at %s with user %s' %
-            (module.params['vcenter_hostname'], module.params['username']))
-    # and don't forget to disconnect
-    atexit.register(Disconnect, connection)
-    content = connection.RetrieveContent()
+            msg='%d of %d VMs failed: %s' %
+                (len(failed), len(results), ', '.join(failed)),
+            results=results,
+            duration=round(time.time() - start, 3),
+            session=session)
+    module.exit_json(
+        changed=len([result for result in results if result['changed']]) > 0,
+        results=results,
+        duration=round(time.time() - start, 3),
+        session=session,
+        ansible_facts={'vsphere_guests': dict(
+            (result['name'], result['ansible_facts']) for result in results)})
+
+def guest_specs(module):
+    """Returns a list of dicts with the name and options of each guest"""
+    if module.params['guest']:
+        entries = [{'name': module.params['guest']}]
+        for identifier in VM_IDENTIFIERS:
+            if module.params[identifier]:
+                entries[0][identifier] = module.params[identifier]
+    else:
+        entries = module.params['guests']
+
+    specs = []
+    for entry in entries:
+        if not isinstance(entry, dict):
+            entry = {'name': entry}
+        if not entry.get('name'):
+            module.fail_json(msg='each entry of guests requires a name')
+        unknown = [key for key in entry
+            if key not in GUEST_OPTIONS + VM_IDENTIFIERS + ['name']]
+        if unknown:
+            module.fail_json(msg='unsupported options for guest %s: %s' %
+                (entry['name'], ', '.join(unknown)))
+        if entry['name'] in [spec['name'] for spec in specs]:
+            module.fail_json(msg='guest %s is listed more than once' %
+                entry['name'])
+
+        spec = {'name': str(entry['name'])}
+        for identifier in VM_IDENTIFIERS:
+            spec[identifier] = entry.get(identifier)
+        for option in GUEST_OPTIONS:
+            spec[option] = entry.get(option, module.params[option])
+            if spec[option] is None:
+                module.fail_json(msg='missing required argument %s for guest %s'
+                    % (option, spec['name']))
+        try:
+            spec['num_cpus'] = int(spec['num_cpus'])
+            spec['memory_mb'] = int(spec['memory_mb'])
+        except ValueError:
+            module.fail_json(msg='num_cpus and memory_mb of guest %s need to be '
+                'integers' % spec['name'])
+        spec['power_on_after_clone'] = module.boolean(
+            spec['power_on_after_clone'])
+        for option in ['template_src', 'datastore']:
+            if not isinstance(spec[option], list):
+                spec[option] = [
+                    name.strip() for name in str(spec[option]).split(',')]
+        # the datastore is only known up front if a single one is given
+        spec['datastores'] = spec['datastore']
+        spec['datastore'] = None
+        if len(spec['datastores']) == 1 and \
+            not is_pattern(spec['datastores'][0]):
+            spec['datastore'] = spec['datastores'][0]
+        if module.params['replicate_template'] and \
+            is_pattern(spec['template_src'][0]):
+            module.fail_json(msg=('replicate_template requires the first ' +
+                'entry of template_src of guest %s to be a name, not a ' +
+                'pattern') % spec['name'])
+        specs.append(spec)
+    return specs
+
+def has_identifier(spec):
+    """Returns True if the guest is identified by more than its name"""
+    return len([key for key in VM_IDENTIFIERS if spec.get(key)]) > 0
+
+def resolve_objs(module, spec, found):
+    """Returns the objects the options of a guest refer to or fails"""
+    storage_pods = []
+    for name in spec['datastores']:
+        if is_pattern(name):
+            continue
+        if name in found[vim.StoragePod]:
+            storage_pods.append(found[vim.StoragePod][name])
+        elif name not in found[vim.Datastore]:
+            module.fail_json(
+                msg='datastore %s not found on vCenter server at %s' %
+                (name, module.params['vcenter_hostname']))
 
-    # validate parameters
-    template = get_obj(
-        content,
-        [vim.VirtualMachine],
-        module.params['template_src'])
-    if not template:
-        module.fail_json(msg='template "%s" not found on vCenter server at %s' %
-            (module.params['template_src'], module.params['vcenter_hostname']))
-
-    datastore = get_obj(content, [vim.Datastore], module.params['datastore'])
-    if not datastore:
-        module.fail_json(msg='datastore %s not found on vCenter server at %s' %
-            (module.params['datastore'], module.params['vcenter_hostname']))
-
-    folder = get_obj(content, [vim.Folder], module.params['folder'])
+    # datastore clusters, lists and patterns are resolved by place_guests
+    datastore = None
+    if spec['datastore'] and not storage_pods:
+        datastore = found[vim.Datastore][spec['datastore']]
+    else:
+        spec['datastore'] = None
+
+    folder = found[vim.Folder].get(spec['folder'])
     if not folder:
         module.fail_json(msg='folder %s not found on vCenter server at %s' %
-            (module.params['folder'], module.params['vcenter_hostname']))
+            (spec['folder'], module.params['vcenter_hostname']))
 
-    resource_pool = get_obj(
-        content,
-        [vim.ResourcePool],
-        module.params['resource_pool'])
+    resource_pool = found[vim.ResourcePool].get(spec['resource_pool'])
     if not resource_pool:
         module.fail_json(
             msg='resource_pool %s not found on vCenter server at %s' %
-            (module.params['resource_pool'], module.params['vcenter_hostname']))
+            (spec['resource_pool'], module.params['vcenter_hostname']))
 
-    # is this a change of an existing machine or a new creation operation?
-    guest = get_obj(content, [vim.VirtualMachine], module.params['guest'])
-    if guest:
-        change_guest(guest, module, datastore, folder, resource_pool)
+    return {
+        'datastore': datastore,
+        'storage_pods': storage_pods,
+        'folder': folder,
+        'resource_pool': resource_pool}
+
+def replica_name(template, datastore):
+    """Returns the name of the replica of a template on a datastore"""
+    return '%s_%s' % (template, datastore)
+
+def find_templates(module, content, specs, found):
+    """Returns a dict mapping the name of each guest to a list of (template,
+    name) tuples of the replicas matching its template_src names and
+    patterns, or fails"""
+    patterns = {}
+    for spec in specs:
+        for name in spec['template_src']:
+            if is_pattern(name):
+                patterns[name] = []
+
+    # patterns are matched against a single sweep of all template names
+    if patterns:
+        vms = get_objs(content, [vim.VirtualMachine], ['name', 'config.template'])
+        vms.sort(key=lambda vm: vm[1].get('name'))
+        for vm, properties in vms:
+            if not properties.get('config.template') and \
+                module.params['clone_type'] != 'instant':
+                continue
+            for pattern in patterns:
+                if fnmatch.fnmatchcase(properties.get('name', ''), pattern):
+                    patterns[pattern].append((vm, properties['name']))
+
+    templates = {}
+    for spec in specs:
+        candidates = []
+        for name in spec['template_src']:
+            if is_pattern(name):
+                matches = patterns[name]
+            elif name in found[vim.VirtualMachine]:
+                matches = [(found[vim.VirtualMachine][name], name)]
+            else:
+                matches = []
+            for template, template_name in matches:
+                if template not in [vm for vm, _ in candidates]:
+                    candidates.append((template, template_name))
+        if not candidates:
+            module.fail_json(
+                msg='template "%s" not found on vCenter server at %s' %
+                (', '.join(spec['template_src']),
+                module.params['vcenter_hostname']))
+        templates[spec['name']] = candidates
+    return templates
+
+def place_guests(module, content, clones):
+    """Chooses the target datastore of new guests with a list or pattern of
+    datastores or a datastore cluster, which is stored in their objects
+
+    Unless datastore_placement is set to sdrs, the accessible datastore with
+    the most free space is chosen, based on a single bulk read of the free
+    space of all datastores. The space reserved by clones already placed in
+    the same run is subtracted, so these spread over the datastores, whatever
+    the clone_type."""
+    pending = [(spec, objects) for spec, objects in clones
+        if objects['datastore'] is None]
+    if not pending:
+        return
+
+    datastores = get_objs(content, [vim.Datastore], ['name', 'parent',
+        'summary.freeSpace', 'summary.capacity', 'summary.accessible',
+        'summary.maintenanceMode'])
+
+    # full clones need about the committed space of their template, linked
+    # and instant clones share its disks and need about their memory for the
+    # swap file, until their delta disks grow
+    sizes = {}
+    if module.params['clone_type'] == 'full':
+        templates = {}
+        for _, objects in pending:
+            for template, _ in objects['templates']:
+                templates[template._moId] = template
+        sizes = dict(
+            (template._moId, properties.get('summary.storage.committed', 0))
+            for template, properties in get_props(content, templates.values(),
+                ['summary.storage.committed']))
+
+    reserved = {}
+    for spec, objects in pending:
+        if module.params['clone_type'] == 'full':
+            required = max([sizes.get(template._moId, 0)
+                for template, _ in objects['templates']])
+        else:
+            required = spec['memory_mb'] * 1024 * 1024
+
+        if module.params['datastore_placement'] == 'sdrs' and \
+            objects['storage_pods']:
+            datastore = recommend_datastore(
+                module, content, spec, objects, objects['storage_pods'][0])
+            objects['datastore'] = datastore
+            spec['datastore'] = datastore.name
+            objects['placement'] = {
+                'datastore': spec['datastore'],
+                'reason': 'recommended by storage DRS'}
+            continue
+
+        candidates = []
+        for datastore, properties in datastores:
+            if not properties.get('summary.accessible') or \
+                properties.get('summary.maintenanceMode', 'normal') != 'normal':
+                continue
+            for name in spec['datastores']:
+                if fnmatch.fnmatchcase(properties['name'], name) or \
+                    properties.get('parent') in objects['storage_pods']:
+                    candidates.append((datastore, properties))
+                    break
+        if not candidates:
+            module.fail_json(msg=('no accessible datastore matching %s ' +
+                'found for guest %s') %
+                (', '.join(spec['datastores']), spec['name']))
+
+        free = lambda candidate: candidate[1]['summary.freeSpace'] - \
+            reserved.get(candidate[0]._moId, 0)
+        datastore, properties = max(candidates, key=free)
+        if free((datastore, properties)) < required:
+            module.fail_json(msg=('not enough free space on the datastores ' +
+                'matching %s for guest %s, %d bytes required') %
+                (', '.join(spec['datastores']), spec['name'], required))
+        reserved[datastore._moId] = reserved.get(datastore._moId, 0) + required
+
+        objects['datastore'] = datastore
+        spec['datastore'] = properties['name']
+        objects['placement'] = {
+            'datastore': spec['datastore'],
+            'free_space': free((datastore, properties)) + required,
+            'capacity': properties['summary.capacity'],
+            'reason': 'most free space of %d candidate datastore(s)' %
+                len(candidates)}
+
+def recommend_datastore(module, content, spec, objects, storage_pod):
+    """Returns the datastore storage DRS recommends for a new guest"""
+    template = objects['templates'][0][0]
+    relospec = vim.vm.RelocateSpec()
+    relospec.pool = objects['resource_pool']
+    clonespec = vim.vm.CloneSpec()
+    clonespec.location = relospec
+    clonespec.powerOn = False
+    clonespec.template = False
+    placement = vim.storageDrs.StoragePlacementSpec()
+    placement.type = 'clone'
+    placement.cloneName = spec['name']
+    placement.folder = objects['folder']
+    placement.vm = template
+    placement.cloneSpec = clonespec
+    placement.podSelectionSpec = vim.storageDrs.PodSelectionSpec(
+        storagePod=storage_pod)
+    try:
+        result = content.storageResourceManager.RecommendDatastores(
+            storageSpec=placement)
+    except vmodl.MethodFault as error:
+        module.fail_json(msg='storage DRS failed to recommend a datastore ' +
+            'for guest %s: %s' % (spec['name'], error.msg))
+    for recommendation in result.recommendations:
+        for action in recommendation.action:
+            if getattr(action, 'destination', None):
+                return action.destination
+    module.fail_json(msg='storage DRS did not recommend a datastore for ' +
+        'guest %s' % spec['name'])
 
+def select_templates(module, content, clones):
+    """Selects the template replica to clone each new guest from
+
+    A replica on the target datastore is preferred, as it allows the storage
+    array to offload the copy, followed by one on the same storage array. If
+    replicate_template is set and no replica exists on the target datastore,
+    one is created there. The chosen template and the reason for choosing it
+    are stored in the objects of the guest."""
+    candidates = {}
+    for spec, objects in clones:
+        if len(objects['templates']) == 1 and \
+            not module.params['replicate_template']:
+            objects['template'], name = objects['templates'][0]
+            objects['template_source'] = {
+                'name': name,
+                'reason': 'only matching template'}
+        else:
+            for template, _ in objects['templates']:
+                candidates[template._moId] = template
+    if not candidates:
+        return
+
+    # read the location of all candidates and the arrays they live on at once
+    templates = dict(
+        (template._moId, properties)
+        for template, properties in get_props(
+            content, candidates.values(), ['name', 'parent', 'datastore']))
+
+    # replicas created by earlier runs live next to the first candidate
+    if module.params['replicate_template']:
+        found = {}
+        for spec, objects in clones:
+            if 'template' in objects:
+                continue
+            name = replica_name(spec['template_src'][0], spec['datastore'])
+            if name not in found:
+                parent = templates[objects['templates'][0][0]._moId]['parent']
+                found[name] = content.searchIndex.FindChild(
+                    entity=parent, name=name)
+            replica = found[name]
+            if replica and replica not in \
+                [template for template, _ in objects['templates']]:
+                objects['templates'].append((replica, name))
+        replicas = [replica for replica in found.values()
+            if replica and replica._moId not in templates]
+        if replicas:
+            templates.update(dict(
+                (template._moId, properties)
+                for template, properties in get_props(
+                    content, replicas, ['name', 'parent', 'datastore'])))
+    datastores = {}
+    for _, objects in clones:
+        datastores[objects['datastore']._moId] = objects['datastore']
+    for properties in templates.values():
+        for datastore in properties.get('datastore', []):
+            datastores[datastore._moId] = datastore
+    arrays = dict(
+        (datastore._moId, storage_array(properties))
+        for datastore, properties in get_props(
+            content, datastores.values(), ['name', 'info']))
+
+    replicas = {}
+    for spec, objects in clones:
+        if 'template' in objects:
+            continue
+        target = objects['datastore']
+        near = None
+        for template, _ in objects['templates']:
+            locations = templates[template._moId].get('datastore', [])
+            if target in locations:
+                objects['template'] = template
+                objects['template_source'] = {
+                    'name': templates[template._moId]['name'],
+                    'reason': 'replica on the target datastore %s' %
+                        spec['datastore']}
+                break
+            if near is None and arrays[target._moId] and [datastore
+                for datastore in locations
+                if arrays[datastore._moId] == arrays[target._moId]]:
+                near = template
+        if 'template' in objects:
+            continue
+
+        if near is not None:
+            source = near
+            reason = 'replica on the same storage array as the target ' + \
+                'datastore %s' % spec['datastore']
+        else:
+            source = objects['templates'][0][0]
+            reason = 'no replica near the target datastore %s' % \
+                spec['datastore']
+        objects['template'] = source
+        objects['template_source'] = {
+            'name': templates[source._moId]['name'],
+            'reason': reason}
+
+        if module.params['replicate_template']:
+            name = replica_name(spec['template_src'][0], spec['datastore'])
+            if name not in replicas:
+                replicas[name] = (source, target, [])
+            replicas[name][2].append(objects)
+
+    # create the missing replicas concurrently and clone from them
+    running = {}
+    for name, (source, target, guests) in replicas.items():
+        if module.check_mode:
+            for objects in guests:
+                objects['template_source']['reason'] += \
+                    ', replica %s would have been created' % name
+            continue
+        relospec = vim.vm.RelocateSpec()
+        relospec.datastore = target
+        clonespec = vim.vm.CloneSpec()
+        clonespec.location = relospec
+        clonespec.powerOn = False
+        clonespec.template = True
+        task = source.Clone(
+            folder=templates[guests[0]['templates'][0][0]._moId]['parent'],
+            name=name,
+            spec=clonespec)
+        running[task._moId] = (task, name, guests)
+    if running:
+        done = wait_for_tasks(
+            module,
+            content,
+            [task for task, _, _ in running.values()],
+            module.params['task_timeout'])
+        for moid, info in done.items():
+            task, name, guests = running[moid]
+            if info['state'] == 'error':
+                module.fail_json(
+                    msg='failed to create the template replica %s: %s' %
+                    (name, task_error_msg(info['error'])),
+                    tasks=[task_summary(info)])
+            for objects in guests:
+                objects['template'] = info['result']
+                objects['template_source'] = {
+                    'name': name,
+                    'reason': 'replica created on the target datastore'}
+
+def storage_array(properties):
+    """Returns an identifier of the storage array backing a datastore, the
+    NFS server or the vendor and array part of the NAA id of the first VMFS
+    extent, or None if unknown"""
+    info = properties.get('info')
+    if isinstance(info, vim.host.NasDatastoreInfo) and info.nas:
+        return 'nfs:%s' % info.nas.remoteHost
+    if isinstance(info, vim.host.VmfsDatastoreInfo) and info.vmfs and \
+        info.vmfs.extent:
+        disk = info.vmfs.extent[0].diskName
+        # naa.6 + vendor OUI + the array specific prefix of the serial number
+        if disk.startswith('naa.6') and len(disk) > 24:
+            return disk[:24]
+    return None
+
+def clone_guests(module, content, clones):
+    """Creates the new guests, keeping at most max_concurrent_clones clone
+    tasks running at once unless wait is no, and returns dicts of their
+    results and of the new VMs by name"""
+    results = {}
+    new_vms = {}
+    pending = list(clones)
+    running = {}
+    while pending or running:
+        while pending and (not module.params['wait'] or
+            len(running) < module.params['max_concurrent_clones']):
+            spec, objects = pending.pop(0)
+            if module.check_mode:
+                results[spec['name']] = {
+                    'name': spec['name'],
+                    'changed': True,
+                    'changes': [
+                        'vm %s would have been created, if not running in '
+                        'check mode' % spec['name']],
+                    'tasks': [],
+                    'template_source': objects['template_source'],
+                    'ansible_facts': {}}
+                if 'placement' in objects:
+                    results[spec['name']]['placement'] = objects['placement']
+                continue
+            previous = perf_phase('task_submit')
+            try:
+                if module.params['clone_type'] == 'instant':
+                    task = objects['template'].InstantClone_Task(
+                        spec=instant_clone_spec(spec, objects))
+                else:
+                    task = objects['template'].Clone(
+                        folder=objects['folder'],
+                        name=spec['name'],
+                        spec=clone_spec(spec, objects))
+            except vmodl.MethodFault as error:
+                results[spec['name']] = {
+                    'name': spec['name'],
+                    'failed': True,
+                    'msg': task_error_msg(error),
+                    'changed': False,
+                    'changes': [],
+                    'tasks': []}
+                continue
+            finally:
+                perf_phase(previous)
+            if not module.params['wait']:
+                results[spec['name']] = {
+                    'name': spec['name'],
+                    'changed': True,
+                    'changes': ['creation of vm %s has been started' %
+                        spec['name']],
+                    'tasks': [task_handle(task)],
+                    'template_source': objects['template_source'],
+                    'ansible_facts': {}}
+                if 'placement' in objects:
+                    results[spec['name']]['placement'] = objects['placement']
+                continue
+            running[task._moId] = (spec, objects, task)
+
+        if not running:
+            break
+        done = wait_for_tasks(
+            module,
+            content,
+            [task for _, _, task in running.values()],
+            module.params['task_timeout'],
+            first=True,
+            partial=True)
+        if not done:
+            # the clones keep running and can be collected with
+            # vsphere_task_status, those not started yet aren't started
+            for spec, objects, task in running.values():
+                results[spec['name']] = {
+                    'name': spec['name'],
+                    'failed': True,
+                    'msg': 'timed out after %d seconds waiting for the '
+                        'creation of vm %s to complete' %
+                        (module.params['task_timeout'], spec['name']),
+                    'changed': True,
+                    'changes': ['creation of vm %s has been started' %
+                        spec['name']],
+                    'tasks': [task_handle(task)],
+                    'template_source': objects['template_source']}
+                if 'placement' in objects:
+                    results[spec['name']]['placement'] = objects['placement']
+            for spec, objects in pending:
+                results[spec['name']] = {
+                    'name': spec['name'],
+                    'failed': True,
+                    'msg': 'vm %s was not created, as the clones before it '
+                        'timed out' % spec['name'],
+                    'changed': False,
+                    'changes': [],
+                    'tasks': []}
+            break
+        for moid, info in done.items():
+            spec, objects, task = running.pop(moid)
+            if info['state'] == 'error':
+                results[spec['name']] = {
+                    'name': spec['name'],
+                    'failed': True,
+                    'msg': task_error_msg(info['error']),
+                    'changed': False,
+                    'changes': [],
+                    'tasks': [task_summary(info)]}
+            else:
+                results[spec['name']] = {
+                    'name': spec['name'],
+                    'changed': True,
+                    'changes': ['vm %s has been created' % spec['name']],
+                    'tasks': [task_summary(info)],
+                    'template_source': objects['template_source']}
+                if 'placement' in objects:
+                    results[spec['name']]['placement'] = objects['placement']
+                new_vms[spec['name']] = info['result']
+
+                # instant clones can't be annotated while being created
+                if module.params['clone_type'] == 'instant' and spec['notes']:
+                    conf = vim.vm.ConfigSpec(annotation=spec['notes'])
+                    previous = perf_phase('task_submit')
+                    task = info['result'].ReconfigVM_Task(spec=conf)
+                    perf_phase(previous)
+                    info = wait_for_tasks(
+                        module,
+                        content,
+                        [task],
+                        module.params['task_timeout'],
+                        partial=True).get(task._moId)
+                    if info is None:
+                        results[spec['name']]['tasks'].append(
+                            task_handle(task))
+                        results[spec['name']]['failed'] = True
+                        results[spec['name']]['msg'] = 'timed out after ' \
+                            '%d seconds waiting for the notes to be set' % \
+                            module.params['task_timeout']
+                        continue
+                    results[spec['name']]['tasks'].append(task_summary(info))
+                    if info['state'] == 'error':
+                        results[spec['name']]['failed'] = True
+                        results[spec['name']]['msg'] = \
+                            task_error_msg(info['error'])
+    return results, new_vms
+
+def prepare_clone_sources(module, content, clones):
+    """Validates the templates of linked and instant clones and selects the
+    snapshot linked clones are based on"""
+    clone_type = module.params['clone_type']
+    if clone_type == 'instant':
+        version = content.about.apiVersion.split('.')
+        if not hasattr(vim.vm, 'InstantCloneSpec') or \
+            [int(part) for part in version[:2]] < [6, 7]:
+            module.fail_json(msg='instant clones require vCenter 6.7 or ' +
+                'later, the vCenter server at %s runs API version %s' %
+                (module.params['vcenter_hostname'], content.about.apiVersion))
+
+    templates = dict(
+        (objects['template']._moId, objects['template'])
+        for _, objects in clones)
+    properties = dict(
+        (template._moId, snapshot)
+        for template, snapshot in get_props(content, templates.values(), [
+            'snapshot', 'summary.runtime.powerState',
+            'config.hardware.numCPU', 'config.hardware.memoryMB']))
+
+    for spec, objects in clones:
+        source = properties[objects['template']._moId]
+        if clone_type == 'linked':
+            objects['snapshot'] = find_snapshot(
+                source.get('snapshot'), module.params['template_snapshot'])
+            if not objects['snapshot']:
+                module.fail_json(
+                    msg=('snapshot %s of template %s not found, linked ' +
+                    'clones require a snapshot of the template') %
+                    (module.params['template_snapshot'] or 'latest',
+                    objects['template_source']['name']))
+        else:
+            if source['summary.runtime.powerState'] != 'poweredOn':
+                module.fail_json(msg='instant clones require a running ' +
+                    'parent VM, but %s is %s' % (
+                    objects['template_source']['name'],
+                    source['summary.runtime.powerState']))
+            if source['config.hardware.numCPU'] != spec['num_cpus'] or \
+                source['config.hardware.memoryMB'] != spec['memory_mb']:
+                module.fail_json(msg=('instant clones inherit the hardware ' +
+                    'of their parent VM, %s has %d CPUs and %d MB memory, ' +
+                    'but guest %s requests %d CPUs and %d MB memory') %
+                    (objects['template_source']['name'],
+                    source['config.hardware.numCPU'],
+                    source['config.hardware.memoryMB'], spec['name'],
+                    spec['num_cpus'], spec['memory_mb']))
+
+def find_snapshot(snapshot_info, name):
+    """Returns the snapshot with the given name, the current snapshot if no
+    name is given or None if there is no such snapshot"""
+    if not snapshot_info:
+        return None
+    if not name:
+        return snapshot_info.currentSnapshot
+    trees = list(snapshot_info.rootSnapshotList)
+    while trees:
+        tree = trees.pop(0)
+        if tree.name == name:
+            return tree.snapshot
+        trees.extend(tree.childSnapshotList)
+    return None
+
+def clone_spec(spec, objects):
+    """Returns the clone specification for a new guest"""
     # prepare relocation specification
     relospec = vim.vm.RelocateSpec()
-    relospec.datastore = datastore
-    relospec.pool = resource_pool
+    relospec.datastore = objects['datastore']
+    relospec.pool = objects['resource_pool']
 
     # prepare VM configuration
     vmconf = vim.vm.ConfigSpec()
-    vmconf.numCPUs = module.params['num_cpus']
-    vmconf.memoryMB = module.params['memory_mb']
+    vmconf.numCPUs = spec['num_cpus']
+    vmconf.memoryMB = spec['memory_mb']
     vmconf.cpuHotAddEnabled = False
     vmconf.memoryHotAddEnabled = False
-    vmconf.annotation = module.params['notes']
+    vmconf.annotation = spec['notes']
+    if spec['uuid']:
+        vmconf.uuid = spec['uuid']
+    if spec['instance_uuid']:
+        vmconf.instanceUuid = spec['instance_uuid']
 
     # prepare the clones specification
     clonespec = vim.vm.CloneSpec()
     clonespec.location = relospec
     clonespec.config = vmconf
-    clonespec.powerOn = module.params['power_on_after_clone']
+    clonespec.powerOn = spec['power_on_after_clone']
     clonespec.template = False # the clone itself will not be a template
 
-    if module.check_mode:
-        changes = [
-            'vm %s would have been created, if not running in check mode' %
-            module.params['guest']]
-    else:
-        task = template.Clone(
-            folder=folder,
-            name=module.params['guest'],
-            spec=clonespec)
-        new_vm = wait_for_task(module, task)
-        changes = ['vm %s has been created' % module.params['guest']]
+    # linked clones only get delta disks, backed by the templates snapshot
+    if 'snapshot' in objects:
+        relospec.diskMoveType = 'createNewChildDiskBacking'
+        clonespec.snapshot = objects['snapshot']
+    return clonespec
 
-    module.exit_json(
-        changed=True,
-        changes=changes,
-        ansible_facts=gather_facts(new_vm))
-
-def change_guest(
-    guest,
-    module,
-    datastore,
-    folder,
-    resource_pool):
-    """Reconfigures guest and exits with the result"""
-    changes = []
+def instant_clone_spec(spec, objects):
+    """Returns the instant clone specification for a new guest"""
+    relospec = vim.vm.RelocateSpec()
+    relospec.datastore = objects['datastore']
+    relospec.pool = objects['resource_pool']
+    relospec.folder = objects['folder']
+
+    clonespec = vim.vm.InstantCloneSpec()
+    clonespec.name = spec['name']
+    clonespec.location = relospec
+
+    # the hardware is inherited from the parent VM, but not its UUIDs
+    if spec['uuid'] or spec['instance_uuid']:
+        vmconf = vim.vm.ConfigSpec()
+        if spec['uuid']:
+            vmconf.uuid = spec['uuid']
+        if spec['instance_uuid']:
+            vmconf.instanceUuid = spec['instance_uuid']
+        clonespec.config = vmconf
+    return clonespec
+
+def change_guest(guest, snapshot, module, content, spec, objects):
+    """Reconfigures guest and returns the result
+
+    The changes are detected based on the snapshot of the guests properties.
+    The facts are only included in the result if the guest was left
+    unchanged, otherwise they need to be gathered after the change."""
+    result = {
+        'name': spec['name'],
+        'changed': False,
+        'changes': [],
+        'tasks': []}
+    changes = result['changes']
     relocation_required = False
     reconfiguration_required = False
     requires_shutdown = False
     relocation_spec = vim.vm.RelocateSpec()
     virtualmachine_conf = vim.vm.ConfigSpec()
+    resource_pool = objects['resource_pool']
+    folder = objects['folder']
 
     # This works as long as there is only one datastore.
     # For VMDKs on multiple datastores or raw LUNs, this may cause
@@ -272,105 +1132,739 @@ def change_guest(
     #    relocation_spec.datastore = datastore
     #    relocation_required = True
 
-    if guest.resourcePool.name != resource_pool.name:
+    # the references are compared, names are only read to report a change
+    if snapshot.get('resourcePool') != resource_pool:
         changes.append('Relocate VM from resource pool %s to %s' %
-            (guest.resourcePool.name, resource_pool.name))
+            (snapshot['resourcePool'].name, spec['resource_pool']))
         relocation_spec.pool = resource_pool
         relocation_required = True
 
-    if guest.parent.name != folder.name:
+    if snapshot.get('parent') != folder:
         changes.append('Relocate VM from folder %s to %s' %
-            (guest.folder.name, folder.name))
+            (snapshot['parent'].name, spec['folder']))
         relocation_spec.folder = folder
         relocation_required = True
 
-    if guest.config.annotation != module.params['notes']:
+    annotation = snapshot.get('config.annotation', '')
+    if annotation != spec['notes']:
         changes.append('Change configured annotation of VM from "%s" to "%s"' %
-            (guest.config.annotation, module.params['notes']))
-        virtualmachine_conf.annotation = module.params['notes']
+            (annotation, spec['notes']))
+        virtualmachine_conf.annotation = spec['notes']
         reconfiguration_required = True
 
-    if guest.config.hardware.numCPU != module.params['num_cpus']:
+    if snapshot['config.hardware.numCPU'] != spec['num_cpus']:
         changes.append('Change configured number of CPUs of VM from %d to %d' %
-            (guest.config.hardware.numCPU, module.params['num_cpus']))
-        virtualmachine_conf.numCPUs = module.params['num_cpus']
+            (snapshot['config.hardware.numCPU'], spec['num_cpus']))
+        virtualmachine_conf.numCPUs = spec['num_cpus']
         reconfiguration_required = True
         requires_shutdown = True
 
-    if guest.config.hardware.memoryMB != module.params['memory_mb']:
+    if snapshot['config.hardware.memoryMB'] != spec['memory_mb']:
         changes.append('Change configured memory in MB of VM from %d to %d' %
-            (guest.config.hardware.memoryMB, module.params['memory_mb']))
-        virtualmachine_conf.memoryMB = module.params['memory_mb']
+            (snapshot['config.hardware.memoryMB'], spec['memory_mb']))
+        virtualmachine_conf.memoryMB = spec['memory_mb']
         reconfiguration_required = True
         requires_shutdown = True
 
     if len(changes) > 0:
         if  requires_shutdown and \
-            guest.summary.runtime.powerState == 'poweredOn':
-            module.fail_json(
-                msg=('VM %s is powered on and virtual hardware changes have ' +
-                'been detected. Please shutdown the VM and rerun this action ' +
-                'to apply the following changes: %s') %
-                (module.params['guest'], ', '.join(changes)))
+            snapshot['summary.runtime.powerState'] == 'poweredOn':
+            result['failed'] = True
+            result['msg'] = ('VM %s is powered on and virtual hardware ' +
+                'changes have been detected. Please shutdown the VM and ' +
+                'rerun this action to apply the following changes: %s') % \
+                (spec['name'], ', '.join(changes))
+            return result
+        result['changed'] = True
+        if module.check_mode:
+            changes.append('These changes were detected, but not ' +
+            'applied, due to running in check mode')
         else:
-            if module.check_mode:
-                changes.append('These changes were detected, but not ' +
-                'applied, due to running in check mode')
-            else:
-                if relocation_required:
-                    task = guest.RelocateVM_Task(spec=relocation_spec)
-                    wait_for_task(module, task)
-                if reconfiguration_required:
-                    task = guest.ReconfigVM_Task(spec=virtualmachine_conf)
-                    wait_for_task(module, task)
-            module.exit_json(
-                changed=True,
-                changes=changes,
-                ansible_facts=gather_facts(guest))
-    else:
-        module.exit_json(
-            changed=False,
-            ansible_facts=gather_facts(guest))
-
-def get_obj(content, vimtype, name):
-    """Returns an object based on it's vimtype and name"""
-    obj = None
-    container = content.viewManager.CreateContainerView(
-        content.rootFolder, vimtype, True)
-    for element in container.view:
-        if element.name == name:
-            obj = element
-            break
-    return obj
-
-def wait_for_task(module, task):
-    """Wait for a task to complete"""
-    # set generic message
-    error_msg = 'an error occurred while waiting for the task to complete'
-    task_done = False
-    while not task_done:
-        if task.info.state == 'success':
-            return task.info.result
-
-        if task.info.state == 'error':
-            if isinstance(task.info.error, vim.fault.DuplicateName):
-                error_msg = 'an object with the name %s already exists' % \
-                    task.info.error.name
-            module.fail_json(msg=error_msg)
-
-def gather_facts(virtualmachine):
-    """Set ansible_facts based on a VMs configuration"""
-    memory_mb = virtualmachine.summary.config.memorySizeMB
+            operations = []
+            if relocation_required:
+                operations.append(
+                    lambda: guest.RelocateVM_Task(spec=relocation_spec))
+            if reconfiguration_required:
+                operations.append(
+                    lambda: guest.ReconfigVM_Task(spec=virtualmachine_conf))
+            for index, operation in enumerate(operations):
+                previous = perf_phase('task_submit')
+                task = operation()
+                perf_phase(previous)
+                if not module.params['wait'] and \
+                    index == len(operations) - 1:
+                    # facts gathered now would be outdated once it completed
+                    result['tasks'].append(task_handle(task))
+                    result['ansible_facts'] = {}
+                    return result
+                info = wait_for_tasks(
+                    module,
+                    content,
+                    [task],
+                    module.params['task_timeout'],
+                    partial=True).get(task._moId)
+                if info is None:
+                    # the task keeps running, see vsphere_task_status
+                    result['tasks'].append(task_handle(task))
+                    result['failed'] = True
+                    result['msg'] = 'timed out after %d seconds waiting ' \
+                        'for the changes of vm %s to complete' % \
+                        (module.params['task_timeout'], spec['name'])
+                    return result
+                result['tasks'].append(task_summary(info))
+                if info['state'] == 'error':
+                    result['failed'] = True
+                    result['msg'] = task_error_msg(info['error'])
+                    return result
+            return result
+
+    result['ansible_facts'] = gather_facts(snapshot)
+    return result
+
+def get_snapshots(content, guests):
+    """Returns a dict mapping the moId of each guest to a snapshot of its
+    properties, retrieved in a single call"""
+    if not guests:
+        return {}
+    return dict(
+        (guest._moId, properties)
+        for guest, properties in get_props(content, guests, GUEST_PROPERTIES))
+
+def gather_facts(snapshot):
+    """Set ansible_facts based on a snapshot of a VMs configuration"""
+    memory_mb = snapshot['summary.config.memorySizeMB']
     memory_gb = memory_mb / 1024
 
     facts = {}
-    facts['vm_uuid'] = virtualmachine.config.uuid
-    facts['vm_name'] = virtualmachine.config.name
-    facts['instance_uuid'] = virtualmachine.config.instanceUuid
+    facts['vm_uuid'] = snapshot['config.uuid']
+    facts['vm_name'] = snapshot['config.name']
+    facts['instance_uuid'] = snapshot['config.instanceUuid']
     facts['memory_mb'] = memory_mb
     facts['memory_gb'] = memory_gb
-    facts['num_cpus'] = virtualmachine.summary.config.numCpu
+    facts['num_cpus'] = snapshot['summary.config.numCpu']
 
     return facts
 
+# BEGIN vsphere_common
+# copied from common/vsphere_common.py by common/update_modules.py, edit there
+import atexit, fcntl, hashlib, json, os, socket, tempfile, time
+
+# the connection to the vsphere_broker, only set while it is available
+BROKER = {}
+
+# the performance counters of the module run, only filled if perf is set
+PERF = {}
+
+# the number of slowest SOAP requests listed in the perf result
+PERF_SLOWEST_CALLS = 5
+
+def import_pyvmomi():
+    """Imports pyVmomi and pyVim into the module globals
+
+    Loading pyVmomi and its type tables takes a good share of the runtime of
+    a short task, so it is deferred until the arguments have been validated
+    and the vCenter server is actually needed."""
+    global vim, vmodl, SmartConnect, Disconnect, SoapStubAdapter
+    from pyVmomi import vim, vmodl
+    from pyVim.connect import SmartConnect, Disconnect
+    from pyVmomi.SoapAdapter import SoapStubAdapter
+
+def connect(module):
+    """Connects to the vCenter server, reusing a cached session if enabled
+
+    Returns the service instance and a dict describing the session used,
+    with the number of logins done by this task, so their sum over a
+    playbook run shows how often the sessions were reused."""
+    context = None
+
+    if not module.params['certificate_check']:
+        import requests, ssl
+
+        # disable urllib3 ssl warnings
+        requests.packages.urllib3.disable_warnings()
+
+        # disable SSL certificate verification
+        if hasattr(ssl, 'SSLContext'):
+            context = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
+            context.verify_mode = ssl.CERT_NONE
+
+    # use the session of the broker, if there is one
+    session = broker_call('session')
+    if session:
+        connection = reuse_session(module, session, context)
+        if connection:
+            return connection, {'reused': True, 'logins': 0, 'broker': True}
+
+    if not module.params['session_cache']:
+        connection = login(module, context)
+        # and don't forget to disconnect
+        atexit.register(Disconnect, connection)
+        return connection, {'reused': False, 'logins': 1}
+
+    # try the cached session first, without holding the lock
+    cache_path = cache_file(module)
+    session = read_cache(cache_path).get('session', {})
+    connection = reuse_session(module, session, context)
+    if connection:
+        return connection, {'reused': True, 'logins': 0}
+
+    # log in while holding the lock, so concurrent forks wait for a single
+    # login and then reuse its session
+    connections = []
+    def update_session(cache):
+        session = cache.get('session', {})
+        connection = reuse_session(module, session, context)
+        if connection:
+            connections.append((connection, True))
+            return
+        connection = login(module, context)
+        connections.append((connection, False))
+        cache['session'] = {
+            'username': module.params['username'],
+            'cookie': connection._stub.cookie,
+            'version': connection._stub.version}
+    update_cache(cache_path, update_session)
+    connection, reused = connections[0]
+    # the session is kept open for the following tasks, so no disconnect here
+    return connection, {'reused': reused, 'logins': reused and 0 or 1}
+
+def login(module, context):
+    """Logs in to the vCenter server and returns the service instance"""
+    try:
+        if context:
+            return SmartConnect(
+                host=module.params['vcenter_hostname'],
+                user=module.params['username'],
+                pwd=module.params['password'],
+                port=module.params['port'],
+                sslContext=context)
+        else:
+            return SmartConnect(
+                host=module.params['vcenter_hostname'],
+                user=module.params['username'],
+                pwd=module.params['password'],
+                port=module.params['port'])
+    except:
+        module.fail_json(
+            msg='failed to connect to vCenter server at %s with user %s' %
+            (module.params['vcenter_hostname'], module.params['username']))
+
+def reuse_session(module, session, context):
+    """Returns a service instance using the cached session, or None if there
+    is no cached session for the user, it has expired or checking it fails"""
+    if session.get('username') != module.params['username'] or \
+        not session.get('cookie'):
+        return None
+
+    if context:
+        stub = SoapStubAdapter(
+            host=module.params['vcenter_hostname'],
+            port=module.params['port'],
+            version=session['version'],
+            sslContext=context)
+    else:
+        stub = SoapStubAdapter(
+            host=module.params['vcenter_hostname'],
+            port=module.params['port'],
+            version=session['version'])
+    stub.cookie = session['cookie']
+    connection = vim.ServiceInstance('ServiceInstance', stub)
+    try:
+        if connection.content.sessionManager.currentSession:
+            return connection
+    except (vmodl.MethodFault, socket.error, IOError):
+        # a new login either succeeds or reports the actual error
+        pass
+    return None
+
+def find_vm(content, identifiers):
+    """Returns the VM with the uuid, instance_uuid or inventory_path given in
+    the identifiers dict, looked up in the search index, or None"""
+    search_index = content.searchIndex
+    if identifiers.get('uuid'):
+        return search_index.FindByUuid(
+            uuid=identifiers['uuid'], vmSearch=True, instanceUuid=False)
+    if identifiers.get('instance_uuid'):
+        return search_index.FindByUuid(
+            uuid=identifiers['instance_uuid'], vmSearch=True, instanceUuid=True)
+    if identifiers.get('inventory_path'):
+        vm = search_index.FindByInventoryPath(
+            inventoryPath=identifiers['inventory_path'])
+        if isinstance(vm, vim.VirtualMachine):
+            return vm
+    return None
+
+def retrieve_properties(content, object_specs, property_specs):
+    """Returns a list of (object, properties) tuples, retrieved in bulk"""
+    return list(stream_properties(content, object_specs, property_specs))
+
+def stream_properties(content, object_specs, property_specs, page_size=None):
+    """Yields (object, properties) tuples, retrieved in bulk in pages of
+    page_size objects, or as the server sees fit, so that only a single page
+    is held in memory at once"""
+    collector = content.propertyCollector
+    filter_spec = vmodl.query.PropertyCollector.FilterSpec(
+        objectSet=object_specs,
+        propSet=property_specs)
+    options = vmodl.query.PropertyCollector.RetrieveOptions()
+    if page_size:
+        options.maxObjects = page_size
+    result = collector.RetrievePropertiesEx(
+        specSet=[filter_spec],
+        options=options)
+    while result:
+        for obj_content in result.objects:
+            properties = {}
+            for prop in obj_content.propSet:
+                properties[prop.name] = prop.val
+            yield obj_content.obj, properties
+        if not result.token:
+            break
+        result = collector.ContinueRetrievePropertiesEx(token=result.token)
+
+def get_objs(content, vimtypes, properties=None):
+    """Returns the properties (name by default) of all objects of the given
+    vimtypes, using a single container view and property collector call"""
+    if properties is None:
+        properties = ['name']
+    view = content.viewManager.CreateContainerView(
+        content.rootFolder, vimtypes, True)
+    try:
+        traversal_spec = vmodl.query.PropertyCollector.TraversalSpec(
+            name='traverseView',
+            path='view',
+            skip=False,
+            type=vim.view.ContainerView)
+        object_spec = vmodl.query.PropertyCollector.ObjectSpec(
+            obj=view,
+            skip=True,
+            selectSet=[traversal_spec])
+        property_specs = [
+            vmodl.query.PropertyCollector.PropertySpec(
+                type=vimtype,
+                pathSet=properties)
+            for vimtype in vimtypes]
+        return retrieve_properties(content, [object_spec], property_specs)
+    finally:
+        view.Destroy()
+
+def get_props(content, objs, properties):
+    """Returns a list of (object, properties) tuples for the given objects,
+    retrieved in a single property collector call"""
+    object_specs = [
+        vmodl.query.PropertyCollector.ObjectSpec(obj=obj) for obj in objs]
+    property_specs = [
+        vmodl.query.PropertyCollector.PropertySpec(
+            type=vimtype,
+            pathSet=properties)
+        for vimtype in set([type(obj) for obj in objs])]
+    return retrieve_properties(content, object_specs, property_specs)
+
+def find_objs(content, wanted, cache_path=None, cache_ttl=0):
+    """Resolves the names of objects of several vimtypes in a single pass
+
+    wanted maps vimtypes to a list of names, the returned dict maps the same
+    vimtypes to a dict of the names found and their objects. If a cache_path
+    is given, the names are looked up in the inventory index kept in that file
+    first and the vCenter inventory is only swept for the vimtypes that are
+    missing, outdated or stale in the index."""
+    index = broker_call('find', wanted=dict(
+        (vimtype._wsdlName, names) for vimtype, names in wanted.items()))
+    if index is not None:
+        stub = content.propertyCollector._stub
+        return dict(
+            (vimtype, dict(
+                (name, vimtype(moid, stub))
+                for name, moid in index[vimtype._wsdlName].items()))
+            for vimtype in wanted)
+
+    found = dict((vimtype, {}) for vimtype in wanted)
+    sweep = list(wanted.keys())
+
+    if cache_path:
+        sweep = []
+        index = read_cache(cache_path).get('inventory', {})
+        stub = content.propertyCollector._stub
+        candidates = []
+        for vimtype, names in wanted.items():
+            entry = index.get(vimtype._wsdlName)
+            if not entry or time.time() - entry['timestamp'] > cache_ttl or \
+                [name for name in names if name not in entry['objects']]:
+                sweep.append(vimtype)
+                continue
+            for name in names:
+                candidates.append(
+                    (vimtype, name, vimtype(entry['objects'][name], stub)))
+
+        # verify that the cached references still exist and carry their names
+        if candidates:
+            try:
+                current = dict(
+                    (obj._moId, properties.get('name'))
+                    for obj, properties in get_props(
+                        content, [obj for _, _, obj in candidates], ['name']))
+            except vmodl.fault.ManagedObjectNotFound:
+                current = {}
+            for vimtype, name, obj in candidates:
+                if current.get(obj._moId) == name:
+                    found[vimtype][name] = obj
+                elif vimtype not in sweep:
+                    sweep.append(vimtype)
+
+    if sweep:
+        # the views include subtypes, i.e. datastore clusters are folders and
+        # vApps resource pools, but names only resolve to objects of exactly
+        # the wanted vimtype, as they do in the index of the broker
+        objects = dict((vimtype, {}) for vimtype in sweep)
+        for obj, properties in get_objs(content, sweep):
+            if type(obj) in objects and 'name' in properties:
+                objects[type(obj)].setdefault(properties['name'], obj)
+        for vimtype in sweep:
+            found[vimtype] = dict(
+                (name, objects[vimtype][name])
+                for name in wanted[vimtype] if name in objects[vimtype])
+
+        if cache_path:
+            def update_index(cache):
+                index = cache.setdefault('inventory', {})
+                for vimtype in sweep:
+                    index[vimtype._wsdlName] = {
+                        'timestamp': time.time(),
+                        'objects': dict(
+                            (name, obj._moId)
+                            for name, obj in objects[vimtype].items())}
+            update_cache(cache_path, update_index)
+
+    return found
+
+def is_pattern(name):
+    """Returns True if the name contains shell style wildcards"""
+    return len([char for char in '*?[' if char in name]) > 0
+
+def cache_file(module):
+    """Returns the path of the cache file for the vCenter server and user in
+    use, so users neither replace each others sessions nor see inventory
+    indexes built with the permissions of another user"""
+    directory = os.path.expanduser(module.params['cache_dir'])
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+    user = hashlib.sha1(module.params['username'].encode('utf-8'))
+    return os.path.join(directory, '%s_%d_%s.json' %
+        (module.params['vcenter_hostname'], module.params['port'],
+        user.hexdigest()[:12]))
+
+def read_cache(path):
+    """Returns the contents of a cache file, empty if it is missing or broken"""
+    try:
+        cache = open(path)
+        try:
+            return json.load(cache)
+        finally:
+            cache.close()
+    except (IOError, ValueError):
+        return {}
+
+def update_cache(path, update):
+    """Applies the update function to the contents of a cache file
+
+    The file is locked for the duration of the update, to be safe against
+    concurrent forks, and atomically replaced by the updated contents."""
+    lock = open(path + '.lock', 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        cache = read_cache(path)
+        update(cache)
+        handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        temp = os.fdopen(handle, 'w')
+        try:
+            json.dump(cache, temp)
+        finally:
+            temp.close()
+        os.rename(temp_path, path)
+    finally:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
+
+def wait_for_tasks(module, content, tasks, timeout=0, first=False,
+    partial=False):
+    """Wait for tasks to complete and return a dict of their state information
+
+    Instead of polling the tasks, this blocks in WaitForUpdatesEx on the vCenter
+    server until their state or progress changes. The dict maps each completed
+    tasks moId to its state, progress, result, error and the seconds waited.
+    If first is set, it returns as soon as at least one task has completed. A
+    timeout of 0 waits forever, otherwise the module fails once it elapsed,
+    unless partial is set, which returns the tasks completed until then.
+    If the broker is available, it waits on behalf of the module."""
+    previous = perf_phase('task_wait')
+    response = broker_call('wait_tasks',
+        tasks=[task._moId for task in tasks], timeout=timeout, first=first)
+    if response is not None:
+        perf_phase(previous)
+        return broker_task_infos(module, content, response, timeout, partial)
+    collector = content.propertyCollector.CreatePropertyCollector()
+    try:
+        object_specs = [
+            vmodl.query.PropertyCollector.ObjectSpec(obj=task)
+            for task in tasks]
+        property_spec = vmodl.query.PropertyCollector.PropertySpec(
+            type=vim.Task,
+            pathSet=['info.state', 'info.progress', 'info.result',
+                'info.error'])
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec(
+            objectSet=object_specs,
+            propSet=[property_spec])
+        collector.CreateFilter(filter_spec, True)
+
+        start = time.time()
+        infos = dict(
+            (task._moId, {
+                'task': task._moId,
+                'state': None,
+                'progress': None,
+                'result': None,
+                'error': None,
+                'duration': None})
+            for task in tasks)
+        done = {}
+        version = ''
+        while len(done) < len(tasks) and not (first and done):
+            max_wait = 60
+            if timeout:
+                remaining = timeout - (time.time() - start)
+                if remaining <= 0:
+                    if partial:
+                        return done
+                    module.fail_json(
+                        msg='timed out after %d seconds waiting for %d ' \
+                            'task(s) to complete' %
+                            (timeout, len(tasks) - len(done)),
+                        tasks=[task_summary(info) for info in infos.values()])
+                max_wait = int(min(max_wait, max(remaining, 1)))
+            options = vmodl.query.PropertyCollector.WaitOptions(
+                maxWaitSeconds=max_wait)
+            update = collector.WaitForUpdatesEx(version, options)
+            if update is None:
+                continue
+            version = update.version
+            for filter_set in update.filterSet:
+                for object_set in filter_set.objectSet:
+                    info = infos[object_set.obj._moId]
+                    for change in object_set.changeSet:
+                        info[change.name.split('.', 1)[1]] = change.val
+                    if info['state'] in ['success', 'error'] and \
+                        info['task'] not in done:
+                        info['duration'] = round(time.time() - start, 3)
+                        done[info['task']] = info
+        return done
+    finally:
+        collector.Destroy()
+        perf_phase(previous)
+
+def task_error_msg(error):
+    """Returns a message describing the error of a failed task"""
+    if isinstance(error, vim.fault.DuplicateName):
+        return 'an object with the name %s already exists' % error.name
+    if getattr(error, 'msg', None):
+        return 'an error occurred while waiting for the task to complete: %s' \
+            % error.msg
+    return 'an error occurred while waiting for the task to complete'
+
+def task_summary(info):
+    """Returns the state information of a task, reduced to what can be
+    returned in the module result"""
+    return {
+        'task': info['task'],
+        'state': info['state'],
+        'progress': info['progress'],
+        'duration': info['duration']}
+
+def task_handle(task):
+    """Returns the summary of a task which is not waited for, its id can be
+    passed to vsphere_task_status to collect it later"""
+    return {
+        'task': task._moId,
+        'state': 'running',
+        'progress': None,
+        'duration': None}
+
+def broker_connect(module):
+    """Connects to the vsphere_broker listening on broker_socket, if it is set
+    and the broker is running"""
+    if not module.params['broker_socket']:
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(os.path.expanduser(module.params['broker_socket']))
+    except socket.error:
+        sock.close()
+        return
+    reader = sock.makefile('r')
+    atexit.register(broker_close, sock, reader)
+    BROKER.update({
+        'socket': sock,
+        'reader': reader,
+        'request': dict(
+            (key, module.params[key])
+            for key in ['vcenter_hostname', 'port', 'username', 'password',
+                'certificate_check'])})
+
+def broker_close(sock, reader):
+    """Closes the connection to the broker"""
+    reader.close()
+    sock.close()
+
+def broker_call(op, **request):
+    """Returns the result of a request to the broker, or None if it isn't
+    available
+
+    If the request fails, the broker isn't used for the rest of the task and
+    the module falls back to connecting directly, reporting the errors of the
+    vCenter server in its own words."""
+    if not BROKER:
+        return None
+    request.update(BROKER['request'])
+    request['op'] = op
+    start = time.time()
+    try:
+        BROKER['socket'].sendall(json.dumps(request) + '\n')
+        response = json.loads(BROKER['reader'].readline())
+    except (socket.error, ValueError):
+        response = {'error': 'connection to the broker lost'}
+    if PERF:
+        perf_call('broker.%s' % op, time.time() - start)
+    if 'error' in response:
+        broker_close(BROKER['socket'], BROKER['reader'])
+        BROKER.clear()
+        return None
+    return response['result']
+
+def broker_task_infos(module, content, response, timeout, partial=False):
+    """Returns the state information of the tasks the broker waited for like
+    wait_for_tasks does, restoring their results and errors"""
+    stub = content.propertyCollector._stub
+    infos = response['infos']
+    for info in infos.values():
+        if info['result']:
+            vimtype = getattr(
+                vim, info['result']['type'], vmodl.ManagedObject)
+            info['result'] = vimtype(info['result']['moId'], stub)
+        if info['error']:
+            fault = getattr(vim.fault, info['error']['type'], vmodl.MethodFault)
+            error = fault(msg=info['error']['msg'])
+            if info['error']['name']:
+                error.name = info['error']['name']
+            info['error'] = error
+    if response['timed_out'] and not partial:
+        module.fail_json(
+            msg='timed out after %d seconds waiting for %d task(s) to complete'
+                % (timeout, len(infos) - len(response['done'])),
+            tasks=[task_summary(info) for info in infos.values()])
+    return dict((moid, infos[moid]) for moid in response['done'])
+
+def perf_start(module):
+    """Enables the performance counters, if the perf option is set
+
+    The pyVmomi stub adapter is hooked to count, time and measure the SOAP
+    requests of all callers and the counters are added to the result of the
+    module as perf key, whether it succeeds or fails."""
+    if not module.params['perf']:
+        return
+    now = time.time()
+    PERF.update({
+        'start': now,
+        'phase': 'connect',
+        'phase_start': now,
+        'phases': {},
+        'calls': {},
+        'bytes_sent': 0,
+        'bytes_received': 0,
+        'slowest': []})
+
+    invoke_method = SoapStubAdapter.InvokeMethod
+    def timed_invoke_method(self, mo, info, args, outerStub=None):
+        start = time.time()
+        try:
+            return invoke_method(self, mo, info, args, outerStub)
+        finally:
+            perf_call(info.wsdlName, time.time() - start)
+    SoapStubAdapter.InvokeMethod = timed_invoke_method
+
+    get_connection = SoapStubAdapter.GetConnection
+    def counted_get_connection(self):
+        conn = get_connection(self)
+        if not getattr(conn, 'perf_counted', False):
+            perf_count_connection(conn)
+        return conn
+    SoapStubAdapter.GetConnection = counted_get_connection
+
+    exit_json = module.exit_json
+    fail_json = module.fail_json
+    module.exit_json = lambda **kwargs: exit_json(perf=perf_report(), **kwargs)
+    module.fail_json = lambda **kwargs: fail_json(perf=perf_report(), **kwargs)
+
+def perf_count_connection(conn):
+    """Counts the bytes of the requests and responses of a HTTP connection"""
+    request = conn.request
+    getresponse = conn.getresponse
+    def counted_request(method, url, body=None, headers={}):
+        PERF['bytes_sent'] += len(body or '')
+        return request(method, url, body, headers)
+    def counted_getresponse():
+        response = getresponse()
+        read = response.read
+        def counted_read(*args):
+            data = read(*args)
+            PERF['bytes_received'] += len(data)
+            return data
+        response.read = counted_read
+        return response
+    conn.request = counted_request
+    conn.getresponse = counted_getresponse
+    conn.perf_counted = True
+
+def perf_call(method, seconds):
+    """Records a SOAP request to the vCenter server"""
+    calls = PERF['calls'].setdefault(method, {'count': 0, 'seconds': 0.0})
+    calls['count'] += 1
+    calls['seconds'] += seconds
+    PERF['slowest'].append({
+        'method': method,
+        'phase': PERF['phase'],
+        'seconds': round(seconds, 3)})
+    PERF['slowest'].sort(key=lambda call: -call['seconds'])
+    del PERF['slowest'][PERF_SLOWEST_CALLS:]
+
+def perf_phase(name):
+    """Attributes the time from now on to the named phase and returns the
+    previous phase, so that it can be restored after a nested phase"""
+    if not PERF or name is None:
+        return None
+    now = time.time()
+    previous = PERF['phase']
+    PERF['phases'][previous] = \
+        PERF['phases'].get(previous, 0.0) + now - PERF['phase_start']
+    PERF['phase'] = name
+    PERF['phase_start'] = now
+    return previous
+
+def perf_report():
+    """Returns the performance counters, as added to the result"""
+    perf_phase(PERF['phase'])
+    return {
+        'duration': round(time.time() - PERF['start'], 3),
+        'phases': dict(
+            (name, round(seconds, 3))
+            for name, seconds in PERF['phases'].items()),
+        'requests': sum([calls['count'] for calls in PERF['calls'].values()]),
+        'calls': dict(
+            (method, {
+                'count': calls['count'],
+                'seconds': round(calls['seconds'], 3)})
+            for method, calls in PERF['calls'].items()),
+        'bytes_sent': PERF['bytes_sent'],
+        'bytes_received': PERF['bytes_received'],
+        'slowest': PERF['slowest']}
+# END vsphere_common
+
 main()
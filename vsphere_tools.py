@@ -26,7 +26,7 @@ DOCUMENTATION = '''
 module: vsphere_tools
 short_description: Checks the VMware tools status in a guest VM
 description:
-    - This module checks the VMware tools status in a guest VM, optionally upgrading them.
+    - This module checks the VMware tools status in a guest VM, optionally upgrading them. With state report it reports the tools status of all VMs in a folder or resource pool, optionally limited to VMs matching a list of names and patterns, instead. With state latest and no guest, the tools of the selected VMs are upgraded in rolling waves.
 version_added: "not yet"
 notes:
     - This module should run from a system that can access vSphere directly.
@@ -42,8 +42,57 @@ options:
     required: true
   guest:
     description:
-      - The virtual machines name you wish to create or manage.
-    required: true
+      - The virtual machines name you wish to create or manage. Either guest, uuid, instance_uuid or inventory_path is required, unless state is report.
+    required: false
+  guests:
+    description:
+      - A list of VM names or shell style patterns (i.e. web*) selecting the VMs to report on, if state is report, or to upgrade, if state is latest and guest is not set. Defaults to all VMs in the folder or resource pool.
+    required: false
+  folder:
+    description:
+      - The name of the folder whose VMs, including those in subfolders, are selected, if state is report or state is latest and guest is not set.
+    required: false
+  resource_pool:
+    description:
+      - The name of the resource pool whose VMs, including those in child pools, are selected like with folder. Mutually exclusive with folder.
+    required: false
+  wave_size:
+    description:
+      - The maximum number of VMs whose tools are upgraded at once, when upgrading a selection of VMs. Each wave is started once the tools of all VMs of the previous wave are running again, or tools_timeout elapsed. Only powered on VMs with running tools are upgraded, the others are skipped.
+    required: false
+    default: 10
+  max_upgrades_per_host:
+    description:
+      - The maximum number of VMs per ESXi host upgraded in the same wave. VMs exceeding it are moved to a later wave.
+    required: false
+    default: 2
+  max_upgrades_per_datastore:
+    description:
+      - The maximum number of VMs per datastore upgraded in the same wave, like max_upgrades_per_host.
+    required: false
+    default: 4
+  max_failure_rate:
+    description:
+      - The percentage of failed upgrades after which the rollout is stopped, checked after each wave. The VMs not upgraded yet are skipped and the module fails. Below it, failed upgrades are only reported.
+    required: false
+    default: 10
+  tools_timeout:
+    description:
+      - The number of seconds to wait for the tools of a VM to be running in the latest version after its upgrade task completed, when upgrading a selection of VMs, before counting it as failed. The module waits for the changes reported by the vCenter server instead of polling the VMs. Like task_timeout, 0 waits until the tools of all VMs of the wave are running in the latest version.
+    required: false
+    default: 600
+  uuid:
+    description:
+      - The BIOS UUID of the VM. If set, the VM is looked up by it in the vCenter search index instead of scanning all VMs for its name, which is faster on large inventories and unambiguous if names are duplicated across datacenters.
+    required: false
+  instance_uuid:
+    description:
+      - The vCenter instance UUID of the VM, used like uuid.
+    required: false
+  inventory_path:
+    description:
+      - The inventory path of the VM, i.e. MyDatacenter/vm/MyFolder/myvm001, used to look it up in the vCenter search index like uuid.
+    required: false
   username:
     description:
       - Username to connect to vCenter as.
@@ -61,12 +110,61 @@ options:
         - The port number under which the API is accessible on the vCenter server, defaults to port 443 (HTTPS).
     required: false
     default: 443
+  certificate_check:
+    description:
+        - As of PyVmomi 6.0 certificate checks are enforced for increased security, defaults to yes. May be disabled if using self signed certificates and have no way of importing it on your ansible host (unsafe).
+    required: false
+    default: yes
+    choices: ['yes', 'no']
   state:
     description:
-      - Indicates the desired tools state. `latest` ensures that the latest version is installed, upgrading the tools if necessary, while `present` only checks if they are installed.
+      - Indicates the desired tools state. `latest` ensures that the latest version is installed, upgrading the tools if necessary, while `present` only checks if they are installed. `report` sweeps the selected VMs in a single paginated property collector call, processed page by page, and returns the number of VMs per tools version status, tools running status, power state and guest family in counts, as well as the VMs whose tools need an upgrade in upgrade_required.
     required: false
     default: present
-    choices: ['present', 'latest', 'absent']
+    choices: ['present', 'latest', 'absent', 'report']
+  inventory_cache:
+    description:
+      - Keep a local index of the names and managed object references of the inventory objects the module looks up, to avoid sweeping the vCenter inventory on every run. Cached references are verified before use and the index is refreshed if one turned out to be stale or a name is missing.
+    required: false
+    default: no
+    choices: ['yes', 'no']
+  inventory_cache_ttl:
+    description:
+      - The number of seconds after which the inventory index of an object type is refreshed, defaults to one hour.
+    required: false
+    default: 3600
+  wait:
+    description:
+      - Specifies if the module should wait until the tools upgrade of guest is completed. If set to 'no', the id of the upgrade task is returned in tasks, to be collected later with vsphere_task_status. Upgrading a selection of VMs in waves always waits.
+    required: false
+    default: yes
+    choices: ['yes', 'no']
+  task_timeout:
+    description:
+      - The number of seconds to wait for a vCenter task to complete, before failing. Defaults to 0, which waits until the task has completed. In a rolling upgrade, a VM whose upgrade timed out fails with the id of its task in tasks, to be collected later with vsphere_task_status, and counts towards max_failure_rate.
+    required: false
+    default: 0
+  session_cache:
+    description:
+      - Keep the vCenter session cookie in the cache file in cache_dir and reuse it in following tasks, instead of logging in and out on every task. A new login is only done if the cached session has expired. The session in the result tells whether a session was reused and how many logins the task did, 0 or 1, which summed over the tasks of a playbook run should stay close to one.
+    required: false
+    default: no
+    choices: ['yes', 'no']
+  cache_dir:
+    description:
+      - The directory on the ansible host in which the cache files are kept, one per vCenter server and user. It is created with permissions restricted to the current user, if it doesn't exist.
+    required: false
+    default: ~/.ansible/vsphere_cache
+  broker_socket:
+    description:
+      - The path of the Unix socket of a vsphere_broker running on the ansible host, i.e. ~/.ansible/vsphere_cache/broker.sock. The module then uses the session of the broker, resolves names through its inventory index instead of sweeping the inventory and lets it wait for tasks. If the broker isn't running or a request to it fails, the module falls back to connecting directly.
+    required: false
+  perf:
+    description:
+      - Add a perf key to the result, breaking down the wall time of the module into the phases connect, lookup, diff, task_submit and task_wait, as well as report or tools_wait when reporting on or upgrading a selection of VMs. It also counts the SOAP requests to the vCenter server per method, with the seconds spent in them, the bytes sent and received and lists the slowest requests.
+    required: false
+    default: no
+    choices: ['yes', 'no']
 author:
     - Simon Rupf, based on examples by Dann Bohn
 '''
@@ -78,13 +176,62 @@ EXAMPLES = '''
     password: mypass
     guest: myvm001
     state: latest
+# report the tools status of all web servers in a folder
+- vsphere_tools:
+    vcenter_hostname: vcenter.mydomain.local
+    username: myuser
+    password: mypass
+    folder: Production
+    guests:
+      - web*
+    state: report
+  register: tools_report
+# upgrade the tools of all VMs in a resource pool, five at a time and at most
+# one per ESXi host, stopping if more than one in twenty fails
+- vsphere_tools:
+    vcenter_hostname: vcenter.mydomain.local
+    username: myuser
+    password: mypass
+    resource_pool: Production
+    state: latest
+    wave_size: 5
+    max_upgrades_per_host: 1
+    max_failure_rate: 5
+# start the tools upgrade without waiting for it
+- vsphere_tools:
+    vcenter_hostname: vcenter.mydomain.local
+    username: myuser
+    password: mypass
+    guest: myvm001
+    state: latest
+    wait: no
+  register: upgrade
 '''
 
 # import module snippets
 from ansible.module_utils.basic import *
-from pyVmomi import vim
-from pyVim.connect import SmartConnect, Disconnect
-import atexit
+import fnmatch, time
+
+# imported by import_pyvmomi once the arguments have been validated
+vim = vmodl = SmartConnect = Disconnect = SoapStubAdapter = None
+
+# tools version states requiring an upgrade
+UPGRADE_STATUSES = ['guestToolsBlacklisted', 'guestToolsNeedUpgrade',
+    'guestToolsNotInstalled', 'guestToolsSupportedOld', 'guestToolsTooOld']
+
+# properties of VMs counted in a report and the keys they are reported as
+REPORT_PROPERTIES = {
+    'guest.toolsVersionStatus2': 'version_status',
+    'guest.toolsRunningStatus': 'running_status',
+    'runtime.powerState': 'power_state',
+    'guest.guestFamily': 'guest_family'}
+
+# properties of VMs deciding if and when their tools can be upgraded
+UPGRADE_PROPERTIES = ['guest.toolsVersionStatus2', 'guest.toolsRunningStatus',
+    'runtime.powerState', 'runtime.host', 'datastore']
+
+# number of VMs retrieved per page when sweeping VMs for a report
+PAGE_SIZE = 1000
 
 def main():
     """Sets up the module parameters, validates them and perform the task"""
@@ -94,43 +241,143 @@ def main():
             vcenter_hostname=dict(required=True, type='str'),
             username=dict(required=True, type='str'),
             password=dict(required=True, type='str'),
-            guest=dict(required=True, type='str'),
+            guest=dict(required=False, type='str'),
+            guests=dict(required=False, type='list'),
+            folder=dict(required=False, type='str'),
+            resource_pool=dict(required=False, type='str'),
+            uuid=dict(required=False, type='str'),
+            instance_uuid=dict(required=False, type='str'),
+            inventory_path=dict(required=False, type='str'),
             state=dict(required=True, type='str'),
             installer_options=dict(required=False, type='str', default=''),
-            port=dict(required=False, type='int', default=443)
+            port=dict(required=False, type='int', default=443),
+            certificate_check=dict(required=False, type='bool', default=True),
+            wait=dict(required=False, type='bool', default=True),
+            task_timeout=dict(required=False, type='int', default=0),
+            session_cache=dict(required=False, type='bool', default=False),
+            inventory_cache=dict(required=False, type='bool', default=False),
+            inventory_cache_ttl=dict(required=False, type='int', default=3600),
+            wave_size=dict(required=False, type='int', default=10),
+            max_upgrades_per_host=dict(required=False, type='int', default=2),
+            max_upgrades_per_datastore=dict(
+                required=False, type='int', default=4),
+            max_failure_rate=dict(required=False, type='int', default=10),
+            tools_timeout=dict(required=False, type='int', default=600),
+            cache_dir=dict(
+                required=False, type='str', default='~/.ansible/vsphere_cache'),
+            broker_socket=dict(required=False, type='str'),
+            perf=dict(required=False, type='bool', default=False)
         ),
+        mutually_exclusive=[['folder', 'resource_pool']],
         supports_check_mode=True
     )
 
+    state = module.params['state']
+    if state not in ['present', 'latest', 'absent', 'report']:
+        module.fail_json(msg='invalid state "%s" recieved, state must be one of: present, latest, absent, report' % state)
+    identifiers = [module.params[key]
+        for key in ['uuid', 'instance_uuid', 'inventory_path']
+        if module.params[key]]
+    selection = [module.params[key]
+        for key in ['guests', 'folder', 'resource_pool']
+        if module.params[key]]
+    if not identifiers and not module.params['guest'] and \
+        state != 'report' and not (state == 'latest' and selection):
+        module.fail_json(msg='one of guest, uuid, instance_uuid or '
+            'inventory_path is required, unless state is report or state is '
+            'latest and one of guests, folder or resource_pool is set')
+    if module.params['wave_size'] < 1 or \
+        module.params['max_upgrades_per_host'] < 1 or \
+        module.params['max_upgrades_per_datastore'] < 1:
+        module.fail_json(msg='wave_size, max_upgrades_per_host and '
+            'max_upgrades_per_datastore must be at least 1')
+    if not 0 <= module.params['max_failure_rate'] <= 100:
+        module.fail_json(msg='max_failure_rate must be between 0 and 100')
+    if state == 'latest' and not identifiers and not module.params['guest'] \
+        and not module.params['wait']:
+        module.fail_json(msg='wait must be yes when upgrading the tools of '
+            'a selection of VMs, as the waves depend on each other')
+
+    broker_connect(module)
+    if BROKER and module.params['guest'] and not identifiers and \
+        not module.params['perf']:
+        # the status is checked through the broker, without loading pyVmomi
+        statuses = broker_call('properties',
+            type='VirtualMachine',
+            names=[module.params['guest']],
+            paths=['guest.toolsVersionStatus2']) or {}
+        status = statuses.get(module.params['guest'], {}).get(
+            'guest.toolsVersionStatus2')
+        if status is not None:
+            check_tools(module, state, status,
+                {'reused': True, 'logins': 0, 'broker': True})
+    import_pyvmomi()
+    perf_start(module)
+
     # connect to the vCenter...
-    try:
-        connection = SmartConnect(
-            host=module.params['vcenter_hostname'],
-            user=module.params['username'],
-            pwd=module.params['password'],
-            port=module.params['port'])
-    except:
-        module.fail_json(
-            msg='failed to connect to vCenter server at %s with user %s' %
-            (module.params['vcenter_hostname'], module.params['username']))
-    # and don't forget to disconnect
-    atexit.register(Disconnect, connection)
+    connection, session = connect(module)
     content = connection.RetrieveContent()
+    perf_phase('lookup')
+
+    if not identifiers and not module.params['guest']:
+        if state == 'report':
+            report_tools(module, content, session)
+        upgrade_tools(module, content, session)
 
-    # validate parameters
-    guest = get_obj(content, [vim.VirtualMachine], module.params['guest'])
+    # validate parameters, identifiers are looked up in the search index and
+    # only plain names require a scan of the inventory
+    if identifiers:
+        guest = find_vm(content, module.params)
+        if not module.params['guest']:
+            module.params['guest'] = identifiers[0]
+    else:
+        cache_path = None
+        if module.params['inventory_cache']:
+            cache_path = cache_file(module)
+        found = find_objs(
+            content,
+            {vim.VirtualMachine: [module.params['guest']]},
+            cache_path,
+            module.params['inventory_cache_ttl'])
+        guest = found[vim.VirtualMachine].get(module.params['guest'])
     if not guest:
         module.fail_json(msg='guest VM "%s" not found on vCenter server at %s' %
             (module.params['guest'], module.params['vcenter_hostname']))
 
-    state = module.params['state']
-    if state not in ['present', 'latest', 'absent']:
-        module.fail_json(msg='invalid state "%s" recieved, state must be one of: present, latest, absent' % state)
-
     # get current status of VMware tools
+    perf_phase('diff')
     status = guest.guest.toolsVersionStatus2
 
-    # check if status requires an action
+    # check if status requires an action, upgrading the tools if it does
+    check_tools(module, state, status, session)
+    tasks = []
+    if module.check_mode:
+        changes = [
+            'tools on guest VM %s would have been upgraded, if not running in check mode' %
+            module.params['guest']]
+    else:
+        perf_phase('task_submit')
+        task = guest.UpgradeTools(
+            installerOptions=module.params['installer_options'])
+        if module.params['wait']:
+            tasks.append(
+                task_summary(wait_for_task(module, content, task)))
+            changes = ['tools on guest VM %s have been upgraded' %
+                module.params['guest']]
+        else:
+            tasks.append(task_handle(task))
+            changes = ['tools upgrade on guest VM %s has been started' %
+                module.params['guest']]
+    module.exit_json(
+        changed=True,
+        changes=changes,
+        tasks=tasks,
+        session=session,
+        ansible_facts={'vm_tools_status': status})
+
+def check_tools(module, state, status, session):
+    """Fails or exits the module unchanged, unless the tools status requires
+    an upgrade"""
     if state == 'present' and status == 'guestToolsNotInstalled':
         module.fail_json(msg='guest VM "%s" has the tools state "present", but the current status if the tools is "%s"' %
             (module.params['guest'], status))
@@ -139,52 +386,956 @@ def main():
         module.fail_json(msg='guest VM "%s" has the tools state "absent", but the current status if the tools is "%s"' %
             (module.params['guest'], status))
 
-    elif state == 'latest' and status in ['guestToolsBlacklisted',
-        'guestToolsNeedUpgrade', 'guestToolsNotInstalled',
-        'guestToolsSupportedOld', 'guestToolsTooOld']:
-        if module.check_mode:
-            changes = [
-                'tools on guest VM %s would have been upgraded, if not running in check mode' %
-                module.params['guest']]
-        else:
-            task = guest.UpgradeTools(
-                installerOptions=module.params['installer_options'])
-            wait_for_task(module, task)
-            changes = ['tools on guest VM %s have been upgraded' %
-                module.params['guest']]
-        module.exit_json(
-            changed=True,
-            changes=changes,
-            ansible_facts={'vm_tools_status': status})
+    elif state == 'latest' and status in UPGRADE_STATUSES:
+        return
 
     module.exit_json(
             changed=False,
+            session=session,
             ansible_facts={'vm_tools_status': status})
 
-def get_obj(content, vimtype, name):
-    """Returns an object based on it's vimtype and name"""
-    obj = None
-    container = content.viewManager.CreateContainerView(
-        content.rootFolder, vimtype, True)
-    for element in container.view:
-        if element.name == name:
-            obj = element
+def report_tools(module, content, session):
+    """Exits the module with a report of the tools status of the selected
+    VMs, holding only the counts and the VMs needing an upgrade in memory"""
+    start = time.time()
+    perf_phase('report')
+    counts = dict((key, {}) for key in REPORT_PROPERTIES.values())
+    upgrade_required = []
+    total = 0
+    for vm, properties in select_vms(
+        module, content, REPORT_PROPERTIES.keys()):
+        total += 1
+        status = {'name': properties['name']}
+        for path, key in REPORT_PROPERTIES.items():
+            status[key] = properties.get(path) or 'unknown'
+            counts[key][status[key]] = counts[key].get(status[key], 0) + 1
+        if status['version_status'] in UPGRADE_STATUSES:
+            upgrade_required.append(status)
+    module.exit_json(
+        changed=False,
+        vms=total,
+        counts=counts,
+        upgrade_required=upgrade_required,
+        duration=round(time.time() - start, 3),
+        session=session)
+
+def upgrade_tools(module, content, session):
+    """Exits the module after upgrading the tools of the selected VMs in
+    rolling waves
+
+    Each wave holds up to wave_size VMs, at most max_upgrades_per_host per
+    host and max_upgrades_per_datastore per datastore. After the upgrade tasks
+    of a wave completed, the module waits for the tools of its VMs to run in
+    the latest version, before starting the next wave. The rollout is stopped
+    once the share of failed upgrades exceeds max_failure_rate."""
+    start = time.time()
+    perf_phase('diff')
+    results = []
+    pending = []
+    current = 0
+    for vm, properties in select_vms(module, content, UPGRADE_PROPERTIES):
+        status = properties.get('guest.toolsVersionStatus2')
+        if status not in UPGRADE_STATUSES:
+            current += 1
+            continue
+        result = {
+            'name': properties['name'],
+            'changed': False,
+            'version_status': status,
+            'tasks': []}
+        results.append(result)
+        if status == 'guestToolsNotInstalled':
+            result['state'] = 'skipped'
+            result['msg'] = 'tools are not installed'
+        elif properties.get('runtime.powerState') != 'poweredOn':
+            result['state'] = 'skipped'
+            result['msg'] = 'VM is not powered on'
+        elif properties.get('guest.toolsRunningStatus') != 'guestToolsRunning':
+            result['state'] = 'skipped'
+            result['msg'] = 'tools are not running'
+        else:
+            pending.append((vm, properties, result))
+
+    waves = []
+    upgraded = 0
+    failed = 0
+    stopped = False
+    while pending:
+        wave = plan_wave(module, pending)
+        summary = {
+            'wave': len(waves) + 1,
+            'vms': [result['name'] for _, _, result in wave],
+            'succeeded': 0,
+            'failed': 0}
+        waves.append(summary)
+        if module.check_mode:
+            for _, _, result in wave:
+                result['changed'] = True
+                result['state'] = 'check_mode'
+                result['wave'] = summary['wave']
+            continue
+
+        upgrade_wave(module, content, wave, summary)
+        upgraded += summary['succeeded']
+        failed += summary['failed']
+        if failed * 100 > module.params['max_failure_rate'] * \
+            (upgraded + failed):
+            stopped = True
+            break
+
+    for _, _, result in pending:
+        result['state'] = 'skipped'
+        result['msg'] = 'rollout stopped after wave %d' % len(waves)
+    output = dict(
+        changed=len([1 for result in results if result['changed']]) > 0,
+        results=results,
+        waves=waves,
+        upgraded=upgraded,
+        failed=failed,
+        skipped=len([1 for result in results
+            if result['state'] == 'skipped']),
+        current=current,
+        duration=round(time.time() - start, 3),
+        session=session)
+    if stopped:
+        module.fail_json(
+            msg='stopped the tools upgrade, %d of %d upgrades failed, which '
+                'exceeds max_failure_rate of %d%%' %
+                (failed, upgraded + failed, module.params['max_failure_rate']),
+            **output)
+    module.exit_json(**output)
+
+def plan_wave(module, pending):
+    """Removes the VMs of the next wave from the pending (vm, properties,
+    result) tuples and returns them, in the order given and skipping VMs
+    whose host or datastores reached their limit"""
+    wave = []
+    per_host = {}
+    per_datastore = {}
+    for item in list(pending):
+        if len(wave) >= module.params['wave_size']:
             break
-    return obj
-
-def wait_for_task(module, task):
-    """Wait for a task to complete"""
-    # set generic message
-    error_msg = 'an error occurred while waiting for the task to complete'
-    task_done = False
-    while not task_done:
-        if task.info.state == 'success':
-            return task.info.result
-
-        if task.info.state == 'error':
-            if isinstance(task.info.error, vim.fault.DuplicateName):
-                error_msg = 'an object with the name %s already exists' % \
-                    task.info.error.name
-            module.fail_json(msg=error_msg)
+        properties = item[1]
+        host = properties['runtime.host']._moId
+        datastores = [datastore._moId
+            for datastore in properties.get('datastore') or []]
+        if per_host.get(host, 0) >= module.params['max_upgrades_per_host'] or \
+            [1 for datastore in datastores
+            if per_datastore.get(datastore, 0) >=
+            module.params['max_upgrades_per_datastore']]:
+            continue
+        per_host[host] = per_host.get(host, 0) + 1
+        for datastore in datastores:
+            per_datastore[datastore] = per_datastore.get(datastore, 0) + 1
+        pending.remove(item)
+        wave.append(item)
+    return wave
+
+def upgrade_wave(module, content, wave, summary):
+    """Upgrades the tools of the VMs in a wave, waits for them to run in the
+    latest version and updates their results and the summary of the wave
+
+    Upgrades still running once task_timeout elapsed fail, with the id of
+    their task, and count towards max_failure_rate like the other failures."""
+    start = time.time()
+    previous = perf_phase('task_submit')
+    running = {}
+    for vm, _, result in wave:
+        result['wave'] = summary['wave']
+        try:
+            task = vm.UpgradeTools(
+                installerOptions=module.params['installer_options'])
+        except vmodl.MethodFault as error:
+            result['state'] = 'error'
+            result['msg'] = task_error_msg(error)
+            continue
+        running[task._moId] = (vm, task, result)
+    perf_phase(previous)
+
+    upgraded = []
+    if running:
+        done = wait_for_tasks(
+            module,
+            content,
+            [task for _, task, _ in running.values()],
+            module.params['task_timeout'],
+            partial=True)
+        for moid, (vm, task, result) in running.items():
+            info = done.get(moid)
+            if info is None:
+                # the upgrade keeps running and counts as failed in the wave
+                result['changed'] = True
+                result['state'] = 'error'
+                result['msg'] = 'timed out after %d seconds waiting for the ' \
+                    'tools upgrade to complete' % module.params['task_timeout']
+                result['tasks'].append(task_handle(task))
+                continue
+            result['tasks'].append(task_summary(info))
+            if info['state'] == 'success':
+                upgraded.append((vm, result))
+            else:
+                result['state'] = 'error'
+                result['msg'] = task_error_msg(info['error'])
+    summary['task_seconds'] = round(time.time() - start, 3)
+
+    tools_start = time.time()
+    if upgraded:
+        ready = wait_for_tools(
+            module, content, [vm for vm, _ in upgraded],
+            module.params['tools_timeout'])
+        for vm, result in upgraded:
+            result['changed'] = True
+            if vm._moId in ready:
+                result['state'] = 'success'
+                result['tools_seconds'] = ready[vm._moId]
+            else:
+                result['state'] = 'error'
+                result['msg'] = 'tools not running in the latest version ' \
+                    'after %d seconds' % module.params['tools_timeout']
+    summary['tools_seconds'] = round(time.time() - tools_start, 3)
+    summary['duration'] = round(time.time() - start, 3)
+    for _, _, result in wave:
+        if result['state'] == 'success':
+            summary['succeeded'] += 1
+        else:
+            summary['failed'] += 1
+
+def wait_for_tools(module, content, vms, timeout):
+    """Waits for the tools of the VMs to run in the latest version and
+    returns a dict mapping the moIds of the ready VMs to the seconds waited
+
+    Like wait_for_tasks, this blocks in WaitForUpdatesEx on the vCenter server
+    until the tools status of a VM changes. Unlike it, the VMs not ready when
+    the timeout elapsed are left out of the result instead of failing. A
+    timeout of 0 or less waits until all VMs are ready."""
+    previous = perf_phase('tools_wait')
+    collector = content.propertyCollector.CreatePropertyCollector()
+    try:
+        object_specs = [
+            vmodl.query.PropertyCollector.ObjectSpec(obj=vm)
+            for vm in vms]
+        property_spec = vmodl.query.PropertyCollector.PropertySpec(
+            type=vim.VirtualMachine,
+            pathSet=['guest.toolsVersionStatus2', 'guest.toolsRunningStatus'])
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec(
+            objectSet=object_specs,
+            propSet=[property_spec])
+        collector.CreateFilter(filter_spec, True)
+
+        start = time.time()
+        statuses = dict((vm._moId, {}) for vm in vms)
+        ready = {}
+        version = ''
+        while len(ready) < len(vms):
+            max_wait = 60
+            if timeout > 0:
+                remaining = timeout - (time.time() - start)
+                if remaining <= 0:
+                    break
+                max_wait = int(min(max_wait, max(remaining, 1)))
+            options = vmodl.query.PropertyCollector.WaitOptions(
+                maxWaitSeconds=max_wait)
+            update = collector.WaitForUpdatesEx(version, options)
+            if update is None:
+                continue
+            version = update.version
+            for filter_set in update.filterSet:
+                for object_set in filter_set.objectSet:
+                    moid = object_set.obj._moId
+                    status = statuses[moid]
+                    for change in object_set.changeSet:
+                        status[change.name] = change.val
+                    if status.get('guest.toolsRunningStatus') == \
+                        'guestToolsRunning' and \
+                        status.get('guest.toolsVersionStatus2') not in \
+                        UPGRADE_STATUSES + [None] and moid not in ready:
+                        ready[moid] = round(time.time() - start, 3)
+        return ready
+    finally:
+        collector.Destroy()
+        perf_phase(previous)
+
+def select_vms(module, content, properties):
+    """Yields (vm, properties) tuples of the VMs in the folder or resource pool
+    matching the names and patterns in guests, if any, streamed page by page
+    from a single property collector call on a container view"""
+    container = content.rootFolder
+    for vimtype, option in [
+        (vim.Folder, 'folder'), (vim.ResourcePool, 'resource_pool')]:
+        name = module.params[option]
+        if not name:
+            continue
+        cache_path = None
+        if module.params['inventory_cache']:
+            cache_path = cache_file(module)
+        container = find_objs(
+            content,
+            {vimtype: [name]},
+            cache_path,
+            module.params['inventory_cache_ttl'])[vimtype].get(name)
+        if container is None:
+            module.fail_json(msg='%s "%s" not found on vCenter server at %s' %
+                (option.replace('_', ' '), name,
+                module.params['vcenter_hostname']))
+
+    patterns = module.params['guests']
+    view = content.viewManager.CreateContainerView(
+        container, [vim.VirtualMachine], True)
+    try:
+        traversal_spec = vmodl.query.PropertyCollector.TraversalSpec(
+            name='traverseView',
+            path='view',
+            skip=False,
+            type=vim.view.ContainerView)
+        object_spec = vmodl.query.PropertyCollector.ObjectSpec(
+            obj=view,
+            skip=True,
+            selectSet=[traversal_spec])
+        property_spec = vmodl.query.PropertyCollector.PropertySpec(
+            type=vim.VirtualMachine,
+            pathSet=['name', 'config.template'] + list(properties))
+        for vm, vm_properties in stream_properties(
+            content, [object_spec], [property_spec], PAGE_SIZE):
+            if vm_properties.get('config.template') or \
+                'name' not in vm_properties:
+                continue
+            if patterns and not [pattern for pattern in patterns
+                if fnmatch.fnmatchcase(vm_properties['name'], pattern)]:
+                continue
+            yield vm, vm_properties
+    finally:
+        view.Destroy()
+
+def wait_for_task(module, content, task):
+    """Wait for a task to complete and return its state information"""
+    info = wait_for_tasks(
+        module, content, [task], module.params['task_timeout'])[task._moId]
+    if info['state'] == 'error':
+        module.fail_json(
+            msg=task_error_msg(info['error']),
+            tasks=[task_summary(info)])
+    return info
+
+# BEGIN vsphere_common
+# copied from common/vsphere_common.py by common/update_modules.py, edit there
+import atexit, fcntl, hashlib, json, os, socket, tempfile, time
+
+# the connection to the vsphere_broker, only set while it is available
+BROKER = {}
+
+# the performance counters of the module run, only filled if perf is set
+PERF = {}
+
+# the number of slowest SOAP requests listed in the perf result
+PERF_SLOWEST_CALLS = 5
+
+def import_pyvmomi():
+    """Imports pyVmomi and pyVim into the module globals
+
+    Loading pyVmomi and its type tables takes a good share of the runtime of
+    a short task, so it is deferred until the arguments have been validated
+    and the vCenter server is actually needed."""
+    global vim, vmodl, SmartConnect, Disconnect, SoapStubAdapter
+    from pyVmomi import vim, vmodl
+    from pyVim.connect import SmartConnect, Disconnect
+    from pyVmomi.SoapAdapter import SoapStubAdapter
+
+def connect(module):
+    """Connects to the vCenter server, reusing a cached session if enabled
+
+    Returns the service instance and a dict describing the session used,
+    with the number of logins done by this task, so their sum over a
+    playbook run shows how often the sessions were reused."""
+    context = None
+
+    if not module.params['certificate_check']:
+        import requests, ssl
+
+        # disable urllib3 ssl warnings
+        requests.packages.urllib3.disable_warnings()
+
+        # disable SSL certificate verification
+        if hasattr(ssl, 'SSLContext'):
+            context = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
+            context.verify_mode = ssl.CERT_NONE
+
+    # use the session of the broker, if there is one
+    session = broker_call('session')
+    if session:
+        connection = reuse_session(module, session, context)
+        if connection:
+            return connection, {'reused': True, 'logins': 0, 'broker': True}
+
+    if not module.params['session_cache']:
+        connection = login(module, context)
+        # and don't forget to disconnect
+        atexit.register(Disconnect, connection)
+        return connection, {'reused': False, 'logins': 1}
+
+    # try the cached session first, without holding the lock
+    cache_path = cache_file(module)
+    session = read_cache(cache_path).get('session', {})
+    connection = reuse_session(module, session, context)
+    if connection:
+        return connection, {'reused': True, 'logins': 0}
+
+    # log in while holding the lock, so concurrent forks wait for a single
+    # login and then reuse its session
+    connections = []
+    def update_session(cache):
+        session = cache.get('session', {})
+        connection = reuse_session(module, session, context)
+        if connection:
+            connections.append((connection, True))
+            return
+        connection = login(module, context)
+        connections.append((connection, False))
+        cache['session'] = {
+            'username': module.params['username'],
+            'cookie': connection._stub.cookie,
+            'version': connection._stub.version}
+    update_cache(cache_path, update_session)
+    connection, reused = connections[0]
+    # the session is kept open for the following tasks, so no disconnect here
+    return connection, {'reused': reused, 'logins': reused and 0 or 1}
+
+def login(module, context):
+    """Logs in to the vCenter server and returns the service instance"""
+    try:
+        if context:
+            return SmartConnect(
+                host=module.params['vcenter_hostname'],
+                user=module.params['username'],
+                pwd=module.params['password'],
+                port=module.params['port'],
+                sslContext=context)
+        else:
+            return SmartConnect(
+                host=module.params['vcenter_hostname'],
+                user=module.params['username'],
+                pwd=module.params['password'],
+                port=module.params['port'])
+    except:
+        module.fail_json(
+            msg='failed to connect to vCenter server at %s with user %s' %
+            (module.params['vcenter_hostname'], module.params['username']))
+
+def reuse_session(module, session, context):
+    """Returns a service instance using the cached session, or None if there
+    is no cached session for the user, it has expired or checking it fails"""
+    if session.get('username') != module.params['username'] or \
+        not session.get('cookie'):
+        return None
+
+    if context:
+        stub = SoapStubAdapter(
+            host=module.params['vcenter_hostname'],
+            port=module.params['port'],
+            version=session['version'],
+            sslContext=context)
+    else:
+        stub = SoapStubAdapter(
+            host=module.params['vcenter_hostname'],
+            port=module.params['port'],
+            version=session['version'])
+    stub.cookie = session['cookie']
+    connection = vim.ServiceInstance('ServiceInstance', stub)
+    try:
+        if connection.content.sessionManager.currentSession:
+            return connection
+    except (vmodl.MethodFault, socket.error, IOError):
+        # a new login either succeeds or reports the actual error
+        pass
+    return None
+
+def find_vm(content, identifiers):
+    """Returns the VM with the uuid, instance_uuid or inventory_path given in
+    the identifiers dict, looked up in the search index, or None"""
+    search_index = content.searchIndex
+    if identifiers.get('uuid'):
+        return search_index.FindByUuid(
+            uuid=identifiers['uuid'], vmSearch=True, instanceUuid=False)
+    if identifiers.get('instance_uuid'):
+        return search_index.FindByUuid(
+            uuid=identifiers['instance_uuid'], vmSearch=True, instanceUuid=True)
+    if identifiers.get('inventory_path'):
+        vm = search_index.FindByInventoryPath(
+            inventoryPath=identifiers['inventory_path'])
+        if isinstance(vm, vim.VirtualMachine):
+            return vm
+    return None
+
+def retrieve_properties(content, object_specs, property_specs):
+    """Returns a list of (object, properties) tuples, retrieved in bulk"""
+    return list(stream_properties(content, object_specs, property_specs))
+
+def stream_properties(content, object_specs, property_specs, page_size=None):
+    """Yields (object, properties) tuples, retrieved in bulk in pages of
+    page_size objects, or as the server sees fit, so that only a single page
+    is held in memory at once"""
+    collector = content.propertyCollector
+    filter_spec = vmodl.query.PropertyCollector.FilterSpec(
+        objectSet=object_specs,
+        propSet=property_specs)
+    options = vmodl.query.PropertyCollector.RetrieveOptions()
+    if page_size:
+        options.maxObjects = page_size
+    result = collector.RetrievePropertiesEx(
+        specSet=[filter_spec],
+        options=options)
+    while result:
+        for obj_content in result.objects:
+            properties = {}
+            for prop in obj_content.propSet:
+                properties[prop.name] = prop.val
+            yield obj_content.obj, properties
+        if not result.token:
+            break
+        result = collector.ContinueRetrievePropertiesEx(token=result.token)
+
+def get_objs(content, vimtypes, properties=None):
+    """Returns the properties (name by default) of all objects of the given
+    vimtypes, using a single container view and property collector call"""
+    if properties is None:
+        properties = ['name']
+    view = content.viewManager.CreateContainerView(
+        content.rootFolder, vimtypes, True)
+    try:
+        traversal_spec = vmodl.query.PropertyCollector.TraversalSpec(
+            name='traverseView',
+            path='view',
+            skip=False,
+            type=vim.view.ContainerView)
+        object_spec = vmodl.query.PropertyCollector.ObjectSpec(
+            obj=view,
+            skip=True,
+            selectSet=[traversal_spec])
+        property_specs = [
+            vmodl.query.PropertyCollector.PropertySpec(
+                type=vimtype,
+                pathSet=properties)
+            for vimtype in vimtypes]
+        return retrieve_properties(content, [object_spec], property_specs)
+    finally:
+        view.Destroy()
+
+def get_props(content, objs, properties):
+    """Returns a list of (object, properties) tuples for the given objects,
+    retrieved in a single property collector call"""
+    object_specs = [
+        vmodl.query.PropertyCollector.ObjectSpec(obj=obj) for obj in objs]
+    property_specs = [
+        vmodl.query.PropertyCollector.PropertySpec(
+            type=vimtype,
+            pathSet=properties)
+        for vimtype in set([type(obj) for obj in objs])]
+    return retrieve_properties(content, object_specs, property_specs)
+
+def find_objs(content, wanted, cache_path=None, cache_ttl=0):
+    """Resolves the names of objects of several vimtypes in a single pass
+
+    wanted maps vimtypes to a list of names, the returned dict maps the same
+    vimtypes to a dict of the names found and their objects. If a cache_path
+    is given, the names are looked up in the inventory index kept in that file
+    first and the vCenter inventory is only swept for the vimtypes that are
+    missing, outdated or stale in the index."""
+    index = broker_call('find', wanted=dict(
+        (vimtype._wsdlName, names) for vimtype, names in wanted.items()))
+    if index is not None:
+        stub = content.propertyCollector._stub
+        return dict(
+            (vimtype, dict(
+                (name, vimtype(moid, stub))
+                for name, moid in index[vimtype._wsdlName].items()))
+            for vimtype in wanted)
+
+    found = dict((vimtype, {}) for vimtype in wanted)
+    sweep = list(wanted.keys())
+
+    if cache_path:
+        sweep = []
+        index = read_cache(cache_path).get('inventory', {})
+        stub = content.propertyCollector._stub
+        candidates = []
+        for vimtype, names in wanted.items():
+            entry = index.get(vimtype._wsdlName)
+            if not entry or time.time() - entry['timestamp'] > cache_ttl or \
+                [name for name in names if name not in entry['objects']]:
+                sweep.append(vimtype)
+                continue
+            for name in names:
+                candidates.append(
+                    (vimtype, name, vimtype(entry['objects'][name], stub)))
+
+        # verify that the cached references still exist and carry their names
+        if candidates:
+            try:
+                current = dict(
+                    (obj._moId, properties.get('name'))
+                    for obj, properties in get_props(
+                        content, [obj for _, _, obj in candidates], ['name']))
+            except vmodl.fault.ManagedObjectNotFound:
+                current = {}
+            for vimtype, name, obj in candidates:
+                if current.get(obj._moId) == name:
+                    found[vimtype][name] = obj
+                elif vimtype not in sweep:
+                    sweep.append(vimtype)
+
+    if sweep:
+        # the views include subtypes, i.e. datastore clusters are folders and
+        # vApps resource pools, but names only resolve to objects of exactly
+        # the wanted vimtype, as they do in the index of the broker
+        objects = dict((vimtype, {}) for vimtype in sweep)
+        for obj, properties in get_objs(content, sweep):
+            if type(obj) in objects and 'name' in properties:
+                objects[type(obj)].setdefault(properties['name'], obj)
+        for vimtype in sweep:
+            found[vimtype] = dict(
+                (name, objects[vimtype][name])
+                for name in wanted[vimtype] if name in objects[vimtype])
+
+        if cache_path:
+            def update_index(cache):
+                index = cache.setdefault('inventory', {})
+                for vimtype in sweep:
+                    index[vimtype._wsdlName] = {
+                        'timestamp': time.time(),
+                        'objects': dict(
+                            (name, obj._moId)
+                            for name, obj in objects[vimtype].items())}
+            update_cache(cache_path, update_index)
+
+    return found
+
+def is_pattern(name):
+    """Returns True if the name contains shell style wildcards"""
+    return len([char for char in '*?[' if char in name]) > 0
+
+def cache_file(module):
+    """Returns the path of the cache file for the vCenter server and user in
+    use, so users neither replace each others sessions nor see inventory
+    indexes built with the permissions of another user"""
+    directory = os.path.expanduser(module.params['cache_dir'])
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+    user = hashlib.sha1(module.params['username'].encode('utf-8'))
+    return os.path.join(directory, '%s_%d_%s.json' %
+        (module.params['vcenter_hostname'], module.params['port'],
+        user.hexdigest()[:12]))
+
+def read_cache(path):
+    """Returns the contents of a cache file, empty if it is missing or broken"""
+    try:
+        cache = open(path)
+        try:
+            return json.load(cache)
+        finally:
+            cache.close()
+    except (IOError, ValueError):
+        return {}
+
+def update_cache(path, update):
+    """Applies the update function to the contents of a cache file
+
+    The file is locked for the duration of the update, to be safe against
+    concurrent forks, and atomically replaced by the updated contents."""
+    lock = open(path + '.lock', 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        cache = read_cache(path)
+        update(cache)
+        handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        temp = os.fdopen(handle, 'w')
+        try:
+            json.dump(cache, temp)
+        finally:
+            temp.close()
+        os.rename(temp_path, path)
+    finally:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
+
+def wait_for_tasks(module, content, tasks, timeout=0, first=False,
+    partial=False):
+    """Wait for tasks to complete and return a dict of their state information
+
+    Instead of polling the tasks, this blocks in WaitForUpdatesEx on the vCenter
+    server until their state or progress changes. The dict maps each completed
+    tasks moId to its state, progress, result, error and the seconds waited.
+    If first is set, it returns as soon as at least one task has completed. A
+    timeout of 0 waits forever, otherwise the module fails once it elapsed,
+    unless partial is set, which returns the tasks completed until then.
+    If the broker is available, it waits on behalf of the module."""
+    previous = perf_phase('task_wait')
+    response = broker_call('wait_tasks',
+        tasks=[task._moId for task in tasks], timeout=timeout, first=first)
+    if response is not None:
+        perf_phase(previous)
+        return broker_task_infos(module, content, response, timeout, partial)
+    collector = content.propertyCollector.CreatePropertyCollector()
+    try:
+        object_specs = [
+            vmodl.query.PropertyCollector.ObjectSpec(obj=task)
+            for task in tasks]
+        property_spec = vmodl.query.PropertyCollector.PropertySpec(
+            type=vim.Task,
+            pathSet=['info.state', 'info.progress', 'info.result',
+                'info.error'])
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec(
+            objectSet=object_specs,
+            propSet=[property_spec])
+        collector.CreateFilter(filter_spec, True)
+
+        start = time.time()
+        infos = dict(
+            (task._moId, {
+                'task': task._moId,
+                'state': None,
+                'progress': None,
+                'result': None,
+                'error': None,
+                'duration': None})
+            for task in tasks)
+        done = {}
+        version = ''
+        while len(done) < len(tasks) and not (first and done):
+            max_wait = 60
+            if timeout:
+                remaining = timeout - (time.time() - start)
+                if remaining <= 0:
+                    if partial:
+                        return done
+                    module.fail_json(
+                        msg='timed out after %d seconds waiting for %d ' \
+                            'task(s) to complete' %
+                            (timeout, len(tasks) - len(done)),
+                        tasks=[task_summary(info) for info in infos.values()])
+                max_wait = int(min(max_wait, max(remaining, 1)))
+            options = vmodl.query.PropertyCollector.WaitOptions(
+                maxWaitSeconds=max_wait)
+            update = collector.WaitForUpdatesEx(version, options)
+            if update is None:
+                continue
+            version = update.version
+            for filter_set in update.filterSet:
+                for object_set in filter_set.objectSet:
+                    info = infos[object_set.obj._moId]
+                    for change in object_set.changeSet:
+                        info[change.name.split('.', 1)[1]] = change.val
+                    if info['state'] in ['success', 'error'] and \
+                        info['task'] not in done:
+                        info['duration'] = round(time.time() - start, 3)
+                        done[info['task']] = info
+        return done
+    finally:
+        collector.Destroy()
+        perf_phase(previous)
+
+def task_error_msg(error):
+    """Returns a message describing the error of a failed task"""
+    if isinstance(error, vim.fault.DuplicateName):
+        return 'an object with the name %s already exists' % error.name
+    if getattr(error, 'msg', None):
+        return 'an error occurred while waiting for the task to complete: %s' \
+            % error.msg
+    return 'an error occurred while waiting for the task to complete'
+
+def task_summary(info):
+    """Returns the state information of a task, reduced to what can be
+    returned in the module result"""
+    return {
+        'task': info['task'],
+        'state': info['state'],
+        'progress': info['progress'],
+        'duration': info['duration']}
+
+def task_handle(task):
+    """Returns the summary of a task which is not waited for, its id can be
+    passed to vsphere_task_status to collect it later"""
+    return {
+        'task': task._moId,
+        'state': 'running',
+        'progress': None,
+        'duration': None}
+
+def broker_connect(module):
+    """Connects to the vsphere_broker listening on broker_socket, if it is set
+    and the broker is running"""
+    if not module.params['broker_socket']:
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(os.path.expanduser(module.params['broker_socket']))
+    except socket.error:
+        sock.close()
+        return
+    reader = sock.makefile('r')
+    atexit.register(broker_close, sock, reader)
+    BROKER.update({
+        'socket': sock,
+        'reader': reader,
+        'request': dict(
+            (key, module.params[key])
+            for key in ['vcenter_hostname', 'port', 'username', 'password',
+                'certificate_check'])})
+
+def broker_close(sock, reader):
+    """Closes the connection to the broker"""
+    reader.close()
+    sock.close()
+
+def broker_call(op, **request):
+    """Returns the result of a request to the broker, or None if it isn't
+    available
+
+    If the request fails, the broker isn't used for the rest of the task and
+    the module falls back to connecting directly, reporting the errors of the
+    vCenter server in its own words."""
+    if not BROKER:
+        return None
+    request.update(BROKER['request'])
+    request['op'] = op
+    start = time.time()
+    try:
+        BROKER['socket'].sendall(json.dumps(request) + '\n')
+        response = json.loads(BROKER['reader'].readline())
+    except (socket.error, ValueError):
+        response = {'error': 'connection to the broker lost'}
+    if PERF:
+        perf_call('broker.%s' % op, time.time() - start)
+    if 'error' in response:
+        broker_close(BROKER['socket'], BROKER['reader'])
+        BROKER.clear()
+        return None
+    return response['result']
+
+def broker_task_infos(module, content, response, timeout, partial=False):
+    """Returns the state information of the tasks the broker waited for like
+    wait_for_tasks does, restoring their results and errors"""
+    stub = content.propertyCollector._stub
+    infos = response['infos']
+    for info in infos.values():
+        if info['result']:
+            vimtype = getattr(
+                vim, info['result']['type'], vmodl.ManagedObject)
+            info['result'] = vimtype(info['result']['moId'], stub)
+        if info['error']:
+            fault = getattr(vim.fault, info['error']['type'], vmodl.MethodFault)
+            error = fault(msg=info['error']['msg'])
+            if info['error']['name']:
+                error.name = info['error']['name']
+            info['error'] = error
+    if response['timed_out'] and not partial:
+        module.fail_json(
+            msg='timed out after %d seconds waiting for %d task(s) to complete'
+                % (timeout, len(infos) - len(response['done'])),
+            tasks=[task_summary(info) for info in infos.values()])
+    return dict((moid, infos[moid]) for moid in response['done'])
+
+def perf_start(module):
+    """Enables the performance counters, if the perf option is set
+
+    The pyVmomi stub adapter is hooked to count, time and measure the SOAP
+    requests of all callers and the counters are added to the result of the
+    module as perf key, whether it succeeds or fails."""
+    if not module.params['perf']:
+        return
+    now = time.time()
+    PERF.update({
+        'start': now,
+        'phase': 'connect',
+        'phase_start': now,
+        'phases': {},
+        'calls': {},
+        'bytes_sent': 0,
+        'bytes_received': 0,
+        'slowest': []})
+
+    invoke_method = SoapStubAdapter.InvokeMethod
+    def timed_invoke_method(self, mo, info, args, outerStub=None):
+        start = time.time()
+        try:
+            return invoke_method(self, mo, info, args, outerStub)
+        finally:
+            perf_call(info.wsdlName, time.time() - start)
+    SoapStubAdapter.InvokeMethod = timed_invoke_method
+
+    get_connection = SoapStubAdapter.GetConnection
+    def counted_get_connection(self):
+        conn = get_connection(self)
+        if not getattr(conn, 'perf_counted', False):
+            perf_count_connection(conn)
+        return conn
+    SoapStubAdapter.GetConnection = counted_get_connection
+
+    exit_json = module.exit_json
+    fail_json = module.fail_json
+    module.exit_json = lambda **kwargs: exit_json(perf=perf_report(), **kwargs)
+    module.fail_json = lambda **kwargs: fail_json(perf=perf_report(), **kwargs)
+
+def perf_count_connection(conn):
+    """Counts the bytes of the requests and responses of a HTTP connection"""
+    request = conn.request
+    getresponse = conn.getresponse
+    def counted_request(method, url, body=None, headers={}):
+        PERF['bytes_sent'] += len(body or '')
+        return request(method, url, body, headers)
+    def counted_getresponse():
+        response = getresponse()
+        read = response.read
+        def counted_read(*args):
+            data = read(*args)
+            PERF['bytes_received'] += len(data)
+            return data
+        response.read = counted_read
+        return response
+    conn.request = counted_request
+    conn.getresponse = counted_getresponse
+    conn.perf_counted = True
+
+def perf_call(method, seconds):
+    """Records a SOAP request to the vCenter server"""
+    calls = PERF['calls'].setdefault(method, {'count': 0, 'seconds': 0.0})
+    calls['count'] += 1
+    calls['seconds'] += seconds
+    PERF['slowest'].append({
+        'method': method,
+        'phase': PERF['phase'],
+        'seconds': round(seconds, 3)})
+    PERF['slowest'].sort(key=lambda call: -call['seconds'])
+    del PERF['slowest'][PERF_SLOWEST_CALLS:]
+
+def perf_phase(name):
+    """Attributes the time from now on to the named phase and returns the
+    previous phase, so that it can be restored after a nested phase"""
+    if not PERF or name is None:
+        return None
+    now = time.time()
+    previous = PERF['phase']
+    PERF['phases'][previous] = \
+        PERF['phases'].get(previous, 0.0) + now - PERF['phase_start']
+    PERF['phase'] = name
+    PERF['phase_start'] = now
+    return previous
+
+def perf_report():
+    """Returns the performance counters, as added to the result"""
+    perf_phase(PERF['phase'])
+    return {
+        'duration': round(time.time() - PERF['start'], 3),
+        'phases': dict(
+            (name, round(seconds, 3))
+            for name, seconds in PERF['phases'].items()),
+        'requests': sum([calls['count'] for calls in PERF['calls'].values()]),
+        'calls': dict(
+            (method, {
+                'count': calls['count'],
+                'seconds': round(calls['seconds'], 3)})
+            for method, calls in PERF['calls'].items()),
+        'bytes_sent': PERF['bytes_sent'],
+        'bytes_received': PERF['bytes_received'],
+        'slowest': PERF['slowest']}
+# END vsphere_common
 
 main()
@@ -43,126 +43,280 @@ Function Get-Int($obj, $name, $default = $null, $resultobj, $failifempty=$false,
     }
 }
 
-# variables
-$result = New-Object PSObject -Property @{
-    changed = $false
-    changes = @()
-    success = $false
+# formats a setting for comparison, lists are sorted and comma-separated
+Function Format-Setting($value) {
+    (@($value) | ? { $_ -ne $null } | % { "$_" } | Sort-Object -Unique) -join ","
 }
-$states             = @("present","absent")
-$days               = @("Sunday","Monday","Tuesday","Wednesday","Thursday","Friday","Saturday")
-$days_in_month      = @("First","Second","Third","Forth","Last","OnDay")
-$full_days_in_month = @("First","Second","Third","Forth","Last")
-$months             = @("January","February","March","April","May","June","July","August","September","October","November","December")
-$algorithms         = @("ReverseIncremental","Incremental")
-$schedules          = @("Daily","Monthly","Periodicaly","After")
-$periods            = @("Hours","Minutes","Continuously")
-$types              = @("Daily","Monthly")
 
+# returns the options of a job and the names of its proxies, read from the
+# Veeam server only once per run and kept in the catalog
+Function Get-JobOptions($job) {
+    if (-not $catalog.options.ContainsKey($job.Name)) {
+        $options = $job.GetOptions()
+        $job_proxies = @()
+        if ($catalog.job_proxies -ne $null -and $catalog.job_proxies.ContainsKey($job.Name)) {
+            $job_proxies = $catalog.job_proxies[$job.Name]
+        } elseif (-not $options.JobOptions.SourceProxyAutoDetect) {
+            $job_proxies = @($job.GetProxy() | % { $_.Name })
+        }
+        $catalog.options[$job.Name] = @{ options = $options; proxies = $job_proxies }
+    }
+    $catalog.options[$job.Name]
+}
 
+# returns the names of the proxies of all jobs by job name, built once per run
+# and kept in the catalog, whether a job detects its proxies automatically is
+# taken from the options loaded with it, so only the jobs with fixed proxies
+# ask the Veeam server for them
+Function Get-JobProxies {
+    if ($catalog.job_proxies -eq $null) {
+        $job_proxies = @{}
+        foreach ($job in $catalog.jobs.Values) {
+            if ($catalog.options.ContainsKey($job.Name)) {
+                $job_proxies[$job.Name] = $catalog.options[$job.Name].proxies
+            } elseif ($job.Options.JobOptions.SourceProxyAutoDetect) {
+                $job_proxies[$job.Name] = @()
+            } else {
+                $job_proxies[$job.Name] = @($job.GetProxy() | % { $_.Name })
+            }
+        }
+        $catalog.job_proxies = $job_proxies
+    }
+    $catalog.job_proxies
+}
 
-# parameter validation, defaults are based on the Veeam Powershell documentation
-$params = Parse-Args $args $true;
-$check_mode                        = Get-Attr $params "_ansible_check_mode" $false | ConvertTo-Bool
-$name                              = Get-Attr $params "name" -FailIfEmpty $true
-$state                             = Get-Attr $params "state" "present"             -ResultObj $result -ValidateSet $states
-$hosts                             = Get-Attr $params "hosts" -FailIfEmpty $true | % { $_.Split(',').Trim() }
-$repository                        = Get-Attr $params "repository" -FailIfEmpty $true
-$repository_scaleout               = Get-Attr $params "repository_scaleout" $false | ConvertTo-Bool
-$proxies                           = Get-Attr $params "proxies" | % { $_.Split(',').Trim() }
-$algorithm                         = Get-Attr $params "algorithm" "Incremental"     -ResultObj $result -ValidateSet $algorithms
-$filesystem_indexing               = Get-Attr $params "filesystem_indexing" $false | ConvertTo-Bool
-$retain_days                       = Get-Int  $params "retain_days" 14              -ResultObj $result -Min 1
-$schedule                          = Get-Attr $params "schedule" "Daily"            -ResultObj $result -ValidateSet $schedules
-$after                             = Get-Attr $params "after"
-$hour                              = Get-Int  $params "hour" 10                     -ResultObj $result -Max 23
-$day                               = Get-Attr $params "day"                         -ResultObj $result -ValidateSet $days
-$day_in_month                      = Get-Attr $params "day_in_month"                -ResultObj $result -ValidateSet $days_in_month
-$month                             = Get-Attr $params "month"                       -ResultObj $result -ValidateSet $months
-$period                            = Get-Int  $params "period"                      -ResultObj $result -Min 1
-$period_type                       = Get-Attr $params "period_type"                 -ResultObj $result -ValidateSet $periods
-$full                              = Get-Attr $params "full" $false | ConvertTo-Bool
-$full_type                         = Get-Attr $params "full_type"                   -ResultObj $result -ValidateSet $types
-$full_day                          = Get-Attr $params "full_day"                    -ResultObj $result -ValidateSet $days
-$full_day_in_month                 = Get-Attr $params "full_day_in_month"           -ResultObj $result -ValidateSet $full_days_in_month
-$full_month                        = Get-Attr $params "full_month"                  -ResultObj $result -ValidateSet $months
-$transform_full_to_syntethic       = Get-Attr $params "transform_full_to_syntethic" $false | ConvertTo-Bool
-$transform_increments_to_syntethic = Get-Attr $params "transform_increments_to_syntethic" $false | ConvertTo-Bool
-$transform_to_syntethic_days       = Get-Attr $params "transform_to_syntethic_days" -ResultObj $result -ValidateSet $days
-$vss                               = Get-Attr $params "vss" $false | ConvertTo-Bool
-$user                              = Get-Attr $params "user"
+# returns the schedule options of a job and the name of its target repository,
+# read from the Veeam server only once per run and kept in the catalog
+Function Get-JobSchedule($job) {
+    if (-not $catalog.schedules.ContainsKey($job.Name)) {
+        $repository = $null
+        try {
+            $repository = $job.GetTargetRepository().Name
+        } catch {
+            # jobs of other types don't have a repository
+        }
+        $catalog.schedules[$job.Name] = @{ options = $job.GetScheduleOptions(); repository = $repository }
+    }
+    $catalog.schedules[$job.Name]
+}
 
+# reads the current settings of a job, named like the parameters setting them
+Function Get-JobSettings($job) {
+    $job_options = Get-JobOptions $job
+    $options = $job_options.options
+    $schedule_options = (Get-JobSchedule $job).options
+    $vss_options = $job.GetVssOptions()
+    $settings = @{
+        retain_days = @($options.BackupStorageOptions.RetainCycles, $options.BackupStorageOptions.RetainDays)
+        algorithm = "Incremental"
+        full = $options.BackupStorageOptions.EnableFullBackup
+        full_type = $options.BackupTargetOptions.FullBackupScheduleKind
+        full_day = $options.BackupTargetOptions.FullBackupDays
+        full_day_in_month = $options.BackupTargetOptions.FullBackupMonthlyScheduleOptions.DayNumberInMonth
+        full_month = $options.BackupTargetOptions.FullBackupMonthlyScheduleOptions.Months
+        transform_full_to_syntethic = $options.BackupTargetOptions.TransformFullToSyntethic
+        transform_increments_to_syntethic = $options.BackupTargetOptions.TransformIncrementsToSyntethic
+        transform_to_syntethic_days = $options.BackupTargetOptions.TransformToSyntethicDays
+        filesystem_indexing = $vss_options.GuestFSIndexingType -ne "None"
+        vss = $vss_options.Enabled -and $vss_options.VssSnapshotOptions.IsCopyOnly
+        user = $null
+        proxies = "AutoDetect"
+        enabled = $job.IsScheduleEnabled
+        scheduled = -not $options.JobOptions.RunManually
+    }
+    if ($options.BackupTargetOptions.Algorithm -eq "Syntethic") {
+        $settings.algorithm = "ReverseIncremental"
+    }
+    if ($vss_options.Enabled) {
+        $settings.user = $catalog.credentials.Values | ? { $_.Id -eq $vss_options.CredsId } | % { $_.Name }
+    }
+    if (-not $options.JobOptions.SourceProxyAutoDetect) {
+        $settings.proxies = $job_options.proxies
+    }
 
+    if ($schedule_options.OptionsDaily.Enabled) {
+        $settings.schedule = "Daily"
+        $settings.hour = $schedule_options.OptionsDaily.TimeLocal.Hour
+        $settings.minute = $schedule_options.OptionsDaily.TimeLocal.Minute
+        $settings.day = "Everyday"
+        if ($schedule_options.OptionsDaily.Kind -eq "SelectedDays") {
+            $settings.day = $schedule_options.OptionsDaily.Days
+        }
+    } elseif ($schedule_options.OptionsMonthly.Enabled) {
+        $settings.schedule = "Monthly"
+        $settings.hour = $schedule_options.OptionsMonthly.TimeLocal.Hour
+        $settings.minute = $schedule_options.OptionsMonthly.TimeLocal.Minute
+        $settings.day = $schedule_options.OptionsMonthly.DayOfWeek
+        $settings.day_in_month = $schedule_options.OptionsMonthly.DayNumberInMonth
+        $settings.month = $schedule_options.OptionsMonthly.Months
+    } elseif ($schedule_options.OptionsContinuous.Enabled) {
+        $settings.schedule = "Periodicaly"
+        $settings.period_type = "Continuously"
+    } elseif ($schedule_options.OptionsPeriodically.Enabled) {
+        $settings.schedule = "Periodicaly"
+        $settings.period = $schedule_options.OptionsPeriodically.FullPeriod
+        $settings.period_type = $schedule_options.OptionsPeriodically.Kind
+    } elseif ($schedule_options.OptionsScheduleAfterJob.IsEnabled) {
+        $settings.schedule = "After"
+        $settings.after = $catalog.jobs.Values | ? { $_.Id -eq $job.PreviousJobIdForSchedule } | % { $_.Name }
+    }
+    $settings
+}
 
-Add-PSSnapin VeeamPSSnapin
-try {
-    $job = Get-VBRJob -Name $name
-} catch {
-    Fail-Json $result $_.Exception.Message
+# reads the parameters of a job from obj, those which aren't set there are
+# taken from defaults, the name is required if required is set, hosts and
+# repository if the job should also be present and there is no default
+Function Read-JobDefinition($obj, $defaults, $required) {
+    $state = Get-Attr $obj "state" $defaults.state -ResultObj $result -ValidateSet $states
+    $present = $required -and $state -eq "present"
+    @{
+        name                              = Get-Attr $obj "name" -FailIfEmpty $required
+        state                             = $state
+        hosts                             = Get-Attr $obj "hosts" $defaults.hosts -FailIfEmpty ($present -and $defaults.hosts -eq $null) | % { $_.Split(',').Trim() }
+        repository                        = Get-Attr $obj "repository" $defaults.repository -FailIfEmpty ($present -and $defaults.repository -eq $null)
+        repository_scaleout               = Get-Attr $obj "repository_scaleout" $defaults.repository_scaleout | ConvertTo-Bool
+        proxies                           = Get-Attr $obj "proxies" $defaults.proxies | % { $_.Split(',').Trim() }
+        selection                         = Get-Attr $obj "selection" $defaults.selection         -ResultObj $result -ValidateSet $selections
+        proxy_count                       = Get-Int  $obj "proxy_count" $defaults.proxy_count     -ResultObj $result -Min 1
+        algorithm                         = Get-Attr $obj "algorithm" $defaults.algorithm         -ResultObj $result -ValidateSet $algorithms
+        filesystem_indexing               = Get-Attr $obj "filesystem_indexing" $defaults.filesystem_indexing | ConvertTo-Bool
+        retain_days                       = Get-Int  $obj "retain_days" $defaults.retain_days     -ResultObj $result -Min 1
+        schedule                          = Get-Attr $obj "schedule" $defaults.schedule           -ResultObj $result -ValidateSet $schedules
+        after                             = Get-Attr $obj "after" $defaults.after
+        hour                              = Get-Int  $obj "hour" $defaults.hour                   -ResultObj $result -Max 23
+        minute                            = 0
+        backup_window                     = Get-Attr $obj "backup_window" $defaults.backup_window
+        window_group                      = Get-Attr $obj "window_group" $defaults.window_group
+        window_throughput                 = Get-Int  $obj "window_throughput" $defaults.window_throughput -ResultObj $result -Min 1
+        window_rate                       = Get-Int  $obj "window_rate" $defaults.window_rate     -ResultObj $result -Min 1
+        day                               = Get-Attr $obj "day" $defaults.day                     -ResultObj $result -ValidateSet $days
+        day_in_month                      = Get-Attr $obj "day_in_month" $defaults.day_in_month   -ResultObj $result -ValidateSet $days_in_month
+        month                             = Get-Attr $obj "month" $defaults.month                 -ResultObj $result -ValidateSet $months
+        period                            = Get-Int  $obj "period" $defaults.period               -ResultObj $result -Min 1
+        period_type                       = Get-Attr $obj "period_type" $defaults.period_type     -ResultObj $result -ValidateSet $periods
+        full                              = Get-Attr $obj "full" $defaults.full | ConvertTo-Bool
+        full_type                         = Get-Attr $obj "full_type" $defaults.full_type         -ResultObj $result -ValidateSet $types
+        full_day                          = Get-Attr $obj "full_day" $defaults.full_day           -ResultObj $result -ValidateSet $days
+        full_day_in_month                 = Get-Attr $obj "full_day_in_month" $defaults.full_day_in_month -ResultObj $result -ValidateSet $full_days_in_month
+        full_month                        = Get-Attr $obj "full_month" $defaults.full_month       -ResultObj $result -ValidateSet $months
+        transform_full_to_syntethic       = Get-Attr $obj "transform_full_to_syntethic" $defaults.transform_full_to_syntethic | ConvertTo-Bool
+        transform_increments_to_syntethic = Get-Attr $obj "transform_increments_to_syntethic" $defaults.transform_increments_to_syntethic | ConvertTo-Bool
+        transform_to_syntethic_days       = Get-Attr $obj "transform_to_syntethic_days" $defaults.transform_to_syntethic_days -ResultObj $result -ValidateSet $days
+        vss                               = Get-Attr $obj "vss" $defaults.vss | ConvertTo-Bool
+        user                              = Get-Attr $obj "user" $defaults.user
+    }
 }
 
-if ($state -eq "present") {
-    try {
-        $activeVms = @()
-        $vms = Find-VBRViEntity -Name $hosts
-        foreach ($vm in $vms) {
-            if ($vm.UsedSize -gt 0) {
-                $activeVms += $vm
-            }
+# returns the seconds since the epoch
+Function Get-UnixTime {
+    [int]([DateTime]::UtcNow - [DateTime]"1970-01-01").TotalSeconds
+}
+
+# reads the entity cache, mapping host patterns to the timestamp and the names
+# and used sizes of the entities they matched, a broken cache is rebuilt
+Function Read-EntityCache($path) {
+    $cache = @{}
+    if (Test-Path $path) {
+        try {
+            $data = Get-Content -Path $path -Raw | ConvertFrom-Json
+            $data.PSObject.Properties | % { $cache[$_.Name] = $_.Value }
+        } catch {
+            $cache = @{}
         }
-        if ($activeVms.Length -eq 0) {
-            Fail-Json $result "No active hosts found, ensure both vCenters in your SRM configuration are configured in Veeam and the hosts exist"
+    }
+    $cache
+}
+
+# writes the entity cache, replacing the previous one at once
+Function Write-EntityCache($path, $cache) {
+    $directory = Split-Path $path
+    if (-not (Test-Path $directory)) {
+        New-Item -ItemType Directory -Path $directory | Out-Null
+    }
+    $cache | ConvertTo-Json -Depth 4 -Compress | Set-Content -Path "$path.$PID" -Encoding UTF8
+    Move-Item -Path "$path.$PID" -Destination $path -Force
+}
+
+# creates, changes or disables the job of a definition, adding the changes to
+# job_result, failures are thrown, objects are the entities of the hosts which
+# need to be added to their jobs
+Function Set-VeeamJob($definition, $objects, $job_result) {
+    # the parameters of the job, as local variables
+    foreach ($key in $definition.Keys) {
+        Set-Variable -Name $key -Value $definition[$key]
+    }
+    $job = $catalog.jobs[$name]
+
+    if ($state -eq "absent") {
+        if ($job -ne $null) {
+            $current = Get-JobSettings $job
+            if ($current.enabled -or $current.scheduled) {
+                if (-not $check_mode) {
+                    if ($current.scheduled) {
+                        Disable-VBRJobSchedule -Job $job | Out-Null
+                    }
+                    if ($current.enabled) {
+                        Disable-VBRJob -Job $job | Out-Null
+                    }
+                }
+                $job_result.changes += "Disabled backup job '$name' (there is currently no Powershell commandlet to remove jobs)"
+            }
         }
-    } catch {
-        Fail-Json $result $_.Exception.Message
+        return
+    }
+
+    # the names of the hosts using disk space, those missing in the job were
+    # resolved to their entities, the others are skipped, hosts which are gone
+    # must neither be added nor count as active
+    $vanished = @(@($active) + @($missing) | ? { $gone -contains $_ } | Sort-Object -Unique)
+    if ($vanished.Length -gt 0) {
+        throw "Hosts $($vanished -join ', ') no longer exist but are still active in backup job '$name'"
     }
+    $new_vms = @($objects | ? { $missing -contains $_.Name -and $gone -notcontains $_.Name })
+    if ($active.Length -eq 0 -or ($job -eq $null -and $new_vms.Length -eq 0)) {
+        throw "No active hosts found, ensure both vCenters in your SRM configuration are configured in Veeam and the hosts exist"
+    }
+
+    $created = $false
     if ($job -eq $null) {
         if (-not $check_mode) {
-            try {
-                if ($repository_scaleout) {
-                    $repo = Get-VBRBackupRepository -Name $repository -ScaleOut
-                } else {
-                    $repo = Get-VBRBackupRepository -Name $repository
-                }
-                Add-VBRViBackupJob -Name $name -Entity $activeVms -BackupRepository $repo | Out-Null
-                $job = Get-VBRJob -Name $name
-            } catch {
-                Fail-Json $result $_.Exception.Message
+            if ($repository_scaleout) {
+                $repo = $catalog.scaleout_repositories[$repository]
+            } else {
+                $repo = $catalog.repositories[$repository]
             }
+            if ($repo -eq $null) {
+                throw "Backup repository '$repository' not found"
+            }
+            Add-VBRViBackupJob -Name $name -Entity $new_vms -BackupRepository $repo | Out-Null
+            $job = Get-VBRJob -Name $name
+            $catalog.jobs[$name] = $job
         }
-        $result.changes += "Added new backup job '$name'"
-    } else {
+        $created = $true
+        $job_result.changes += "Added new backup job '$name'"
+    } elseif ($new_vms.Length -gt 0) {
         if (-not $check_mode) {
-            try {
-                Add-VBRViJobObject -Job $job -Entities $activeVms | Out-Null
-            } catch {
-                Fail-Json $result $_.Exception.Message
-            }
+            Add-VBRViJobObject -Job $job -Entities $new_vms | Out-Null
         }
-        $result.changes += "Updated backup job '$name'"
+        $job_result.changes += "Added hosts $(($new_vms | % { $_.Name } | Sort-Object -Unique) -join ', ') to backup job '$name'"
     }
 
     if ($vss -and $user -ne $null) {
-        try {
-            $credentials = Get-VBRCredentials -Name $user
-            $vss_options = New-VBRJobVssOptions -ForJob
-            $vss_options.Enabled = $true
-            $vss_options.VssSnapshotOptions.IsCopyOnly = $true
-        } catch {
-            Fail-Json $result $_.Exception.Message
+        $credentials = $catalog.credentials[$user]
+        if ($credentials -eq $null) {
+            throw "Credentials of user '$user' not found"
         }
+        $vss_options = New-VBRJobVssOptions -ForJob
+        $vss_options.Enabled = $true
+        $vss_options.VssSnapshotOptions.IsCopyOnly = $true
     }
 
-    $job_options = New-VBRJobOptions -ForBackupJob
-    $job_options.BackupStorageOptions.RetainCycles = $retain_days
-    $job_options.BackupStorageOptions.RetainDays = $retain_days
-
     $schedule_params = @{
         Job = $job
     }
     $schedule_params.Add($schedule, $true)
     if ($schedule -eq "Daily" -or $schedule -eq "Monthly") {
-        $schedule_params.Add("At", "$($hour):00")
+        $schedule_params.Add("At", ("{0}:{1:D2}" -f $hour, $minute))
         if ($day -ne $null) {
             $schedule_params.Add("Days", $day)
         }
@@ -188,7 +342,10 @@ if ($state -eq "present") {
         }
     } elseif ($schedule -eq "After") {
         if ($after -ne $null) {
-            $schedule_params.Add("AfterJob", (Get-VSBJob -Name $after))
+            if (-not $catalog.jobs.ContainsKey($after)) {
+                throw "Backup job '$after' to run after not found"
+            }
+            $schedule_params.Add("AfterJob", $catalog.jobs[$after])
         }
     }
 
@@ -225,50 +382,737 @@ if ($state -eq "present") {
         $advanced_params.Add("TransformToSyntethicDays", $transform_to_syntethic_days)
     }
 
-    if (-not $check_mode) {
-        try {
+    # the settings the job should have, named like the parameters, settings
+    # which aren't set by the parameters are left as they are
+    $wanted = @{
+        retain_days = $retain_days
+        algorithm = $algorithm
+        schedule = $schedule
+        transform_full_to_syntethic = $transform_full_to_syntethic
+        transform_increments_to_syntethic = $transform_increments_to_syntethic
+        filesystem_indexing = $filesystem_indexing
+        proxies = "AutoDetect"
+        enabled = $true
+        scheduled = $true
+    }
+    if ($schedule -eq "Daily" -or $schedule -eq "Monthly") {
+        $wanted.hour = $hour
+        $wanted.minute = $minute
+        $wanted.day = $day
+    }
+    if ($schedule -eq "Daily" -and $day -eq $null) {
+        $wanted.day = "Everyday"
+    } elseif ($schedule -eq "Monthly") {
+        if ($day -ne $null) {
+            $wanted.day_in_month = $day_in_month
+        }
+        $wanted.month = $month
+    } elseif ($schedule -eq "Periodicaly") {
+        $wanted.period = $period
+        $wanted.period_type = $period_type
+    } elseif ($schedule -eq "After") {
+        $wanted.after = $after
+    }
+    if ($full) {
+        $wanted.full = $true
+        $wanted.full_type = $full_type
+        $wanted.full_day = $full_day
+        $wanted.full_day_in_month = $full_day_in_month
+        $wanted.full_month = $full_month
+    }
+    $wanted.transform_to_syntethic_days = $transform_to_syntethic_days
+    if ($vss -and $user -ne $null) {
+        $wanted.vss = $true
+        $wanted.user = $user
+    }
+    if ($proxies.Length -gt 0) {
+        $wanted.proxies = $proxies
+    }
+
+    # compare them with the current settings, read once, a new job gets all
+    # settings that differ from the defaults, without listing them
+    $current = @{}
+    if ($job -ne $null) {
+        $current = Get-JobSettings $job
+    }
+    $differences = @()
+    foreach ($setting in ($wanted.Keys | Sort-Object)) {
+        $to = Format-Setting $wanted[$setting]
+        if ($to -eq "") {
+            continue
+        }
+        $from = Format-Setting $current[$setting]
+        if ($from -ne $to) {
+            $differences += $setting
+            if (-not $created) {
+                $job_result.changes += "Changed $setting of backup job '$name' from '$from' to '$to'"
+            }
+        }
+    }
+    $schedule_settings = @("schedule","hour","minute","day","day_in_month","month","period","period_type","after")
+    $advanced_settings = @("algorithm","full","full_type","full_day","full_day_in_month","full_month","transform_full_to_syntethic","transform_increments_to_syntethic","transform_to_syntethic_days")
+
+    if (-not $check_mode -and $job -ne $null) {
+        if ($differences -contains "retain_days") {
+            # keep the other options of the job
+            $job_options = (Get-JobOptions $job).options
+            $job_options.BackupStorageOptions.RetainCycles = $retain_days
+            $job_options.BackupStorageOptions.RetainDays = $retain_days
             Set-VBRJobOptions -Job $job -Options $job_options | Out-Null
-            Set-VBRJobSchedule @schedule_params | Out-Null
             Set-VBRJobAdvancedOptions -Job $job -RetainDays $retain_days | Out-Null
+        }
+        if (@($differences | ? { $schedule_settings -contains $_ }).Length -gt 0) {
+            Set-VBRJobSchedule @schedule_params | Out-Null
+        }
+        if (@($differences | ? { $advanced_settings -contains $_ }).Length -gt 0) {
             Set-VBRJobAdvancedBackupOptions @advanced_params | Out-Null
+        }
+        if ($differences -contains "filesystem_indexing") {
             if ($filesystem_indexing) {
                 Enable-VBRJobGuestFSIndexing -Job $job | Out-Null
             } else {
                 Disable-VBRJobGuestFSIndexing -Job $job | Out-Null
             }
-            if ($vss -and $user -ne $null) {
-                Set-VBRJobVssOptions -Job $job -Options $vss_options | Out-Null
-                Set-VBRJobVssOptions -Job $job -Credential $credentials | Out-Null
-            }
+        }
+        if ($differences -contains "vss" -or $differences -contains "user") {
+            Set-VBRJobVssOptions -Job $job -Options $vss_options | Out-Null
+            Set-VBRJobVssOptions -Job $job -Credential $credentials | Out-Null
+        }
+        if ($differences -contains "proxies") {
             if ($proxies.Length -gt 0) {
-                $viproxies = Get-VBRViProxy -Name $proxies
+                $viproxies = @($proxies | ? { $catalog.proxies.ContainsKey($_) } | % { $catalog.proxies[$_] })
+                if ($viproxies.Length -lt @($proxies).Length) {
+                    throw "Backup proxies not found: $(($proxies | ? { -not $catalog.proxies.ContainsKey($_) }) -join ', ')"
+                }
                 Set-VBRJobProxy -Job $job -Proxy $viproxies | Out-Null
             } else {
                 Set-VBRJobProxy -Job $job -AutoDetect | Out-Null
             }
+        }
+        if ($differences -contains "scheduled") {
             Enable-VBRJobSchedule -Job $job | Out-Null
+        }
+        if ($differences -contains "enabled") {
             Enable-VBRJob -Job $job | Out-Null
+        }
+    }
+}
+
+# returns the sessions of backup jobs created in the last days, in a single
+# query, mapping the ids of the jobs to their sessions, the latest first
+Function Get-SessionHistory($days) {
+    $history = @{}
+    [Veeam.Backup.Core.CBackupSession]::GetByTypeAndTimeInterval("Backup", (Get-Date).AddDays(-$days), (Get-Date)) |
+        Sort-Object CreationTime -Descending | % {
+            $key = "$($_.JobId)"
+            if (-not $history.ContainsKey($key)) {
+                $history[$key] = New-Object System.Collections.ArrayList
+            }
+            [void]$history[$key].Add($_)
+        }
+    $history
+}
+
+# estimates the seconds a job runs and the bytes per second it moves from the
+# last five sessions which didn't fail or, without any, from the used size of
+# its hosts and the rate in MB/s
+Function Get-JobEstimate($job, $size, $rate) {
+    $sessions = @()
+    if ($job -ne $null -and $catalog.sessions.ContainsKey("$($job.Id)")) {
+        $sessions = @($catalog.sessions["$($job.Id)"] | ? { $_.Result -ne "Failed" -and $_.EndTime -gt $_.CreationTime } | Select-Object -First 5)
+    }
+    if ($sessions.Length -gt 0) {
+        $duration = ($sessions | % { ($_.EndTime - $_.CreationTime).TotalSeconds } | Measure-Object -Average).Average
+        $processed = ($sessions | % { $_.Progress.ProcessedSize } | Measure-Object -Average).Average
+        $basis = "history"
+    } else {
+        $duration = $size / ($rate * 1MB)
+        $processed = $size
+        $basis = "size"
+    }
+    $duration = [Math]::Max($duration, 60)
+    @{
+        duration = $duration
+        rate = $processed / $duration
+        basis = $basis
+    }
+}
+
+# returns the quarter hours of the day covered by a window like 22-6
+Function Get-WindowSlots($window) {
+    $start, $end = $window.Split("-") | % { [int]$_ * 4 }
+    0..((($end - $start + 96) % 96) - 1) | % { ($start + $_) % 96 }
+}
+
+# staggers the start times of the jobs of the definitions within their backup
+# windows in quarter hours, so that the throughput of the jobs of a group, by
+# default those on the same repository, stays below its ceiling, counting the
+# other scheduled jobs on its repositories, larger jobs are placed first
+Function Get-BackupPlan($windowed) {
+    $groups = @{}
+    foreach ($definition in $windowed) {
+        $group = $definition.window_group
+        if ($group -eq $null) {
+            $group = $definition.repository
+        }
+        if (-not $groups.ContainsKey($group)) {
+            $groups[$group] = @{
+                load = New-Object double[] 96
+                ceiling = $definition.window_throughput * 1MB
+                repositories = @()
+                definitions = @()
+            }
+        }
+        $groups[$group].ceiling = [Math]::Min($groups[$group].ceiling, $definition.window_throughput * 1MB)
+        $groups[$group].repositories += $definition.repository
+        $groups[$group].definitions += $definition
+        $estimate = Get-JobEstimate $catalog.jobs[$definition.name] $definition.size $definition.window_rate
+        $definition.estimate = $estimate
+    }
+
+    # the load of the other jobs with a daily or monthly schedule
+    $planned = @($windowed | % { $_.name })
+    foreach ($job in @($catalog.jobs.Values | ? { $planned -notcontains $_.Name -and $_.IsScheduleEnabled })) {
+        $job_schedule = Get-JobSchedule $job
+        $schedule_options = $job_schedule.options
+        if ($schedule_options.OptionsDaily.Enabled) {
+            $time = $schedule_options.OptionsDaily.TimeLocal
+        } elseif ($schedule_options.OptionsMonthly.Enabled) {
+            $time = $schedule_options.OptionsMonthly.TimeLocal
+        } else {
+            continue
+        }
+        $repository = $job_schedule.repository
+        $estimate = Get-JobEstimate $job 0 1
+        if ($estimate.basis -ne "history") {
+            continue
+        }
+        foreach ($group in @($groups.Values | ? { $_.repositories -contains $repository })) {
+            $slot = $time.Hour * 4 + [Math]::Floor($time.Minute / 15)
+            for ($i = 0; $i -lt [Math]::Min([Math]::Ceiling($estimate.duration / 900), 96); $i++) {
+                $group.load[($slot + $i) % 96] += $estimate.rate
+            }
+        }
+    }
+
+    foreach ($group_name in @($groups.Keys | Sort-Object)) {
+        $group = $groups[$group_name]
+        foreach ($definition in @($group.definitions | Sort-Object { $_.estimate.duration * $_.estimate.rate } -Descending)) {
+            $estimate = $definition.estimate
+            $length = [int][Math]::Min([Math]::Ceiling($estimate.duration / 900), 96)
+            $best = $null
+            $best_peak = [double]::MaxValue
+            # only the starts from which the job ends within the window, or
+            # the start of the window if the job takes longer than it
+            $window = @(Get-WindowSlots $definition.backup_window)
+            $fits = $length -le $window.Length
+            $starts = @($window[0])
+            if ($fits) {
+                $starts = @($window[0..($window.Length - $length)])
+            }
+            foreach ($slot in $starts) {
+                $peak = 0
+                for ($i = 0; $i -lt $length; $i++) {
+                    $peak = [Math]::Max($peak, $group.load[($slot + $i) % 96] + $estimate.rate)
+                }
+                # the earliest start below the ceiling, else the lowest peak
+                if ($peak -le $group.ceiling) {
+                    $best = $slot
+                    $best_peak = $peak
+                    break
+                }
+                if ($peak -lt $best_peak) {
+                    $best = $slot
+                    $best_peak = $peak
+                }
+            }
+            for ($i = 0; $i -lt $length; $i++) {
+                $group.load[($best + $i) % 96] += $estimate.rate
+            }
+            $definition.hour = [int][Math]::Floor($best / 4)
+            $definition.minute = ($best % 4) * 15
+            New-Object PSObject -Property @{
+                job = $definition.name
+                group = $group_name
+                start = "{0:D2}:{1:D2}" -f $definition.hour, $definition.minute
+                size_gb = [Math]::Round($definition.size / 1GB, 1)
+                duration_minutes = [Math]::Round($estimate.duration / 60)
+                rate_mbps = [Math]::Round($estimate.rate / 1MB, 1)
+                estimate = $estimate.basis
+                peak_mbps = [Math]::Round($best_peak / 1MB, 1)
+                below_ceiling = $best_peak -le $group.ceiling
+                fits_window = $fits
+            }
+        }
+    }
+}
+
+# returns the load of a repository or proxy with the given task slots, to
+# which the jobs using it, their recent throughput and the free space are added
+Function Get-ResourceLoad($resource, $slots) {
+    @{
+        name = $resource.Name
+        slots = [Math]::Max([int]$slots, 1)
+        jobs = 0
+        rate = 0.0
+        free = $null
+        current = $false
+    }
+}
+
+# orders resources by jobs per task slot, then recent throughput per task slot,
+# the current ones of a job first, then by free space
+Function Sort-ByLoad($loads) {
+    $loads | Sort-Object @{ Expression = { $_.jobs / $_.slots } }, @{ Expression = { $_.rate / $_.slots } }, @{ Expression = { $_.current }; Descending = $true }, @{ Expression = { $_.free }; Descending = $true }
+}
+
+# describes the load of a repository or proxy
+Function Format-Load($load) {
+    $reason = "$($load.jobs) jobs on $($load.slots) task slots, $([Math]::Round($load.rate / 1MB, 1)) MB/s in recent sessions"
+    if ($load.free -ne $null) {
+        $reason += ", $([Math]::Round($load.free / 1GB)) GB free"
+    }
+    $reason
+}
+
+# assigns the new jobs of the definitions to the least loaded of their
+# candidate repositories with enough free space, and all of them to the least
+# loaded proxy_count of their candidate proxies, the load being measured from
+# the task slots, the jobs assigned to them, the throughput of those jobs in
+# recent sessions and the free space, returns the assignments and reasons
+Function Select-Resources($selected) {
+    $repositories = @{}
+    foreach ($repo in @($catalog.repositories.Values) + @($catalog.scaleout_repositories.Values)) {
+        # repositories without a limit count as the default of four slots
+        $slots = 4
+        try {
+            if ($repo.Options.IsTaskCountLimitEnabled) {
+                $slots = $repo.Options.MaxTaskCount
+            }
         } catch {
-            Fail-Json $result $_.Exception.Message
+            # scale out repositories don't have task slots
         }
+        $load = Get-ResourceLoad $repo $slots
+        try {
+            $load.free = $repo.GetContainer().CachedFreeSpace.InBytes
+        } catch {
+            # nor a single container
+        }
+        $repositories["$($repo.Id)"] = $load
     }
-} elseif ($state -eq "absent") {
-    if ($job -ne $null) {
-        if (-not $check_mode) {
-            try {
-                Disable-VBRJobSchedule -Job $job | Out-Null
-                Disable-VBRJob -Job $job | Out-Null
-            } catch {
-                Fail-Json $result $_.Exception.Message
+    $proxies = @{}
+    foreach ($proxy in $catalog.proxies.Values) {
+        $proxies[$proxy.Name] = Get-ResourceLoad $proxy $proxy.Options.MaxTasksCount
+    }
+
+    # the load of all jobs, the current assignment of the selected jobs is
+    # only kept as a preference
+    $names = @($selected | % { $_.name })
+    $current = @{}
+    $all_proxies = Get-JobProxies
+    foreach ($job in $catalog.jobs.Values) {
+        $estimate = Get-JobEstimate $job 0 1
+        $rate = 0
+        if ($estimate.basis -eq "history") {
+            $rate = $estimate.rate
+        }
+        $job_proxies = $all_proxies[$job.Name]
+        $repo_load = $repositories["$($job.Info.TargetRepositoryId)"]
+        if ($names -contains $job.Name) {
+            $current[$job.Name] = @{ repository = $repo_load; proxies = $job_proxies; rate = $rate }
+            continue
+        }
+        if ($repo_load -ne $null) {
+            $repo_load.jobs += 1
+            $repo_load.rate += $rate
+        }
+        foreach ($name in $job_proxies) {
+            if ($proxies.ContainsKey($name)) {
+                $proxies[$name].jobs += 1
+                $proxies[$name].rate += $rate
             }
         }
-        $result.changes += "Disabled backup job '$name' (there is currently no Powershell commandlet to remove jobs)"
+    }
+
+    foreach ($definition in @($selected | Sort-Object { $_.size } -Descending)) {
+        $assignment = New-Object PSObject -Property @{
+            job = $definition.name
+            repository = $null
+            repository_reason = $null
+            proxies = @()
+            proxy_reasons = @()
+        }
+        $rate = (Get-JobEstimate $null $definition.size $definition.window_rate).rate
+        $job_current = $current[$definition.name]
+        if ($job_current -ne $null) {
+            $rate = [Math]::Max($job_current.rate, 0)
+        }
+
+        if ($job_current -ne $null) {
+            # backups aren't moved, existing jobs keep their repository
+            $repo_load = $job_current.repository
+            if ($repo_load -ne $null) {
+                $assignment.repository = $repo_load.name
+                $assignment.repository_reason = "existing jobs keep their repository, $(Format-Load $repo_load)"
+                $definition.repository = $repo_load.name
+            }
+        } else {
+            $candidates = @($definition.repository.Split(',').Trim())
+            $loads = @($repositories.Values | ? { $candidates -contains $_.name })
+            if ($loads.Length -eq 0) {
+                throw "None of the backup repositories $($candidates -join ', ') found for backup job '$($definition.name)'"
+            }
+            $fitting = @($loads | ? { $_.free -eq $null -or $_.free -ge $definition.size })
+            if ($fitting.Length -gt 0) {
+                $repo_load = @(Sort-ByLoad $fitting)[0]
+                $assignment.repository_reason = "least loaded, $(Format-Load $repo_load)"
+            } else {
+                $repo_load = @($loads | Sort-Object { $_.free } -Descending)[0]
+                $assignment.repository_reason = "no repository has $([Math]::Round($definition.size / 1GB)) GB free, most free space, $(Format-Load $repo_load)"
+            }
+            $assignment.repository = $repo_load.name
+            $definition.repository = $repo_load.name
+        }
+        if ($repo_load -ne $null) {
+            $repo_load.jobs += 1
+            $repo_load.rate += $rate
+            if ($repo_load.free -ne $null -and $job_current -eq $null) {
+                $repo_load.free -= $definition.size
+            }
+        }
+
+        if ($definition.proxies.Length -gt 0) {
+            $loads = @($definition.proxies | ? { $proxies.ContainsKey($_) } | % { $proxies[$_] })
+            if ($loads.Length -eq 0) {
+                throw "None of the backup proxies $(@($definition.proxies) -join ', ') found for backup job '$($definition.name)'"
+            }
+            foreach ($load in $loads) {
+                $load.current = $job_current -ne $null -and $job_current.proxies -contains $load.name
+            }
+            $chosen = @(Sort-ByLoad $loads | Select-Object -First $definition.proxy_count)
+            foreach ($load in $chosen) {
+                $assignment.proxy_reasons += "$($load.name): least loaded, $(Format-Load $load)"
+                $load.jobs += 1
+                $load.rate += $rate / $chosen.Length
+            }
+            $assignment.proxies = @($chosen | % { $_.name })
+            $definition.proxies = $assignment.proxies
+        }
+        $assignment
     }
 }
 
-$result.success = $true
+# returns the duration, sizes, rate and bottleneck of the last sessions of a
+# job which completed in the last history_days, the latest first, with their
+# averages
+Function Get-JobPerformance($job, $count) {
+    $sessions = @()
+    if ($catalog.sessions.ContainsKey("$($job.Id)")) {
+        $sessions = @($catalog.sessions["$($job.Id)"] | ? { $_.State -eq "Stopped" -and $_.EndTime -gt $_.CreationTime } | Select-Object -First $count | % {
+            $bottleneck = $_.Progress.BottleneckInfo
+            @{
+                start = $_.CreationTime.ToString("s")
+                result = "$($_.Result)"
+                full = $_.IsFullMode
+                duration = [int]($_.EndTime - $_.CreationTime).TotalSeconds
+                processed = $_.Progress.ProcessedSize
+                read = $_.Progress.ReadSize
+                transferred = $_.Progress.TransferedSize
+                rate_mbps = [Math]::Round($_.Progress.AvgSpeed / 1MB, 1)
+                bottleneck = "$($bottleneck.Bottleneck)"
+                load = @{
+                    source = $bottleneck.Source
+                    proxy = $bottleneck.Proxy
+                    network = $bottleneck.Network
+                    target = $bottleneck.Target
+                }
+            }
+        })
+    }
+    $performance = @{
+        job = $job.Name
+        history_days = $history_days
+        sessions = $sessions
+        duration = $null
+        rate_mbps = $null
+    }
+    if ($sessions.Length -gt 0) {
+        $performance.duration = [int]($sessions | % { $_.duration } | Measure-Object -Average).Average
+        $performance.rate_mbps = [Math]::Round(($sessions | % { $_.rate_mbps } | Measure-Object -Average).Average, 1)
+    }
+    $performance
+}
+
+# returns the seconds elapsed on a stopwatch, restarting it
+Function Get-Seconds($stopwatch) {
+    [Math]::Round($stopwatch.Elapsed.TotalSeconds, 3)
+    $stopwatch.Reset()
+    $stopwatch.Start()
+}
+
+# variables
+$result = New-Object PSObject -Property @{
+    changed = $false
+    changes = @()
+    success = $false
+    timing = @{}
+}
+$states             = @("present","absent","facts")
+$days               = @("Sunday","Monday","Tuesday","Wednesday","Thursday","Friday","Saturday")
+$days_in_month      = @("First","Second","Third","Forth","Last","OnDay")
+$full_days_in_month = @("First","Second","Third","Forth","Last")
+$months             = @("January","February","March","April","May","June","July","August","September","October","November","December")
+$algorithms         = @("ReverseIncremental","Incremental")
+$schedules          = @("Daily","Monthly","Periodicaly","After")
+$periods            = @("Hours","Minutes","Continuously")
+$types              = @("Daily","Monthly")
+$selections         = @("fixed","load")
+
+# the facts returned
+$facts = @{}
+
+# the objects of the Veeam server used by the jobs, each fetched once per run
+$catalog = @{
+    jobs = @{}
+    credentials = @{}
+    repositories = @{}
+    scaleout_repositories = @{}
+    proxies = @{}
+    sessions = @{}
+    options = @{}
+    schedules = @{}
+    job_proxies = $null
+}
+
+
+
+# parameter validation, defaults are based on the Veeam Powershell documentation,
+# the parameters of the jobs list default to those set for the module
+$params = Parse-Args $args $true;
+$check_mode       = Get-Attr $params "_ansible_check_mode" $false | ConvertTo-Bool
+$jobs             = Get-Attr $params "jobs"
+$entity_cache     = Get-Attr $params "entity_cache" $false | ConvertTo-Bool
+$entity_cache_ttl = Get-Int  $params "entity_cache_ttl" 3600 -ResultObj $result
+$cache_dir        = Get-Attr $params "cache_dir" (Join-Path $env:ProgramData "Ansible\veeam_cache")
+$history_days     = Get-Int  $params "history_days" 14 -ResultObj $result -Min 1
+$session_count    = Get-Int  $params "session_count" 5 -ResultObj $result -Min 1
+$builtin          = @{
+    state = "present"
+    repository_scaleout = $false
+    selection = "fixed"
+    proxy_count = 1
+    algorithm = "Incremental"
+    filesystem_indexing = $false
+    retain_days = 14
+    schedule = "Daily"
+    hour = 10
+    window_throughput = 200
+    window_rate = 50
+    full = $false
+    transform_full_to_syntethic = $false
+    transform_increments_to_syntethic = $false
+    vss = $false
+}
+$defaults = Read-JobDefinition $params $builtin ($jobs -eq $null)
+if ($jobs -eq $null) {
+    $definitions = @($defaults)
+} else {
+    $definitions = @($jobs | % { Read-JobDefinition $_ $defaults $true })
+    $names = @($definitions | % { $_.name })
+    if (@($names | Sort-Object -Unique).Length -lt $names.Length) {
+        Fail-Json $result "The names of the jobs must be unique"
+    }
+}
+foreach ($definition in $definitions) {
+    if ($definition.backup_window -eq $null) {
+        continue
+    }
+    if ($definition.backup_window -notmatch '^(\d{1,2})-(\d{1,2})$' -or [int]$matches[1] -gt 23 -or [int]$matches[2] -gt 23 -or [int]$matches[1] -eq [int]$matches[2]) {
+        Fail-Json $result "Argument backup_window needs to be two different hours between 0 and 23 like 22-6 but was $($definition.backup_window)."
+    }
+    if ($definition.schedule -ne "Daily" -and $definition.schedule -ne "Monthly") {
+        Fail-Json $result "Argument backup_window can only be used with Daily and Monthly schedules."
+    }
+}
+
+
+
+$stopwatch = [Diagnostics.Stopwatch]::StartNew()
+Add-PSSnapin VeeamPSSnapin
+$result.timing.snapin = Get-Seconds $stopwatch
+
+# the jobs, credentials, repositories and proxies are fetched in one call each
+$present = @($definitions | ? { $_.state -eq "present" })
+try {
+    Get-VBRJob | % { $catalog.jobs[$_.Name] = $_ }
+    Get-VBRCredentials | % { $catalog.credentials[$_.Name] = $_ }
+    $new_jobs = @($present | ? { -not $catalog.jobs.ContainsKey($_.name) })
+    $selected = @($present | ? { $_.selection -eq "load" })
+    if (@($new_jobs + $selected | ? { -not $_.repository_scaleout }).Length -gt 0) {
+        Get-VBRBackupRepository | % { $catalog.repositories[$_.Name] = $_ }
+    }
+    if (@($new_jobs + $selected | ? { $_.repository_scaleout }).Length -gt 0) {
+        Get-VBRBackupRepository -ScaleOut | % { $catalog.scaleout_repositories[$_.Name] = $_ }
+    }
+    if (@($present | ? { $_.proxies.Length -gt 0 }).Length -gt 0) {
+        Get-VBRViProxy | % { $catalog.proxies[$_.Name] = $_ }
+    }
+    $reported = @($definitions | ? { $_.state -eq "facts" })
+    if ($selected.Length -gt 0 -or $reported.Length -gt 0 -or @($present | ? { $_.backup_window -ne $null }).Length -gt 0) {
+        $catalog.sessions = Get-SessionHistory $history_days
+    }
+} catch {
+    Fail-Json $result $_.Exception.Message
+}
+$result.timing.lookup = Get-Seconds $stopwatch
+
+# the host patterns of all jobs are resolved in a single sweep, unless they
+# are in the entity cache and younger than its ttl
+$cache_path = Join-Path $cache_dir "entities.json"
+$cache = @{}
+if ($entity_cache) {
+    $cache = Read-EntityCache $cache_path
+}
+$now = Get-UnixTime
+$patterns = @($present | % { $_.hosts } | Sort-Object -Unique)
+$stale = @($patterns | ? { -not $cache.ContainsKey($_) -or $now - $cache[$_].timestamp -gt $entity_cache_ttl })
+$cached = @($patterns | ? { $stale -notcontains $_ } | % { $cache[$_].entities }).Length
+$live = @()
+$gone = @()
+try {
+    if ($stale.Length -gt 0) {
+        $live = @(Find-VBRViEntity -Name $stale)
+        foreach ($pattern in $stale) {
+            $cache[$pattern] = @{
+                timestamp = $now
+                entities = @($live | ? { $_.Name -like $pattern } | % { @{ name = $_.Name; used_size = $_.UsedSize } })
+            }
+        }
+    }
+
+    # hosts which are already in their job are skipped, the entities of the
+    # others are looked up by name if they came from the cache
+    $sizes = @{}
+    $patterns | % { $cache[$_].entities } | ? { $_.used_size -gt $sizes[$_.name] } | % { $sizes[$_.name] = $_.used_size }
+    foreach ($definition in $present) {
+        $definition.active = @($definition.hosts | % { $cache[$_].entities } | ? { $_.used_size -gt 0 } | % { $_.name } | Sort-Object -Unique)
+        $definition.size = [long]($definition.active | % { $sizes[$_] } | Measure-Object -Sum).Sum
+        $definition.missing = $definition.active
+        $job = $catalog.jobs[$definition.name]
+        if ($job -ne $null) {
+            $job_vms = @($job.GetObjectsInJob() | ? { $_.Type -eq "Include" } | % { $_.Name })
+            $definition.missing = @($definition.active | ? { $job_vms -notcontains $_ })
+        }
+    }
+    $needed = @($present | % { $_.missing } | Sort-Object -Unique)
+    $objects = @($live | ? { $_.UsedSize -gt 0 -and $needed -contains $_.Name })
+    $resolved = @($objects | % { $_.Name })
+    $unresolved = @($needed | ? { $resolved -notcontains $_ })
+    if ($unresolved.Length -gt 0) {
+        $found = @(Find-VBRViEntity -Name $unresolved | ? { $_.UsedSize -gt 0 })
+        $live = $live + $found
+        $objects = $objects + $found
+        # patterns which matched hosts that are gone are swept again next time
+        $gone = @($unresolved | ? { @($found | % { $_.Name }) -notcontains $_ })
+        foreach ($pattern in @($cache.Keys)) {
+            if (@($cache[$pattern].entities | ? { $gone -contains $_.name }).Length -gt 0) {
+                $cache.Remove($pattern)
+            }
+        }
+        # and the hosts themselves are no longer active in their jobs
+        foreach ($definition in $present) {
+            $definition.active = @($definition.active | ? { $gone -notcontains $_ })
+            $definition.size = [long]($definition.active | % { $sizes[$_] } | Measure-Object -Sum).Sum
+            $definition.missing = @($definition.missing | ? { $gone -notcontains $_ })
+        }
+    }
+    if ($entity_cache -and ($stale.Length -gt 0 -or $gone.Length -gt 0)) {
+        Write-EntityCache $cache_path $cache
+    }
+} catch {
+    Fail-Json $result $_.Exception.Message
+}
+Set-Attr $result "entities" @{
+    cached = $cached
+    live = $live.Length
+    skipped = [int]($present | % { $_.active.Length - $_.missing.Length } | Measure-Object -Sum).Sum
+}
+$result.timing.entities = Get-Seconds $stopwatch
+
+# jobs selecting their repository and proxies by load get the least loaded
+if ($selected.Length -gt 0) {
+    try {
+        Set-Attr $result "selection" @(Select-Resources $selected)
+    } catch {
+        Fail-Json $result $_.Exception.Message
+    }
+    $result.timing.selection = Get-Seconds $stopwatch
+}
+
+# jobs with a backup window start when the load of their group is lowest
+$windowed = @($present | ? { $_.backup_window -ne $null })
+if ($windowed.Length -gt 0) {
+    try {
+        $plan = @(Get-BackupPlan $windowed)
+    } catch {
+        Fail-Json $result $_.Exception.Message
+    }
+    $facts.veeam_backup_plan = $plan
+    $result.timing.plan = Get-Seconds $stopwatch
+}
+
+# the performance of the last sessions of the jobs matching the names of those
+# definitions whose state is facts
+if ($reported.Length -gt 0) {
+    $patterns = @($reported | % { $_.name })
+    $names = @($catalog.jobs.Keys | ? { $name = $_; @($patterns | ? { $name -like $_ }).Length -gt 0 } | Sort-Object)
+    if ($names.Length -eq 0) {
+        Fail-Json $result "No backup jobs matching $($patterns -join ', ') found"
+    }
+    try {
+        $facts.veeam_job_sessions = @($names | % { Get-JobPerformance $catalog.jobs[$_] $session_count })
+    } catch {
+        Fail-Json $result $_.Exception.Message
+    }
+    $result.timing.facts = Get-Seconds $stopwatch
+}
+if ($facts.Count -gt 0) {
+    Set-Attr $result "ansible_facts" $facts
+}
+
+$job_results = @()
+foreach ($definition in @($definitions | ? { $_.state -ne "facts" })) {
+    $job_result = New-Object PSObject -Property @{
+        name = $definition.name
+        changed = $false
+        changes = @()
+        success = $false
+        duration = $null
+    }
+    try {
+        Set-VeeamJob $definition $objects $job_result | Out-Null
+        $job_result.success = $true
+    } catch {
+        Set-Attr $job_result "msg" $_.Exception.Message
+    }
+    $job_result.changed = $job_result.changes.Length -gt 0
+    $job_result.duration = Get-Seconds $stopwatch
+    $job_results += $job_result
+}
+
+$result.changes = @($job_results | % { $_.changes })
 if ($result.changes.Length -gt 0) {
     $result.changed = $true
 }
+if ($jobs -ne $null) {
+    Set-Attr $result "jobs" $job_results
+}
+$failed = @($job_results | ? { -not $_.success })
+if ($failed.Length -gt 0) {
+    if ($jobs -eq $null) {
+        Fail-Json $result $failed[0].msg
+    }
+    Fail-Json $result "$($failed.Length) of $($job_results.Length) backup jobs failed: $(($failed | % { $_.name }) -join ', ')"
+}
+$result.success = $true
 Exit-Json $result
-
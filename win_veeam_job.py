@@ -33,29 +33,35 @@ notes:
     - This module must be executed on the Veeam server
     - This module supports VMware vSphere backups, Microsoft Hyper-V currently isn't supported
     - Tested on VMware Veeam 9.0 and VMware vSphere 5.5
+    - The current settings of an existing job are read first and only those that differ are changed, the changes are listed in the result. Settings whose parameters aren't set are left as they are, hosts are only ever added to a job.
 requirements:
     - "pywinrm>=0.1.1"
 options:
   name:
     description:
-      - Name of the backup job to create, change or disable on the Veeam server.
-    required: true
+      - Name of the backup job to create, change or disable on the Veeam server. Required unless jobs is set.
+    required: false
+  jobs:
+    description:
+      - List of backup jobs to create, change or disable in a single run, each a dict of the options of this module, at least the name. Options not set in a job are taken from the options of the module. The Veeam snap-in is loaded and the jobs, repositories, proxies and credentials are fetched once and the hosts of all jobs are resolved in a single sweep. The results of the jobs, with their changes and the seconds they took, are returned in jobs, the seconds spent on loading the snap-in, fetching and resolving the hosts in timing.
+    required: false
   state:
     description:
-      - State of the backup job on the Veeam server.
+      - State of the backup job on the Veeam server. If set to facts, the job is left as it is and the performance of its last sessions within history_days is returned in the veeam_job_sessions fact. The name may then use wildcards to report on several jobs.
     required: false
     choices:
       - present
       - absent
+      - facts
     default: present
   hosts:
     description:
-      - Name of a single host or a comma-separated list of hosts. These are the guest VM names as used in your vCenter. May use wildcards.
-    required: true
+      - Name of a single host or a comma-separated list of hosts. These are the guest VM names as used in your vCenter. May use wildcards. Required for jobs which should be present.
+    required: false
   repository:
     description:
-      - Name of a single backup repository or a comma-separated list of backup repositories.
-    required: true
+      - Name of a single backup repository or a comma-separated list of backup repositories. Required for jobs which should be present.
+    required: false
   repository_scaleout:
     description:
       - Enables or disables the search for scale out repositories.
@@ -66,8 +72,21 @@ options:
     default: no
   proxies:
     description:
-      - Name of a single backup proxy or a comma-separated list of backup proxies. Falls back to automatic proxy selection if not set or empty.
+      - Name of a single backup proxy or a comma-separated list of backup proxies. Falls back to automatic proxy selection if not set or empty. If selection is load, these are the candidates to choose from.
+    required: false
+  selection:
+    description:
+      - If set to load, the repository and proxies are lists of candidates and the job is assigned to the least loaded of them. The load of a repository or proxy is measured from its task slots, the jobs already assigned to it and the throughput of those jobs in the sessions of the last history_days, all fetched once per run. A new job gets the least loaded repository with enough free space for the used size of its hosts, existing jobs keep their repository, as their backups aren't moved. Each job gets the least loaded proxy_count proxies, keeping its current ones if they are as loaded as others. The assignments and the reasons for them are returned in selection.
+    required: false
+    choices:
+      - fixed
+      - load
+    default: fixed
+  proxy_count:
+    description:
+      - The number of proxies to assign a job to if selection is load.
     required: false
+    default: 1
   algorithm:
     description:
       - In Incremental mode the first job run creates a full backup file, and the subsequent runs backups only store the changed blocks. In ReverseIncremental mode every job run creates a full backup file by merging a previous full backup with recent changes.
@@ -105,9 +124,37 @@ options:
     required: false
   hour:
     description:
-      - For daily and monthly schedules, this specifies the hour of the day (0-23) at which the job should be started. If not set, the job will start at 10 by default.
+      - For daily and monthly schedules, this specifies the hour of the day (0-23) at which the job should be started. If not set, the job will start at 10 by default. Ignored if backup_window is set.
     required: false
     default: 10
+  backup_window:
+    description:
+      - For daily and monthly schedules, the hours between which the job should run, like 22-6, instead of a fixed hour. The start time is computed in quarter hours from the used size of the hosts of the job, or its recent sessions if it has run before, and the start times of the other jobs of its window_group, so that their combined throughput stays below window_throughput. Only start times from which the job ends within the window are used. A job taking longer than the window starts at its beginning and has fits_window set to false in the plan. The jobs of a single run are placed largest first and the plan is returned in the veeam_backup_plan fact.
+    required: false
+  window_group:
+    description:
+      - The name of the group of jobs sharing the throughput of a backup window, like the repository and proxies they use. Defaults to the repository of the job.
+    required: false
+  window_throughput:
+    description:
+      - The throughput in MB/s the jobs of a window_group may reach together, the lowest value set for the jobs of a group applies.
+    required: false
+    default: 200
+  window_rate:
+    description:
+      - The throughput in MB/s assumed for a job in a backup window which hasn't run before.
+    required: false
+    default: 50
+  history_days:
+    description:
+      - The number of days of backup sessions taken into account for backup windows, the selection by load and facts, fetched in a single query.
+    required: false
+    default: 14
+  session_count:
+    description:
+      - The number of the last completed sessions of each job returned with their duration, sizes, rate and bottleneck if the state is facts. Only the sessions of the last history_days are read, so fewer are returned for jobs which ran less often, and none for jobs which didn't run in that time.
+    required: false
+    default: 5
   day:
     description:
       - For daily and monthly schedules, this specifies the day of week to run the job.
@@ -254,6 +301,22 @@ options:
     description:
       - Specifies the credentials to use when the vss parameter is enabled. Valid credentials need to already have been configured in Veeam.
     required: false
+  entity_cache:
+    description:
+      - Keep the names and used sizes of the entities the host patterns matched in a cache file in cache_dir on the Veeam server, to avoid sweeping the inventory of the vCenter servers on every run. Hosts which are already in their job are skipped, the others are looked up by name. The result contains the number of entities taken from the cache and looked up live and of the hosts skipped in entities.
+    required: false
+    default: no
+    choices: ['yes', 'no']
+  entity_cache_ttl:
+    description:
+      - The number of seconds after which the entities of a host pattern are looked up again, defaults to one hour. Hosts matching a pattern which were added to the vCenter since are only found after that time.
+    required: false
+    default: 3600
+  cache_dir:
+    description:
+      - The directory on the Veeam server in which the entity cache is kept.
+    required: false
+    default: '%ProgramData%\\Ansible\\veeam_cache'
 author:
     - Simon Rupf
 '''
@@ -277,4 +340,41 @@ EXAMPLES = '''
     full_day_in_month: First
     vss: yes
     user: Administrator
+# example managing the jobs of several protection groups in a single run
+- win_veeam_job:
+    repository: MyTapeRepo
+    hour: 22
+    jobs:
+      - name: Protection group 1
+        hosts: PG1-*
+      - name: Protection group 2
+        hosts: PG2-*
+        hour: 23
+      - name: Protection group 3
+        state: absent
+# example assigning jobs to the least loaded of several repositories and proxies
+- win_veeam_job:
+    name: Protection group 4
+    hosts: PG4-*
+    repository: MyRepo01,MyRepo02,MyRepo03
+    proxies: MyProxy01,MyProxy02,MyProxy03,MyProxy04
+    proxy_count: 2
+    selection: load
+# example staggering the start times of jobs on the same repository within the night
+- win_veeam_job:
+    repository: MyTapeRepo
+    backup_window: 20-6
+    window_throughput: 400
+    jobs:
+      - name: Protection group 1
+        hosts: PG1-*
+      - name: Protection group 2
+        hosts: PG2-*
+# example returning the performance of the last ten sessions of several jobs
+# within the last 30 days
+- win_veeam_job:
+    name: Protection group*
+    state: facts
+    session_count: 10
+    history_days: 30
 '''